@@ -1 +1,3 @@
 from ._version import __version__, VERSION
+
+default_app_config = 'anymail.apps.AnymailConfig'
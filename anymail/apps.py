@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+from .signals import tracking
+from .suppression import get_suppression_list, record_suppression_event
+
+
+class AnymailConfig(AppConfig):
+    name = 'anymail'
+    verbose_name = "Anymail"
+
+    def ready(self):
+        # (Only connected if enabled, so tracking isn't dispatched to a receiver that does nothing)
+        if get_suppression_list() is not None:
+            tracking.connect(record_suppression_event, dispatch_uid="anymail.suppression")
@@ -1,12 +1,18 @@
+from copy import copy
 from datetime import date, datetime
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 from django.utils.timezone import is_naive, get_current_timezone, make_aware, utc
 
-from ..exceptions import AnymailError, AnymailUnsupportedFeature, AnymailRecipientsRefused
-from ..message import AnymailStatus
-from ..utils import Attachment, ParsedEmail, UNSET, combine, last, get_anymail_setting
+from ..exceptions import AnymailCancelSend, AnymailError, AnymailUnsupportedFeature, AnymailRecipientsRefused
+from ..message import AnymailRecipientStatus, AnymailStatus
+from ..metrics import get_metrics_sink, get_send_status_code, record_send
+from ..signals import pre_send, post_send
+from ..suppression import get_suppression_list, normalize_email
+from ..utils import (Attachment, ParsedEmail, UNSET, attachment_encoding_cache, combine, last,
+                     get_anymail_setting, monotonic)
 
 
 class AnymailBaseBackend(BaseEmailBackend):
@@ -21,6 +27,22 @@ class AnymailBaseBackend(BaseEmailBackend):
                                                                kwargs=kwargs, default=False)
         self.ignore_recipient_status = get_anymail_setting('ignore_recipient_status',
                                                            kwargs=kwargs, default=False)
+        self.send_concurrency = get_anymail_setting('send_concurrency',
+                                                    kwargs=kwargs, default=1)
+        self.suppression_list = get_suppression_list(
+            get_anymail_setting('suppression_list', kwargs=kwargs, default=None))
+        self.metrics_sink = get_metrics_sink(
+            get_anymail_setting('metrics_sink', kwargs=kwargs, default=None))
+        self.max_batch_size = get_anymail_setting('max_batch_size', esp_name=self.esp_name,
+                                                  kwargs=kwargs, default=self.max_batch_size)
+        # (not from kwargs or esp_name: the cache is shared by all backends, so it has a single size)
+        encoding_cache_size = get_anymail_setting('attachment_encoding_cache_size', default=0)
+        if encoding_cache_size:
+            if encoding_cache_size != attachment_encoding_cache.max_size:
+                attachment_encoding_cache.resize(encoding_cache_size)  # (only when the setting has changed)
+            self.attachment_encoding_cache = attachment_encoding_cache
+        else:
+            self.attachment_encoding_cache = None
 
         # Merge SEND_DEFAULTS and <esp_name>_SEND_DEFAULTS settings
         send_defaults = get_anymail_setting('send_defaults', default={})  # but not from kwargs
@@ -31,6 +53,10 @@ class AnymailBaseBackend(BaseEmailBackend):
             send_defaults.update(esp_send_defaults)
         self.send_defaults = send_defaults
 
+    # Maximum number of "to" recipients the ESP allows in a single API call for a batch
+    # send (with merge_data), or None if unlimited. Larger batches are sent in chunks.
+    max_batch_size = None
+
     def open(self):
         """
         Open and persist a connection to the ESP's API, and whether
@@ -80,14 +106,7 @@ class AnymailBaseBackend(BaseEmailBackend):
         created_session = self.open()
 
         try:
-            for message in email_messages:
-                try:
-                    sent = self._send(message)
-                except AnymailError:
-                    if self.fail_silently:
-                        sent = False
-                    else:
-                        raise
+            for sent in self._send_all(email_messages):
                 if sent:
                     num_sent += 1
         finally:
@@ -96,6 +115,86 @@ class AnymailBaseBackend(BaseEmailBackend):
 
         return num_sent
 
+    def _send_all(self, email_messages):
+        """Sends all email_messages, and returns an iterable of whether each was sent.
+
+        This should only be called by send_messages, with the connection open.
+        Subclasses can override to send several messages in a single ESP API call.
+        """
+        if self.send_concurrency > 1 and len(email_messages) > 1:
+            return self._send_concurrently(email_messages)
+        else:
+            return (self._send_or_fail_silently(message) for message in email_messages)
+
+    def _send_or_fail_silently(self, message):
+        """Calls _send, but returns False for AnymailErrors if fail_silently"""
+        try:
+            return self._send_recording_metrics(message)
+        except AnymailError:
+            if self.fail_silently:
+                return False
+            else:
+                raise
+
+    def _send_concurrently(self, email_messages):
+        """Sends email_messages using a pool of up to send_concurrency threads.
+
+        Returns a list of sent results, in email_messages order. All messages
+        are attempted (and get an anymail_status) even if some fail; if not
+        fail_silently, the first failure (in message order) is then re-raised.
+        """
+        results = self._map_concurrently(self._send_recording_metrics, email_messages)
+        if not self.fail_silently:
+            for sent, err in results:
+                if err is not None:
+                    raise err
+        return [sent for sent, err in results]
+
+    def _send_recording_metrics(self, message):
+        """Calls _send, and records the result in Anymail's metrics"""
+        try:
+            sent = self._send(message)
+        except AnymailError as err:
+            self.record_send_metrics(message, err)
+            raise
+        self.record_send_metrics(message)
+        return sent
+
+    def record_send_metrics(self, message, error=None):
+        """Records a send attempt for message (which raised AnymailError error if not None) in Anymail's metrics,
+        and reports it to the metrics sink (if any) unless the send was cancelled or had no recipients
+
+        Subclasses that override _send_all must call this once for each message.
+        """
+        record_send(self.esp_name, message, error)
+        status = getattr(message, 'anymail_status', None)
+        if self.metrics_sink is not None and status is not None and (error is not None or status.status is not None):
+            self.metrics_sink(esp_name=self.esp_name, status=status, error=error,
+                              status_code=get_send_status_code(status, error))
+
+    def _map_concurrently(self, func, items):
+        """Calls func(item) for each of items, using up to send_concurrency threads.
+
+        Returns a list of (result, error) for each item (in order), where
+        error is an AnymailError raised by func, or None.
+        """
+        # Worker threads share this backend, and so its open connection.
+        def call_capturing_errors(item):
+            try:
+                return func(item), None
+            except AnymailError as err:
+                return None, err
+
+        if self.send_concurrency > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.send_concurrency, len(items)))
+            try:
+                return pool.map(call_capturing_errors, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            return [call_capturing_errors(item) for item in items]
+
     def _send(self, message):
         """Sends the EmailMessage message, and returns True if the message was sent.
 
@@ -104,23 +203,161 @@ class AnymailBaseBackend(BaseEmailBackend):
         Implementations must raise exceptions derived from AnymailError for
         anticipated failures that should be suppressed in fail_silently mode.
         """
-        message.anymail_status = AnymailStatus()
-        if not message.recipients():
+        message = self.prepare_message(message)
+        if message is None:
             return False
+        return self._send_prepared(message)
 
-        payload = self.build_message_payload(message, self.send_defaults)
-        # FUTURE: if pre-send-signal OK...
-        response = self.post_to_esp(payload, message)
-        message.anymail_status.esp_response = response
+    def prepare_message(self, message):
+        """Runs the steps before building message's payload, and returns the message to send (or None to skip it).
 
-        recipient_status = self.parse_recipient_status(response, payload, message)
-        message.anymail_status.set_recipient_status(recipient_status)
+        Gives message a new anymail_status, sends the pre_send signal, and drops
+        any recipients in the suppression list. (The result may be a copy of message,
+        sharing its anymail_status.) Returns None if the send was cancelled or there
+        are no recipients, or raises AnymailRecipientsRefused if all of them were suppressed.
+        """
+        message.anymail_status = AnymailStatus()
+        if not self.run_pre_send(message):  # (might modify message)
+            return None  # cancel send without error
+        if not message.recipients():
+            return None
+        if self.suppression_list is not None:
+            message = self.drop_suppressed_recipients(message)
+            if not message.recipients():
+                self.raise_for_recipient_status(message.anymail_status, None, None, message)
+                return None
+        return message
+
+    def _send_prepared(self, message):
+        """Sends message (the result of prepare_message), and returns True if it was sent"""
+        if self.max_batch_size is not None and len(message.to) > self.max_batch_size \
+                and self.is_batch_send(message):
+            return self._send_batch_in_chunks(message)
+
+        start = monotonic()
+        try:
+            payload = self.build_message_payload(message, self.send_defaults)
+            built = monotonic()
+            response = self.post_to_esp(payload, message)
+            message.anymail_status.esp_response = response
+            posted = monotonic()
+
+            recipient_status = self.parse_recipient_status(response, payload, message)
+            message.anymail_status.set_recipient_status(recipient_status)
+            self.record_timings(message.anymail_status, start, built, posted)
+        finally:
+            message.anymail_status.timings['total'] = monotonic() - start  # (for failed sends, too)
 
+        self.report_send(message, payload, response)  # (before raising recipient status errors)
         self.raise_for_recipient_status(message.anymail_status, response, payload, message)
-        # FUTURE: post-send signal
 
         return True
 
+    def record_timings(self, anymail_status, start, built, posted):
+        """Add the build_payload, post_to_esp and parse_response phases of an API call to anymail_status.timings"""
+        anymail_status.add_timing('build_payload', built - start)
+        anymail_status.add_timing('post_to_esp', posted - built)
+        anymail_status.add_timing('parse_response', monotonic() - posted)
+
+    def report_send(self, message, payload, response):
+        """Sends the post_send signal (if it has receivers)"""
+        if post_send.has_listeners(self.__class__):
+            self.run_post_send(message, payload, response)
+
+    def run_pre_send(self, message):
+        """Sends the pre_send signal, and returns True if message should still be sent"""
+        if not pre_send.has_listeners(self.__class__):
+            return True
+        try:
+            pre_send.send(self.__class__, message=message, esp_name=self.esp_name)
+        except AnymailCancelSend:
+            return False
+        return True
+
+    def run_post_send(self, message, payload, response):
+        """Sends the post_send signal"""
+        post_send.send(self.__class__, message=message, status=message.anymail_status, esp_name=self.esp_name,
+                       payload=payload, response=response, timings=message.anymail_status.timings)
+
+    def drop_suppressed_recipients(self, message):
+        """Returns message, or a copy without any recipients in the suppression list.
+
+        The dropped recipients get "rejected" status in message.anymail_status.
+        """
+        encoding = message.encoding
+        parsed = {field: [(address, ParsedEmail(address, encoding).email) for address in getattr(message, field)]
+                  for field in ('to', 'cc', 'bcc')}
+        suppressed = self.suppression_list.get_reasons(
+            email for addresses in parsed.values() for address, email in addresses)
+        if not suppressed:
+            return message
+        message.anymail_status.set_recipient_status({
+            email: AnymailRecipientStatus(message_id=None, status='rejected')
+            for addresses in parsed.values() for address, email in addresses
+            if normalize_email(email) in suppressed})
+        filtered_message = copy(message)  # (shares message.anymail_status)
+        for field, addresses in parsed.items():
+            setattr(filtered_message, field, [address for address, email in addresses
+                                              if normalize_email(email) not in suppressed])
+        return filtered_message
+
+    def is_batch_send(self, message):
+        """Returns True if message is a batch send, where each "to" gets an individual message"""
+        return combine(self.send_defaults.get('merge_data', UNSET), getattr(message, 'merge_data', UNSET)) is not UNSET
+
+    def _send_batch_in_chunks(self, message):
+        """Sends a batch send message in max_batch_size chunks of its "to" recipients.
+
+        Chunks are sent concurrently if send_concurrency allows. Each chunk records its
+        results in its own AnymailStatus, and once all have been sent they're combined into
+        message.anymail_status (esp_response is a list of the responses for each chunk).
+        Any cc and bcc recipients are sent only with the first chunk.
+        """
+        chunk_messages = []
+        for start in range(0, len(message.to), self.max_batch_size):
+            chunk_message = copy(message)
+            chunk_message.anymail_status = AnymailStatus()  # (not shared between send_chunk threads)
+            chunk_message.to = message.to[start:start + self.max_batch_size]
+            if start > 0:
+                chunk_message.cc = chunk_message.bcc = []
+            merge_data = getattr(message, 'merge_data', None)
+            if merge_data:
+                # Only include the merge_data this chunk needs
+                chunk_emails = [ParsedEmail(address, message.encoding).email for address in chunk_message.to]
+                chunk_message.merge_data = {email: merge_data[email] for email in chunk_emails
+                                            if email in merge_data}
+            chunk_messages.append(chunk_message)
+
+        started = monotonic()
+
+        def send_chunk(chunk_message):
+            chunk_start = monotonic()
+            payload = self.build_message_payload(chunk_message, self.send_defaults)
+            built = monotonic()
+            response = self.post_to_esp(payload, chunk_message)
+            posted = monotonic()
+            recipient_status = self.parse_recipient_status(response, payload, chunk_message)
+            # (phases are summed across chunks, so can add up to more than the total if sent concurrently)
+            self.record_timings(chunk_message.anymail_status, chunk_start, built, posted)
+            return response, payload, recipient_status
+
+        results = self._map_concurrently(send_chunk, chunk_messages)
+        message.anymail_status.esp_response = [result[0] if result else err.response
+                                               for result, err in results]
+        for chunk_message, (result, err) in zip(chunk_messages, results):
+            message.anymail_status.add_call_stats(chunk_message.anymail_status)
+            if err is None:
+                message.anymail_status.set_recipient_status(result[2])
+        message.anymail_status.timings['total'] = monotonic() - started
+        for result, err in results:
+            if err is not None:
+                raise err
+
+        self.report_send(message, [result[1] for result, err in results], message.anymail_status.esp_response)
+        self.raise_for_recipient_status(message.anymail_status, message.anymail_status.esp_response,
+                                        None, message)
+        return True
+
     def build_message_payload(self, message, defaults):
         """Returns a payload that will allow message to be sent via the ESP.
 
@@ -213,25 +450,44 @@ class BasePayload(object):
         self.init_payload()
 
         # we should consider hoisting the first text/html out of alternatives into set_html_body
-        message_attrs = self.base_message_attrs + self.anymail_message_attrs + self.esp_message_attrs
-        for attr, combiner, converter in message_attrs:
+        for attr, combiner, converter, setter_name in self.get_message_attr_plan():
             value = getattr(message, attr, UNSET)
             if combiner is not None:
-                default_value = self.defaults.get(attr, UNSET)
+                default_value = defaults.get(attr, UNSET)
+                if value is UNSET and default_value is UNSET:
+                    continue
                 value = combiner(default_value, value)
+            if value is not UNSET and converter is not None:
+                if not callable(converter):
+                    converter = getattr(self, converter)
+                value = converter(value)
             if value is not UNSET:
-                if converter is not None:
-                    if not callable(converter):
-                        converter = getattr(self, converter)
-                    value = converter(value)
-            if value is not UNSET:
-                if attr == 'body':
+                if setter_name is None:  # body
                     setter = self.set_html_body if message.content_subtype == 'html' else self.set_text_body
                 else:
                     # AttributeError here? Your Payload subclass is missing a set_<attr> implementation
-                    setter = getattr(self, 'set_%s' % attr)
+                    setter = getattr(self, setter_name)
                 setter(value)
 
+    @classmethod
+    def get_message_attr_plan(cls):
+        """Returns a list of (attr, combiner, converter, setter_name) for the payload class's message attrs.
+
+        converter is a function, the name of a payload converter method, or None.
+        setter_name is 'set_<attr>', or None for body. (The payload looks up
+        converter and setter methods on itself, so overrides are respected.)
+        The plan is computed once for each payload class, on first use.
+        """
+        try:
+            return cls.__dict__['_message_attr_plan']
+        except KeyError:
+            pass
+        plan = [(attr, combiner, converter, None if attr == 'body' else 'set_%s' % attr)
+                for attr, combiner, converter
+                in cls.base_message_attrs + cls.anymail_message_attrs + cls.esp_message_attrs]
+        cls._message_attr_plan = plan
+        return plan
+
     def unsupported_feature(self, feature):
         if not self.backend.ignore_unsupported_features:
             raise AnymailUnsupportedFeature("%s does not support %s" % (self.esp_name, feature),
@@ -250,7 +506,8 @@ class BasePayload(object):
 
     def prepped_attachments(self, attachments):
         str_encoding = self.message.encoding or settings.DEFAULT_CHARSET
-        return [Attachment(attachment, str_encoding) for attachment in attachments]
+        encoding_cache = self.backend.attachment_encoding_cache
+        return [Attachment(attachment, str_encoding, encoding_cache) for attachment in attachments]
 
     def aware_datetime(self, value):
         """Converts a date or datetime or timestamp to an aware datetime.
@@ -1,23 +1,133 @@
-import json
+import binascii
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from base64 import b64encode
+from contextlib import closing
+from email.utils import mktime_tz, parsedate_tz
 
 import requests
+import six
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+from requests.packages.urllib3.fields import RequestField
 # noinspection PyUnresolvedReferences
 from six.moves.urllib.parse import urljoin
 
 from .base import AnymailBaseBackend, BasePayload
 from ..exceptions import AnymailRequestsAPIError, AnymailSerializationError
+from ..jsoncodec import get_json_codec
+from ..ratelimit import get_rate_limiter, parse_rate
+from ..utils import get_anymail_setting, monotonic
 from .._version import __version__
 
 
+class PersistentSessionRegistry(object):
+    """A thread-safe, process-wide cache of requests Sessions
+
+    Sessions are shared by all backend instances with the same key
+    (e.g., esp_name and api_url), so their pooled connections to the ESP
+    survive from one backend instance to the next.
+
+    A session is closed (and removed) once it has been unused for longer
+    than its idle_timeout. This is checked whenever a session is borrowed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}  # key: _PersistentSession
+
+    def borrow(self, key, create_session, idle_timeout=None):
+        """Return the session for key, calling create_session() if there isn't one yet.
+
+        Callers must release(key) when they are done with the session.
+        """
+        with self._lock:
+            now = time.time()
+            self._close_idle_sessions(now)
+            try:
+                entry = self._sessions[key]
+            except KeyError:
+                entry = self._sessions[key] = _PersistentSession(create_session(), idle_timeout)
+            entry.borrowers += 1
+            entry.last_used = now
+            return entry.session
+
+    def release(self, key):
+        with self._lock:
+            try:
+                entry = self._sessions[key]
+            except KeyError:
+                return  # already cleared
+            entry.borrowers -= 1
+            entry.last_used = time.time()
+
+    def clear(self):
+        """Close and remove all sessions"""
+        with self._lock:
+            sessions = [entry.session for entry in self._sessions.values()]
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+    def _close_idle_sessions(self, now):
+        for key, entry in list(self._sessions.items()):
+            if entry.borrowers < 1 and entry.idle_timeout is not None \
+                    and now - entry.last_used > entry.idle_timeout:
+                del self._sessions[key]
+                entry.session.close()
+
+
+class _PersistentSession(object):
+    def __init__(self, session, idle_timeout):
+        self.session = session
+        self.idle_timeout = idle_timeout
+        self.borrowers = 0
+        self.last_used = None
+
+
+# Shared sessions for all backends using PERSISTENT_SESSIONS
+persistent_sessions = PersistentSessionRegistry()
+
+
 class AnymailRequestsBackend(AnymailBaseBackend):
     """
     Base Anymail email backend for ESPs that use an HTTP API via requests
     """
 
+    # HTTP statuses that mean the ESP did not accept the message, so it's safe to try again.
+    # (Not 500, where the ESP may have sent the message before running into trouble.)
+    retry_status_codes = (429, 502, 503, 504)
+
     def __init__(self, api_url, **kwargs):
         """Init options from Django settings"""
         self.api_url = api_url
         super(AnymailRequestsBackend, self).__init__(**kwargs)
+        self.persistent_sessions = get_anymail_setting('persistent_sessions', kwargs=kwargs, default=False)
+        self.session_idle_timeout = get_anymail_setting('session_idle_timeout', kwargs=kwargs, default=60)
+        # allow each concurrent send thread its own pooled connection
+        self.session_pool_size = max(get_anymail_setting('session_pool_size', kwargs=kwargs,
+                                                         default=DEFAULT_POOLSIZE),
+                                     self.send_concurrency)
+        self.streaming_threshold = get_anymail_setting('streaming_threshold', kwargs=kwargs, default=None)
+        self.json_codec = get_json_codec(get_anymail_setting('json_codec', kwargs=kwargs, default="json"))
+        self.send_retries = get_anymail_setting('send_retries', kwargs=kwargs, default=0)
+        self.send_retry_backoff = get_anymail_setting('send_retry_backoff', kwargs=kwargs, default=0.5)
+        self.send_retry_max_backoff = get_anymail_setting('send_retry_max_backoff', kwargs=kwargs, default=30)
+        self.send_retry_time_limit = get_anymail_setting('send_retry_time_limit', kwargs=kwargs, default=60)
+        self.rate_limit = get_anymail_setting('rate_limit', esp_name=self.esp_name, kwargs=kwargs, default=None)
+        if self.rate_limit is not None:
+            self.rate_limit = parse_rate(self.rate_limit)
+            self.rate_limit_burst = get_anymail_setting('rate_limit_burst', esp_name=self.esp_name, kwargs=kwargs,
+                                                        default=max(1, int(self.rate_limit)))
+            self.rate_limit_per_api_key = get_anymail_setting('rate_limit_per_api_key', esp_name=self.esp_name,
+                                                              kwargs=kwargs, default=False)
+            self.rate_limiter = get_rate_limiter(
+                get_anymail_setting('rate_limiter', kwargs=kwargs, default="local"),
+                cache_alias=get_anymail_setting('rate_limit_cache', kwargs=kwargs, default="default"))
         self.session = None
 
     def open(self):
@@ -25,21 +135,43 @@ class AnymailRequestsBackend(AnymailBaseBackend):
             return False  # already exists
 
         try:
-            self.session = requests.Session()
+            if self.persistent_sessions:
+                self.session = persistent_sessions.borrow(self.persistent_session_key, self.create_session,
+                                                          idle_timeout=self.session_idle_timeout)
+            else:
+                self.session = self.create_session()
         except requests.RequestException:
             if not self.fail_silently:
                 raise
         else:
-            self.session.headers["User-Agent"] = "django-anymail/{version}-{esp} {orig}".format(
-                esp=self.esp_name.lower(), version=__version__,
-                orig=self.session.headers.get("User-Agent", ""))
             return True
 
+    def create_session(self):
+        """Return a new requests.Session for calling the ESP's API"""
+        session = requests.Session()
+        session.headers["User-Agent"] = "django-anymail/{version}-{esp} {orig}".format(
+            esp=self.esp_name.lower(), version=__version__,
+            orig=session.headers.get("User-Agent", ""))
+        if self.session_pool_size != DEFAULT_POOLSIZE:
+            adapter = HTTPAdapter(pool_connections=self.session_pool_size,
+                                  pool_maxsize=self.session_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        return session
+
+    @property
+    def persistent_session_key(self):
+        """Backends with the same key can share a persistent session"""
+        return self.esp_name, self.api_url, self.session_pool_size
+
     def close(self):
         if self.session is None:
             return
         try:
-            self.session.close()
+            if self.persistent_sessions:
+                persistent_sessions.release(self.persistent_session_key)  # leave it open for reuse
+            else:
+                self.session.close()
         except requests.RequestException:
             if not self.fail_silently:
                 raise
@@ -63,12 +195,96 @@ class AnymailRequestsBackend(AnymailBaseBackend):
         return should be a requests.Response
 
         Can raise AnymailRequestsAPIError for HTTP errors in the post
+
+        Failures to connect (see is_connect_error) and retry_status_codes responses
+        are retried (up to send_retries times, within send_retry_time_limit seconds).
         """
+        started = monotonic()
         params = payload.get_request_params(self.api_url)
-        response = self.session.request(**params)
+        if isinstance(params.get('data'), six.text_type):
+            # (http.client would encode a str body as latin-1; JSON codecs may leave non-ascii chars unescaped)
+            params['data'] = params['data'].encode('utf-8')
+        serialize_time = monotonic() - started
+        deadline = monotonic() + self.send_retry_time_limit
+        attempt = 0
+        while True:
+            if self.rate_limit is not None:
+                self.wait_for_rate_limit(payload)
+            try:
+                response = self.session.request(**params)
+            except requests.ConnectionError as err:
+                if not is_connect_error(err):
+                    raise
+                response = None
+                last_error = err
+                if attempt >= self.send_retries:
+                    raise last_error
+            else:
+                if response.status_code not in self.retry_status_codes or attempt >= self.send_retries:
+                    break
+            delay = self.get_retry_delay(attempt, response)
+            if monotonic() + delay > deadline:
+                if response is None:
+                    raise last_error
+                break
+            time.sleep(delay)
+            attempt += 1
+            self.record_retry(delay, payload, message)
+            if isinstance(params.get('data'), StreamingBody):
+                params['data'].seek(0)  # (rewind for the retry)
+        self.record_request(serialize_time, params, response, payload, message)
         self.raise_for_status(response, payload, message)
         return response
 
+    def record_request(self, serialize_time, params, response, payload, message):
+        """Note the send API call's serialize and time_to_first_byte timings, and sizes, in message.anymail_status"""
+        if message is not None:
+            message.anymail_status.add_timing('serialize', serialize_time)
+            # (requests' elapsed is from sending the request until the response headers arrive)
+            message.anymail_status.add_timing('time_to_first_byte', response.elapsed.total_seconds())
+            message.anymail_status.add_sizes(request_body_size(params, response), len(response.content))
+
+    def wait_for_rate_limit(self, payload):
+        """Sleep until the rate limit allows another ESP API call"""
+        delay = self.rate_limiter.acquire(self.get_rate_limit_key(payload), self.rate_limit, self.rate_limit_burst)
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_rate_limit_key(self, payload):
+        """Return a str identifying the rate limit budget payload's API call counts against"""
+        key = self.esp_name.lower()
+        if self.rate_limit_per_api_key:
+            credential = self.get_rate_limit_credential(payload)
+            if credential is not None:
+                # (don't put API keys in cache keys)
+                key += ":" + hashlib.sha1(credential.encode('utf-8')).hexdigest()[:16]
+        return key
+
+    def get_rate_limit_credential(self, payload):
+        """Return the API key (or other credential) payload will be sent with.
+
+        Subclasses should override if the ESP's credential isn't self.api_key.
+        """
+        return getattr(self, 'api_key', None)
+
+    def get_retry_delay(self, attempt, response=None):
+        """Return the number of seconds to wait before retrying a failed request.
+
+        Uses the response's Retry-After header if present, otherwise
+        exponential backoff with "full jitter."
+        """
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after
+        return random.uniform(0, min(self.send_retry_max_backoff, self.send_retry_backoff * 2 ** attempt))
+
+    def record_retry(self, delay, payload, message):
+        """Note a retried request (after delay seconds) in message.anymail_status"""
+        if message is not None:
+            message.anymail_status.retries += 1
+            message.anymail_status.retry_delay += delay
+
     def raise_for_status(self, response, payload, message):
         """Raise AnymailRequestsAPIError if response is an HTTP error
 
@@ -85,12 +301,30 @@ class AnymailRequestsBackend(AnymailBaseBackend):
         Useful for implementing deserialize_response
         """
         try:
-            return response.json()
+            # (bytes, unless requests knows the encoding; the json_codec decodes utf-8)
+            return self.json_codec.loads(response.content if response.encoding is None else response.text)
         except ValueError:
             raise AnymailRequestsAPIError("Invalid JSON in %s API response" % self.esp_name,
                                           email_message=message, payload=payload, response=response)
 
 
+def parse_retry_after(value):
+    """Return the number of seconds specified by an HTTP Retry-After header value, or None.
+
+    value can be delay-seconds or an HTTP-date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed_date = parsedate_tz(value)
+    if parsed_date is None:
+        return None
+    return max(0, mktime_tz(parsed_date) - time.time())
+
+
 class RequestsPayload(BasePayload):
     """Abstract Payload for AnymailRequestsBackend"""
 
@@ -117,13 +351,23 @@ class RequestsPayload(BasePayload):
         else:
             url = api_url
 
+        data = self.serialize_data()
+        headers = self.headers
+        files = self.files
+        if files and self.backend.streaming_threshold is not None:
+            if sum(content_size(file_content(value)) for value in dict_or_list_values(files)) \
+                    >= self.backend.streaming_threshold:
+                data = StreamingBody.from_multipart(data, files)
+                headers = dict(headers or {}, **{'Content-Type': data.content_type})
+                files = None
+
         return dict(
             method=self.method,
             url=url,
             params=self.params,
-            data=self.serialize_data(),
-            headers=self.headers,
-            files=self.files,
+            data=data,
+            headers=headers,
+            files=files,
             auth=self.auth,
             # json= is not here, because we prefer to do our own serialization
             #       to provide extra context in error messages
@@ -141,10 +385,307 @@ class RequestsPayload(BasePayload):
         """Returns data serialized to json, raising appropriate errors.
 
         Useful for implementing serialize_data in a subclass,
+
+        If data contains Base64Content items (see b64content), and their total size
+        is at least the backend's streaming_threshold, returns a StreamingBody that
+        encodes them as it's sent. (The result is otherwise identical.)
         """
+        placeholders = {}  # token: Base64Content
+
+        def placeholder(obj):
+            if isinstance(obj, Base64Content):
+                token = "anymail-b64-%s-%d" % (id(placeholders), len(placeholders))
+                placeholders[token] = obj
+                return token
+            raise TypeError("%r is not JSON serializable" % obj)
+
         try:
-            return json.dumps(data)
+            serialized = self.backend.json_codec.dumps(data, default=placeholder)
         except TypeError as err:
             # Add some context to the "not JSON serializable" message
             raise AnymailSerializationError(orig_err=err, email_message=self.message,
                                             backend=self.backend, payload=self)
+        if not placeholders:
+            return serialized
+
+        # Split serialized into json text and the Base64Content between them
+        parts = re.split("(%s)" % "|".join(re.escape(token) for token in placeholders), serialized)
+        parts = [placeholders[part] if i % 2 else part for i, part in enumerate(parts)]
+        streamed_size = sum(part.size for part in parts if isinstance(part, Base64Content))
+        if streamed_size >= self.backend.streaming_threshold:
+            return StreamingBody.from_parts(parts)
+        return "".join(part.b64content if isinstance(part, Base64Content) else part for part in parts)
+
+    def b64content(self, attachment):
+        """Returns attachment's content for json data, as a base64 str (or a Base64Content to be streamed)
+
+        Useful for implementing attachments in a subclass that uses serialize_json
+        """
+        if self.backend.streaming_threshold is not None:
+            return Base64Content(attachment)
+        return attachment.b64content
+
+    def upload_content(self, attachment):
+        """Returns attachment's content for a requests files value
+
+        Useful for implementing attachments in a subclass that uploads files.
+        File attachments aren't read until the request is sent (and then
+        in chunks, if the request is streamed).
+        """
+        if attachment.is_file:
+            return AttachmentUpload(attachment)
+        return attachment.content
+
+
+class Base64Content(object):
+    """An Attachment's content, to be base64 encoded while it is streamed"""
+
+    chunk_size = 3 * 16 * 1024  # (multiple of 3 bytes, so encoded chunks can simply be concatenated)
+
+    def __init__(self, attachment):
+        self.attachment = attachment
+        self.size = attachment.size
+
+    @property
+    def b64content(self):
+        return self.attachment.b64content
+
+    @property
+    def b64length(self):
+        return 4 * ((self.size + 2) // 3)
+
+    def iter_b64chunks(self):
+        with closing(self.attachment.open()) as f:
+            for chunk in read_chunks(f, self.chunk_size):
+                yield b64encode(chunk)
+
+
+class AttachmentUpload(object):
+    """A file Attachment's content, for a requests files value.
+
+    Iterating yields bytes chunks read from the file (for a StreamingBody);
+    read() returns the entire content (for requests' own multipart encoder).
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, attachment):
+        self.attachment = attachment
+        self.size = attachment.size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        with closing(self.attachment.open()) as f:
+            for chunk in read_chunks(f, self.chunk_size):
+                yield chunk
+
+    def read(self):
+        return self.attachment.content
+
+
+class FileChunks(object):
+    """Iterates a file-like object's content in bytes chunks, from its current position.
+
+    Each iteration starts again from that (original) position. len() is the content size.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.start = fileobj.tell()
+        self.length = content_size(fileobj)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        self.fileobj.seek(self.start)
+        for chunk in read_chunks(self.fileobj, self.chunk_size):
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+
+def read_chunks(fileobj, chunk_size):
+    """Yields fileobj's remaining content in chunks of chunk_size (except the last, which may be shorter)"""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        while chunk and len(chunk) < chunk_size:
+            more = fileobj.read(chunk_size - len(chunk))  # (a short read isn't necessarily the end)
+            if not more:
+                break
+            chunk += more
+        if not chunk:
+            break
+        yield chunk
+
+
+def file_content(value):
+    """Returns the content from a requests files value ((filename, content, ...) tuple, or bare content)"""
+    return value[1] if isinstance(value, (tuple, list)) else value
+
+
+def content_size(content):
+    """Returns the size of content (bytes, str, AttachmentUpload, or a seekable file-like object), in bytes"""
+    if isinstance(content, AttachmentUpload):
+        return content.size
+    if hasattr(content, 'read'):
+        position = content.tell()
+        content.seek(0, os.SEEK_END)
+        size = content.tell() - position
+        content.seek(position)
+        return size
+    if isinstance(content, six.text_type):
+        return len(content.encode('utf-8'))
+    return len(content)
+
+
+def is_connect_error(err):
+    """Returns True if requests exception err means the connection to the ESP couldn't be opened
+
+    (So the ESP can't have received the request, and it's safe to retry.) Other
+    ConnectionErrors -- like a connection aborted or reset, or an SSLError -- can
+    happen after the whole request has been sent, so the ESP may have the message.
+    """
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    if isinstance(err, requests.exceptions.SSLError):
+        return False
+    reason = err.args[0] if err.args else None
+    reason = getattr(reason, 'reason', reason)  # (requests wraps urllib3's MaxRetryError)
+    return isinstance(reason, NewConnectionError)
+
+
+def request_body_size(params, response):
+    """Returns the size in bytes of the request body sent for a requests.request(**params), or None if unknown"""
+    request = getattr(response, 'request', None)
+    body = request.body if request is not None else params.get('data') if not params.get('files') else None
+    if isinstance(body, (six.binary_type, six.text_type)):
+        return content_size(body)
+    if isinstance(body, StreamingBody):
+        return len(body)
+    return None  # (e.g., form data, or a streamed request requests didn't prepare)
+
+
+def dict_or_list_items(value):
+    return value.items() if isinstance(value, dict) else value
+
+
+def dict_or_list_values(value):
+    return [item for (_, item) in dict_or_list_items(value)]
+
+
+class StreamingBody(object):
+    """A request body that's generated as it is sent.
+
+    Can be iterated (yielding bytes chunks) or read like a file; either way,
+    the chunks are produced by a new call to make_chunks(). len() is the
+    total size in bytes, which requests uses for the Content-Length header.
+    """
+
+    def __init__(self, make_chunks, length):
+        self.make_chunks = make_chunks
+        self.length = length
+        self.seek(0)
+
+    @classmethod
+    def from_parts(cls, parts):
+        """Returns a StreamingBody for a sequence of str, bytes, Base64Content and StreamingBody parts
+
+        str parts are encoded as utf-8 (JSON codecs may leave non-ascii characters unescaped).
+        """
+        parts = [part.encode('utf-8') if isinstance(part, six.text_type) else part for part in parts]
+
+        def make_chunks():
+            for part in parts:
+                if isinstance(part, bytes):
+                    yield part
+                elif isinstance(part, Base64Content):
+                    for chunk in part.iter_b64chunks():
+                        yield chunk
+                else:
+                    for chunk in part:
+                        yield chunk
+
+        length = sum(part.b64length if isinstance(part, Base64Content) else len(part) for part in parts)
+        return cls(make_chunks, length)
+
+    @classmethod
+    def from_multipart(cls, data, files):
+        """Returns a StreamingBody for multipart/form-data, like requests would encode data and files.
+
+        File content can be bytes, str, or a file-like object (which is read in chunks
+        as the body is sent). Sets content_type (which includes the multipart boundary).
+        """
+        boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        parts = []
+
+        def add_field(field):
+            parts.append(("--%s\r\n" % boundary + field.render_headers()).encode('utf-8'))
+            content = field.data
+            if isinstance(content, six.integer_types):
+                content = str(content)
+            if isinstance(content, six.text_type):
+                content = content.encode('utf-8')
+            parts.append(content if isinstance(content, (bytes, AttachmentUpload)) else FileChunks(content))
+            parts.append(b"\r\n")
+
+        # data fields (and their order) as requests.models.RequestEncodingMixin._encode_files:
+        for name, values in dict_or_list_items(data or {}):
+            if isinstance(values, six.string_types) or not hasattr(values, '__iter__'):
+                values = [values]
+            for value in values:
+                if value is not None:
+                    if not isinstance(value, bytes):
+                        value = six.text_type(value)
+                    field = RequestField(name=name.decode('utf-8') if isinstance(name, bytes) else name,
+                                         data=value.encode('utf-8') if isinstance(value, six.text_type) else value)
+                    field.make_multipart()
+                    add_field(field)
+        for name, value in dict_or_list_items(files):
+            filename = content_type = headers = None
+            if isinstance(value, (tuple, list)):
+                if len(value) == 2:
+                    filename, content = value
+                elif len(value) == 3:
+                    filename, content, content_type = value
+                else:
+                    filename, content, content_type, headers = value
+            else:
+                content = value
+                filename = getattr(content, 'name', None) or name
+            field = RequestField(name=name, data=content, filename=filename, headers=headers)
+            field.make_multipart(content_type=content_type)
+            add_field(field)
+        parts.append(("--%s--\r\n" % boundary).encode('ascii'))
+
+        body = cls.from_parts(parts)
+        body.content_type = "multipart/form-data; boundary=%s" % boundary
+        return body
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.make_chunks()
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise ValueError("StreamingBody can only seek to the start")
+        self._chunks = self.make_chunks()
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            result, self._buffer = self._buffer, b""
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
@@ -22,6 +22,9 @@ class MailgunBackend(AnymailRequestsBackend):
             api_url += "/"
         super(MailgunBackend, self).__init__(api_url, **kwargs)
 
+    # Mailgun's batch sending allows at most this many recipients per API call
+    max_batch_size = 1000
+
     def build_message_payload(self, message, defaults):
         return MailgunPayload(message, defaults, self)
 
@@ -156,7 +159,7 @@ class MailgunPayload(RequestsPayload):
             field = "attachment"
             name = attachment.name
         self.files.append(
-            (field, (name, attachment.content, attachment.mimetype))
+            (field, (name, self.upload_content(attachment), attachment.mimetype))
         )
 
     def set_metadata(self, metadata):
@@ -129,7 +129,7 @@ class MandrillPayload(RequestsPayload):
         self.data["message"].setdefault(field, []).append({
             "type": attachment.mimetype,
             "name": name,
-            "content": attachment.b64content
+            "content": self.b64content(attachment)
         })
 
     def set_metadata(self, metadata):
@@ -0,0 +1,38 @@
+from django.core.mail.backends.base import BaseEmailBackend
+
+from ..message import AnymailRecipientStatus, AnymailStatus
+from ..outbox import Outbox
+from ..utils import ParsedEmail
+
+
+class OutboxBackend(BaseEmailBackend):
+    """
+    Anymail email backend that stores messages in a durable outbox, to be sent later
+
+    Run the anymail_send_outbox management command to actually send the messages
+    (through the ANYMAIL_OUTBOX_BACKEND).
+    """
+
+    def __init__(self, **kwargs):
+        super(OutboxBackend, self).__init__(fail_silently=kwargs.pop('fail_silently', False))
+        self.outbox = Outbox(**kwargs)
+
+    def send_messages(self, email_messages):
+        email_messages = [message for message in email_messages if message.recipients()]
+        if not email_messages:
+            return 0
+        try:
+            outbox_ids = self.outbox.put(email_messages)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
+
+        for message, outbox_id in zip(email_messages, outbox_ids):
+            # The outbox id stands in for the ESP's message_id until the message is sent
+            recipient_status = AnymailRecipientStatus(message_id=outbox_id, status='queued')
+            message.anymail_status = AnymailStatus()
+            message.anymail_status.set_recipient_status(
+                {ParsedEmail(address, message.encoding).email: recipient_status
+                 for address in message.recipients()})
+        return len(email_messages)
@@ -1,10 +1,13 @@
 import re
 
-from ..exceptions import AnymailRequestsAPIError
+# noinspection PyUnresolvedReferences
+from six.moves.urllib.parse import urljoin
+
+from ..exceptions import AnymailError, AnymailRequestsAPIError
 from ..message import AnymailRecipientStatus
-from ..utils import get_anymail_setting
+from ..utils import UNSET, combine, get_anymail_setting, last, monotonic
 
-from .base_requests import AnymailRequestsBackend, RequestsPayload
+from .base_requests import AnymailRequestsBackend, RequestsPayload, StreamingBody, content_size
 
 
 class PostmarkBackend(AnymailRequestsBackend):
@@ -20,11 +23,166 @@ class PostmarkBackend(AnymailRequestsBackend):
                                       default="https://api.postmarkapp.com/")
         if not api_url.endswith("/"):
             api_url += "/"
+        self.batch_send = get_anymail_setting('batch_send', esp_name=esp_name, kwargs=kwargs, default=False)
         super(PostmarkBackend, self).__init__(api_url, **kwargs)
 
+    # Postmark's batch APIs accept at most this many messages per call
+    # (and a merge_data batch send makes a separate message for each "to")
+    max_batch_size = 500
+
+    # ... and a request body of at most this many bytes (including attachments)
+    max_batch_payload_size = 50 * 1024 * 1024
+
     def build_message_payload(self, message, defaults):
         return PostmarkPayload(message, defaults, self)
 
+    def _send_all(self, email_messages):
+        if not self.batch_send or len(email_messages) < 2:
+            return super(PostmarkBackend, self)._send_all(email_messages)
+
+        # Messages that can use the batch API are grouped by server token
+        # (which may vary via esp_extra), and sent in chunks of at most
+        # max_batch_size messages and max_batch_payload_size bytes.
+        # Template messages can't be batched, and are sent individually.
+        results = [False] * len(email_messages)
+        errors = [None] * len(email_messages)
+        batches = {}  # server_token: [(index, message, payload, serialized data, build time), ...]
+        for index, message in enumerate(email_messages):
+            try:
+                message = self.prepare_message(message)  # (suppression list, pre_send, etc.)
+                if message is None:
+                    continue
+                if not self.is_batchable(message):
+                    results[index] = self._send_prepared(message)
+                    continue
+                start = monotonic()
+                payload = self.build_message_payload(message, self.send_defaults)
+                built = monotonic()
+                data = payload.serialize_data()
+                serialized = monotonic()
+                message.anymail_status.add_timing('build_payload', built - start)
+                message.anymail_status.add_timing('serialize', serialized - built)
+                batch = batches.setdefault(payload.server_token, [])
+                batch.append((index, message, payload, data, serialized - start))
+            except AnymailError as err:
+                errors[index] = err
+
+        for batch in batches.values():
+            for chunk in self.batch_chunks(batch):
+                for index, sent, err in self._send_batch(chunk):
+                    results[index] = sent
+                    errors[index] = err
+
+        for message, err in zip(email_messages, errors):
+            self.record_send_metrics(message, err)
+        if not self.fail_silently:
+            for err in errors:
+                if err is not None:
+                    raise err
+        return results
+
+    def batch_chunks(self, batch):
+        """Yields chunks of batch's (index, message, payload, serialized data, build time) for _send_batch
+
+        Each chunk has at most max_batch_size messages, and serializes to at most
+        max_batch_payload_size bytes -- unless a single message is larger than that
+        (it's sent in a chunk of its own, and Postmark will reject it).
+        """
+        chunk = []
+        chunk_size = len("[]")
+        for item in batch:
+            data = item[3]
+            size = (len(data) if isinstance(data, StreamingBody) else content_size(data)) + len(", ")
+            if chunk and (len(chunk) >= self.max_batch_size or chunk_size + size > self.max_batch_payload_size):
+                yield chunk
+                chunk = []
+                chunk_size = len("[]")
+            chunk.append(item)
+            chunk_size += size
+        if chunk:
+            yield chunk
+
+    def is_batchable(self, message):
+        """Returns True if message can be sent with Postmark's batch API, which doesn't support templates
+
+        (Must agree with PostmarkPayload.get_api_endpoint, but is decided without building a payload.)
+        """
+        defaults = self.send_defaults
+        if last(defaults.get('template_id', UNSET), getattr(message, 'template_id', UNSET)) is not UNSET:
+            return False
+        for attr in ('merge_data', 'merge_global_data'):
+            if combine(defaults.get(attr, UNSET), getattr(message, attr, UNSET)) is not UNSET:
+                return False
+        esp_extra = combine(defaults.get('esp_extra', UNSET), getattr(message, 'esp_extra', UNSET))
+        return esp_extra is UNSET or not ('TemplateId' in esp_extra or 'TemplateModel' in esp_extra)
+
+    def _send_batch(self, batch):
+        """Sends batch of (index, message, payload, serialized data, build time) via Postmark's batch API.
+
+        Yields (index, sent, error) for each message in the batch. Each message's
+        anymail_status.timings include its own build time, and the batch API call's.
+        """
+        batch_payload = PostmarkBatchPayload([data for (_, _, _, data, _) in batch],
+                                             server_token=batch[0][2].server_token,
+                                             messages=[message for (_, message, _, _, _) in batch])
+        start = monotonic()
+        try:
+            response = self.post_to_esp(batch_payload, None)
+            posted = monotonic()
+            if response.status_code != 200:  # (PostmarkBackend.raise_for_status allows 422)
+                raise AnymailRequestsAPIError(payload=batch_payload, response=response)
+            parsed_response = self.deserialize_json_response(response, batch_payload, None)
+            if not isinstance(parsed_response, list) or len(parsed_response) != len(batch):
+                raise AnymailRequestsAPIError("Invalid Postmark batch API response format",
+                                              payload=batch_payload, response=response)
+        except AnymailError as err:
+            # The entire batch failed
+            failed = monotonic()
+            for (index, message, payload, _, build_time) in batch:
+                message.anymail_status.esp_response = err.response
+                message.anymail_status.timings['total'] = build_time + failed - start
+                yield index, False, err
+            return
+        batch_parse_time = monotonic() - posted
+
+        # Postmark's batch response has one result per message, in the same order
+        for (index, message, payload, _, build_time), parsed_result in zip(batch, parsed_response):
+            anymail_status = message.anymail_status
+            anymail_status.esp_response = response
+            try:
+                parse_start = monotonic()
+                recipient_status = self.parse_send_result(parsed_result, response, payload, message)
+                anymail_status.set_recipient_status(recipient_status)
+                anymail_status.add_timing('post_to_esp', posted - start)
+                anymail_status.add_timing('parse_response', batch_parse_time + monotonic() - parse_start)
+                anymail_status.timings['total'] = (build_time + anymail_status.timings['post_to_esp']
+                                                   + anymail_status.timings['parse_response'])
+                self.report_send(message, payload, response)  # (before raising recipient status errors)
+                self.raise_for_recipient_status(message.anymail_status, response, payload, message)
+            except AnymailError as err:
+                yield index, False, err
+            else:
+                yield index, True, None
+
+    def get_rate_limit_credential(self, payload):
+        return payload.server_token  # (can be overridden per message by esp_extra)
+
+    def record_request(self, serialize_time, params, response, payload, message):
+        if isinstance(payload, PostmarkBatchPayload):
+            # each message in a batch gets the batch call's serialize and time_to_first_byte timings, and sizes
+            for batch_message in payload.messages:
+                super(PostmarkBackend, self).record_request(serialize_time, params, response, payload, batch_message)
+        else:
+            super(PostmarkBackend, self).record_request(serialize_time, params, response, payload, message)
+
+    def record_retry(self, delay, payload, message):
+        if isinstance(payload, PostmarkBatchPayload):
+            # a retried batch counts as a retry for each message in it
+            for batch_message in payload.messages:
+                super(PostmarkBackend, self).record_retry(delay, payload, batch_message)
+        else:
+            super(PostmarkBackend, self).record_retry(delay, payload, message)
+
     def raise_for_status(self, response, payload, message):
         # We need to handle 422 responses in parse_recipient_status
         if response.status_code != 422:
@@ -32,6 +190,37 @@ class PostmarkBackend(AnymailRequestsBackend):
 
     def parse_recipient_status(self, response, payload, message):
         parsed_response = self.deserialize_json_response(response, payload, message)
+        if payload.merge_data is None or not isinstance(parsed_response, list):
+            return self.parse_send_result(parsed_response, response, payload, message)
+
+        # batchWithTemplates returns a list of results, one for each "to" email
+        merge_recipients = payload.merge_batch_recipients()
+        if len(parsed_response) != len(merge_recipients):
+            raise AnymailRequestsAPIError("Invalid Postmark API response format",
+                                          email_message=message, payload=payload, response=response)
+        recipient_status = {}
+        errors = []
+        for recipients, parsed_result in zip(merge_recipients, parsed_response):
+            try:
+                recipient_status.update(
+                    self.parse_send_result(parsed_result, response, payload, message, recipients))
+            except AnymailRequestsAPIError as err:
+                errors.append(err)
+                recipient_status.update({
+                    recipient.email: AnymailRecipientStatus(message_id=None, status='failed')
+                    for recipient in recipients
+                })
+        if errors and len(errors) == len(merge_recipients):
+            raise errors[0]
+        return recipient_status
+
+    def parse_send_result(self, parsed_response, response, payload, message, recipients=None):
+        """Return recipient status for a single message's (deserialized) result from a Postmark send API
+
+        :param list[ParsedEmail] recipients: the recipients of this result; default all the payload's recipients
+        """
+        if recipients is None:
+            recipients = payload.all_recipients
         try:
             error_code = parsed_response["ErrorCode"]
             msg = parsed_response["Message"]
@@ -67,7 +256,7 @@ class PostmarkBackend(AnymailRequestsBackend):
                 status=('rejected' if recipient.email.lower() in rejected_emails
                         else default_status)
             )
-            for recipient in payload.all_recipients
+            for recipient in recipients
         }
 
     def parse_inactive_recipients(self, msg):
@@ -87,6 +276,37 @@ class PostmarkBackend(AnymailRequestsBackend):
             return []
 
 
+class PostmarkBatchPayload(object):
+    """Payload for Postmark's batch send API, combining several already-serialized PostmarkPayloads"""
+
+    def __init__(self, serialized_messages, server_token, messages=None):
+        self.serialized_messages = serialized_messages
+        self.server_token = server_token
+        self.messages = messages or []  # the original EmailMessages, in the same order
+
+    def get_request_params(self, api_url):
+        return dict(
+            method="POST",
+            url=urljoin(api_url, "email/batch"),
+            data=self.serialize_data(),
+            headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+                'X-Postmark-Server-Token': self.server_token,
+            },
+        )
+
+    def serialize_data(self):
+        # Same result as json.dumps(list of each message's data)
+        if any(isinstance(message, StreamingBody) for message in self.serialized_messages):
+            parts = ["["]
+            for message in self.serialized_messages:
+                parts += [message, ", "]
+            parts[-1] = "]"
+            return StreamingBody.from_parts(parts)
+        return "[" + ", ".join(self.serialized_messages) + "]"
+
+
 class PostmarkPayload(RequestsPayload):
 
     def __init__(self, message, defaults, backend, *args, **kwargs):
@@ -97,10 +317,14 @@ class PostmarkPayload(RequestsPayload):
         }
         self.server_token = backend.server_token  # added to headers later, so esp_extra can override
         self.all_recipients = []  # used for backend.parse_recipient_status
+        self.to_emails = []
+        self.merge_data = None  # late-bound per-recipient TemplateModel
         super(PostmarkPayload, self).__init__(message, defaults, backend, headers=headers, *args, **kwargs)
 
     def get_api_endpoint(self):
-        if 'TemplateId' in self.data or 'TemplateModel' in self.data:
+        if self.merge_data is not None:
+            return "email/batchWithTemplates"
+        elif 'TemplateId' in self.data or 'TemplateModel' in self.data:
             # This is the one Postmark API documented to have a trailing slash. (Typo?)
             return "email/withTemplate/"
         else:
@@ -112,8 +336,32 @@ class PostmarkPayload(RequestsPayload):
         return params
 
     def serialize_data(self):
+        if self.merge_data is not None:
+            return self.serialize_json({"Messages": self.expand_merge_data()})
         return self.serialize_json(self.data)
 
+    def expand_merge_data(self):
+        """Return a list of separate batchWithTemplates message data for each "to" email"""
+        global_model = self.data.get("TemplateModel", {})
+        messages = []
+        for to_email in self.to_emails:
+            data = self.data.copy()
+            data["To"] = to_email.address
+            if messages:
+                # cc and bcc get only one copy (of the first "to" message)
+                data.pop("Cc", None)
+                data.pop("Bcc", None)
+            data["TemplateModel"] = global_model.copy()
+            data["TemplateModel"].update(self.merge_data.get(to_email.email, {}))
+            messages.append(data)
+        return messages
+
+    def merge_batch_recipients(self):
+        """Return a list of the recipients of each message in expand_merge_data"""
+        cc_and_bcc = [email for email in self.all_recipients if email not in self.to_emails]
+        return [[to_email] + (cc_and_bcc if index == 0 else [])
+                for index, to_email in enumerate(self.to_emails)]
+
     #
     # Payload construction
     #
@@ -130,6 +378,8 @@ class PostmarkPayload(RequestsPayload):
             field = recipient_type.capitalize()
             self.data[field] = ', '.join([email.address for email in emails])
             self.all_recipients += emails  # used for backend.parse_recipient_status
+            if recipient_type == "to":
+                self.to_emails = emails  # used for expand_merge_data
 
     def set_subject(self, subject):
         self.data["Subject"] = subject
@@ -158,7 +408,7 @@ class PostmarkPayload(RequestsPayload):
         """Returns Postmark attachment dict for attachment"""
         att = {
             "Name": attachment.name or "",
-            "Content": attachment.b64content,
+            "Content": self.b64content(attachment),
             "ContentType": attachment.mimetype,
         }
         if attachment.inline:
@@ -192,7 +442,9 @@ class PostmarkPayload(RequestsPayload):
     def set_template_id(self, template_id):
         self.data["TemplateId"] = template_id
 
-    # merge_data: Postmark doesn't support per-recipient substitutions
+    def set_merge_data(self, merge_data):
+        # late-bind in self.serialize_data, which expands the message for each "to" email
+        self.merge_data = merge_data
 
     def set_merge_global_data(self, merge_global_data):
         self.data["TemplateModel"] = merge_global_data
@@ -0,0 +1,277 @@
+import random
+import threading
+import time
+
+import requests
+import six
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from ..exceptions import AnymailAPIError, AnymailConfigurationError, AnymailError
+from ..utils import ParsedEmail, UNSET, get_anymail_setting
+
+
+def is_failover_error(err):
+    """Return True if err means an ESP is unavailable (so another might succeed), rather than a problem with the message
+
+    That's connection errors and timeouts, and ESP API errors with HTTP 429 or 5xx status.
+    (Not socket.error: that's OSError on Python 3, which includes local problems like unreadable attachments.
+    And not other API errors, like 400 for an invalid from_email: another ESP would likely reject it, too.)
+    """
+    if isinstance(err, AnymailAPIError):  # (before requests errors: AnymailRequestsAPIError is also an HTTPError)
+        status_code = err.status_code
+        return status_code is not None and (status_code == 429 or status_code >= 500)
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker(object):
+    """Tracks consecutive failures for a backend, so a failing backend can be skipped.
+
+    After failure_threshold consecutive failures, the circuit "opens" and allow()
+    returns False for recovery_time seconds. Then a single trial call is allowed:
+    success closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, recovery_time=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.time()
+            if now - self.opened_at >= self.recovery_time:
+                self.opened_at = now  # allow this trial, but hold off others until it's done
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+
+class CircuitBreakerRegistry(object):
+    """Process-wide CircuitBreakers, shared by all RoutingBackend instances with the same backend name and settings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name, failure_threshold, recovery_time):
+        key = (name, failure_threshold, recovery_time)
+        with self._lock:
+            try:
+                return self._breakers[key]
+            except KeyError:
+                breaker = self._breakers[key] = CircuitBreaker(failure_threshold, recovery_time)
+                return breaker
+
+    def clear(self):
+        with self._lock:
+            self._breakers = {}
+
+
+circuit_breakers = CircuitBreakerRegistry()
+
+
+class RoutingBackend(BaseEmailBackend):
+    """
+    Anymail email backend that sends through one of several other email backends
+
+    Chooses a backend for each message by ROUTING_RULES or (otherwise) ROUTING_BACKENDS
+    weights, and fails over to the next backend if an ESP is unavailable.
+    """
+
+    def __init__(self, **kwargs):
+        super(RoutingBackend, self).__init__(fail_silently=kwargs.pop('fail_silently', False))
+        backends = get_anymail_setting('routing_backends', kwargs=kwargs)
+        self.rules = get_anymail_setting('routing_rules', kwargs=kwargs, default=[])
+        failure_threshold = get_anymail_setting('routing_failure_threshold', kwargs=kwargs, default=5)
+        recovery_time = get_anymail_setting('routing_recovery_time', kwargs=kwargs, default=30)
+
+        self.backends = []  # [(name, weight, connection), ...]
+        for config in backends:
+            if isinstance(config, six.string_types):
+                config = {'backend': config}
+            try:
+                backend = config['backend']
+            except KeyError:
+                raise AnymailConfigurationError("Each ANYMAIL ROUTING_BACKENDS item needs a 'backend'")
+            name = config.get('name', backend)
+            connection = get_connection(backend, fail_silently=False, **config.get('options', {}))
+            self.backends.append((name, config.get('weight', 1), connection))
+        if not self.backends:
+            raise AnymailConfigurationError("The ANYMAIL ROUTING_BACKENDS setting must list at least one backend")
+
+        names = [name for (name, _, _) in self.backends]
+        for rule in self.rules:
+            if not rule.get('backends'):
+                raise AnymailConfigurationError("Each ANYMAIL ROUTING_RULES item needs a non-empty 'backends' list")
+            for name in rule['backends']:
+                if name not in names:
+                    raise AnymailConfigurationError(
+                        "ANYMAIL ROUTING_RULES refers to unknown backend %r (choices are %s)"
+                        % (name, ", ".join(names)))
+        self.circuit_breakers = {name: circuit_breakers.get(name, failure_threshold, recovery_time)
+                                 for name in names}
+        self.is_open = False
+        self.opened_connections = []
+
+    def open(self):
+        # Backend connections are opened as they're needed (see _get_open_connection)
+        if self.is_open:
+            return False
+        self.is_open = True
+        return True
+
+    def close(self):
+        self.is_open = False
+        connections, self.opened_connections = self.opened_connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                if not self.fail_silently:
+                    raise
+
+    def _get_open_connection(self, connection):
+        if connection not in self.opened_connections:
+            if connection.open():
+                self.opened_connections.append(connection)
+        return connection
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        created_session = self.open()
+        try:
+            num_sent = 0
+            for message in email_messages:
+                try:
+                    if self._send(message):
+                        num_sent += 1
+                except (AnymailError, requests.RequestException):
+                    if not self.fail_silently:
+                        raise
+        finally:
+            if created_session:
+                self.close()
+        return num_sent
+
+    def _send(self, message):
+        """Send message through the first available backend (in routing order) that succeeds"""
+        routes = self.get_routes(message)
+        skipped = []  # backends with open circuits
+        last_error = None
+        for name, connection in routes:
+            if not self.circuit_breakers[name].allow():
+                skipped.append((name, connection))
+                continue
+            try:
+                return self._send_with(name, connection, message)
+            except Exception as err:
+                if not is_failover_error(err):
+                    raise
+                last_error = err
+        if last_error is None:
+            # Every circuit is open: better to try them anyway than to drop the message
+            for name, connection in skipped:
+                try:
+                    return self._send_with(name, connection, message)
+                except Exception as err:
+                    if not is_failover_error(err):
+                        raise
+                    last_error = err
+        if last_error is None:
+            raise AnymailError("No ROUTING_BACKENDS available to send the message", email_message=message)
+        raise last_error
+
+    def _send_with(self, name, connection, message):
+        breaker = self.circuit_breakers[name]
+        try:
+            sent = self._get_open_connection(connection).send_messages([message])
+        except Exception as err:
+            if is_failover_error(err):
+                breaker.record_failure()
+            raise
+        breaker.record_success()
+        return sent
+
+    def get_routes(self, message):
+        """Return a list of (name, connection) to try for message, in order"""
+        for rule in self.rules:
+            if self.rule_matches(rule, message):
+                routes = dict((name, connection) for (name, _, connection) in self.backends)
+                return [(name, routes[name]) for name in rule['backends']]
+
+        # Weighted random order (without replacement)
+        remaining = list(self.backends)
+        routes = []
+        while remaining:
+            total = sum(weight for (_, weight, _) in remaining)
+            choice = random.uniform(0, total)
+            for index, (name, weight, connection) in enumerate(remaining):
+                choice -= weight
+                if choice <= 0 or index == len(remaining) - 1:
+                    routes.append((name, connection))
+                    del remaining[index]
+                    break
+        return routes
+
+    @staticmethod
+    def rule_matches(rule, message):
+        """Return True if message meets all the conditions in rule"""
+        if 'tags' in rule:
+            tags = getattr(message, 'tags', UNSET)
+            if tags is UNSET or not set(rule['tags']) & set(tags or []):
+                return False
+        if 'from_domain' in rule:
+            from_domains = rule['from_domain']
+            if isinstance(from_domains, six.string_types):
+                from_domains = [from_domains]
+            from_email = ParsedEmail(message.from_email, message.encoding).email
+            domain = from_email.rpartition('@')[2].lower()
+            if domain not in [from_domain.lower() for from_domain in from_domains]:
+                return False
+        if 'min_size' in rule or 'max_size' in rule:
+            size = message_size(message)
+            if size < rule.get('min_size', 0) or size > rule.get('max_size', size):
+                return False
+        return True
+
+
+def message_size(message):
+    """Return the approximate size of message's content (body, alternatives, and attachments), in bytes"""
+    def content_size(content):
+        if content is None:
+            return 0
+        if getattr(content, 'anymail_path', None) is not None:  # AnymailFileAttachment (don't read the file)
+            return content.anymail_size
+        if hasattr(content, 'get_payload'):  # MIMEBase attachment
+            content = content.get_payload()
+            if isinstance(content, list):
+                return sum(content_size(part) for part in content)
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        return len(content)
+
+    size = content_size(message.body)
+    for alternative in getattr(message, 'alternatives', []):
+        size += content_size(alternative[0])
+    for attachment in message.attachments:
+        if isinstance(attachment, tuple):
+            size += content_size(attachment[1])
+        else:
+            size += content_size(attachment)
+    return size
@@ -43,6 +43,12 @@ class SendGridBackend(AnymailRequestsBackend):
             api_url += "/"
         super(SendGridBackend, self).__init__(api_url, **kwargs)
 
+    # SendGrid recommends no more than this many x-smtpapi "to" addresses per API call
+    max_batch_size = 1000
+
+    def get_rate_limit_credential(self, payload):
+        return self.api_key if self.api_key is not None else self.username
+
     def build_message_payload(self, message, defaults):
         return SendGridPayload(message, defaults, self)
 
@@ -259,7 +265,7 @@ class SendGridPayload(RequestsPayload):
                 "multiple attachments with the same filename ('%s')" % filename if filename
                 else "multiple unnamed attachments")
 
-        self.files[files_field] = (filename, attachment.content, attachment.mimetype)
+        self.files[files_field] = (filename, self.upload_content(attachment), attachment.mimetype)
 
     def set_metadata(self, metadata):
         self.smtpapi['unique_args'] = metadata
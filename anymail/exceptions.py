@@ -133,6 +133,18 @@ class AnymailWebhookValidationFailure(AnymailError, SuspiciousOperation):
     """
 
 
+class AnymailWebhookQueueFull(AnymailError):
+    """Exception when an asynchronous webhook dispatcher has too many events waiting.
+
+    The webhook view responds with an HTTP 503 error, so the ESP will retry later.
+    """
+
+
+class AnymailCancelSend(Exception):
+    """Exception a pre_send signal receiver can raise to cancel sending a message (without error)"""
+    # This deliberately doesn't inherit from AnymailError: it's not an error
+
+
 class AnymailConfigurationError(ImproperlyConfigured):
     """Exception for Anymail configuration or installation issues"""
     # This deliberately doesn't inherit from AnymailError,
@@ -0,0 +1,162 @@
+import json
+from decimal import Decimal
+
+from .exceptions import AnymailConfigurationError
+from .utils import InstanceRegistry, get_anymail_setting
+
+
+class JSONCodec(object):
+    """Encodes and decodes JSON with Python's json module.
+
+    dumps returns a str (faster codecs may leave non-ascii characters
+    unescaped, which is equivalent JSON); loads accepts str or utf-8 bytes.
+    """
+
+    name = "json"
+
+    def dumps(self, obj, default=None):
+        return json.dumps(obj, default=default)
+
+    def loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8')  # (json.loads doesn't accept bytes before Python 3.6)
+        return json.loads(s)
+
+
+class FastJSONCodec(JSONCodec):
+    """Base for codecs using a faster (but not quite identical) JSON library.
+
+    Anything the library handles differently from Python's json module
+    -- objects it can't serialize, invalid JSON, etc. -- is retried with
+    the json module, so results (and errors) are the same, just faster --
+    apart from the differences listed in each codec's docs. (That's why
+    these codecs are only used if chosen in the JSON_CODEC setting.)
+    """
+
+    def dumps(self, obj, default=None):
+        try:
+            return self._dumps(obj, default)
+        except (TypeError, ValueError, OverflowError):
+            return super(FastJSONCodec, self).dumps(obj, default)
+
+    def loads(self, s):
+        try:
+            return self._loads(s)
+        except (TypeError, ValueError, OverflowError):
+            return super(FastJSONCodec, self).loads(s)
+
+    def _dumps(self, obj, default):
+        raise NotImplementedError("%s.%s must implement _dumps" % (self.__class__.__module__, self.__class__.__name__))
+
+    def _loads(self, s):
+        raise NotImplementedError("%s.%s must implement _loads" % (self.__class__.__module__, self.__class__.__name__))
+
+
+class OrjsonCodec(FastJSONCodec):
+    """Uses orjson, sending the types json.dumps can't serialize to default.
+
+    orjson natively serializes some types json.dumps rejects. The passthrough
+    options send datetimes and dataclasses to default (which raises TypeError,
+    unless the caller's default handles them -- as with json.dumps), and
+    anything else orjson can't handle (like non-str dict keys or very large
+    ints) is retried with json. orjson does still serialize UUIDs and enums
+    (which json.dumps can't), and writes NaN and Infinity as null (which
+    json.dumps writes as invalid JSON).
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def _dumps(self, obj, default):
+        # (orjson.JSONEncodeError is a TypeError, so FastJSONCodec retries with json)
+        return self.orjson.dumps(obj, default=default or _not_serializable, option=self.options).decode('utf-8')
+
+    def _loads(self, s):
+        return self.orjson.loads(s)
+
+
+def _not_serializable(obj):
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+class UjsonCodec(FastJSONCodec):
+    """Uses ujson, retrying with json for anything ujson can't handle.
+
+    ujson serializes Decimals as numbers (which json.dumps can't serialize),
+    without calling default. So that doesn't depend on the ujson version
+    (or whether json is used instead), this codec always serializes Decimals
+    as (float) numbers. Older ujson versions write Infinity as Inf.
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+        try:
+            ujson.dumps(None, default=None)
+        except TypeError:
+            self.supports_default = False  # (older ujson)
+        else:
+            self.supports_default = True
+
+    def dumps(self, obj, default=None):
+        return super(UjsonCodec, self).dumps(obj, _decimals_as_floats(default))
+
+    def _dumps(self, obj, default):
+        if default is not None:
+            if not self.supports_default:
+                raise TypeError("ujson doesn't support default")  # (use json)
+            return self.ujson.dumps(obj, ensure_ascii=True, default=default)
+        return self.ujson.dumps(obj, ensure_ascii=True)
+
+    def _loads(self, s):
+        return self.ujson.loads(s)
+
+
+def _decimals_as_floats(default):
+    """Returns a json default function that serializes Decimals as floats, and passes anything else to default"""
+    def decimals_as_floats(obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if default is None:
+            raise TypeError("%r is not JSON serializable" % obj)
+        return default(obj)
+    return decimals_as_floats
+
+
+CODECS = [OrjsonCodec, UjsonCodec, JSONCodec]  # in "auto" preference order
+
+
+def _auto_codec():
+    """Returns an instance of the fastest codec whose library is installed"""
+    for codec_class in CODECS:
+        try:
+            return codec_class()
+        except ImportError:
+            pass
+
+
+_codecs = InstanceRegistry(
+    dict({codec_class.name: codec_class for codec_class in CODECS}, auto=_auto_codec),
+    "Unknown Anymail JSON_CODEC %r: use 'auto', 'orjson', 'ujson', or 'json'",
+    import_paths=False)
+
+
+def get_json_codec(name=None):
+    """Returns the JSONCodec for name, or for the JSON_CODEC setting if name is None
+
+    name can be "json" (the default), "orjson", "ujson", or "auto", which uses
+    the fastest library that's installed.
+    """
+    if name is None:
+        name = get_anymail_setting('json_codec', default="json")
+    try:
+        return _codecs.get(name)
+    except ImportError as err:
+        raise AnymailConfigurationError(
+            "Anymail JSON_CODEC %r requires the %s package: %s" % (name, name, err))
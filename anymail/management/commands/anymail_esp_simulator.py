@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+
+from ...simulator import SIMULATED_ESPS, ESPSimulator
+
+
+def add_simulator_arguments(parser):
+    """Adds the ESPSimulator options to a command's argument parser"""
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds the simulated ESP waits before each response")
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help="Maximum additional (random) seconds to wait before each response")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of sends (0.0-1.0) to fail with --error-status")
+    parser.add_argument('--error-status', type=int, default=500,
+                        help="HTTP status for simulated errors (default 500; use 503 to exercise retries)")
+    parser.add_argument('--throttle-every', type=int, default=None,
+                        help="After this many requests, answer the next --throttle-count requests with 429")
+    parser.add_argument('--throttle-count', type=int, default=1,
+                        help="Length of each burst of 429 (rate limited) responses")
+    parser.add_argument('--retry-after', type=int, default=0,
+                        help="Retry-After seconds in 429 responses")
+    parser.add_argument('--max-payload-size', type=int, default=None,
+                        help="Reject request bodies larger than this many bytes with a 413 "
+                             "(default is each ESP's documented limit)")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Random seed, for repeatable error and latency sequences")
+
+
+def get_simulator(options, **kwargs):
+    """Returns an ESPSimulator for the options added by add_simulator_arguments"""
+    return ESPSimulator(
+        latency=options['latency'], latency_jitter=options['latency_jitter'],
+        error_rate=options['error_rate'], error_status=options['error_status'],
+        throttle_every=options['throttle_every'], throttle_count=options['throttle_count'],
+        retry_after=options['retry_after'], max_payload_size=options['max_payload_size'],
+        seed=options['seed'], **kwargs)
+
+
+class Command(BaseCommand):
+    help = ("Run a local HTTP server that simulates the Mailgun, Mandrill, Postmark and SendGrid send APIs "
+            "(for load testing; see anymail_load_test).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default="127.0.0.1",
+                            help="Address to listen on (default 127.0.0.1)")
+        parser.add_argument('--port', type=int, default=8025,
+                            help="Port to listen on (default 8025)")
+        parser.add_argument('--log-requests', action='store_true',
+                            help="Log each request to stderr")
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        simulator = get_simulator(options, host=options['host'], port=options['port'],
+                                  verbose=options['log_requests'])
+        for esp_name in sorted(SIMULATED_ESPS):
+            self.stdout.write("Simulating %s at %s" % (esp_name, simulator.api_url(esp_name)))
+        try:
+            simulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,211 @@
+import json
+import os
+import sys
+import threading
+
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+# noinspection PyUnresolvedReferences
+from six.moves import queue
+
+from ...simulator import SIMULATED_ESPS
+from ...utils import monotonic
+from .anymail_esp_simulator import add_simulator_arguments, get_simulator
+
+try:
+    import resource
+except ImportError:  # (not available on Windows)
+    resource = None
+
+
+BACKENDS = {
+    # esp: (backend, connection kwargs)
+    "mailgun": ("anymail.backends.mailgun.MailgunBackend", {"api_key": "simulated"}),
+    "mandrill": ("anymail.backends.mandrill.MandrillBackend", {"api_key": "simulated"}),
+    "postmark": ("anymail.backends.postmark.PostmarkBackend", {"server_token": "simulated"}),
+    "sendgrid": ("anymail.backends.sendgrid.SendGridBackend", {"api_key": "simulated"}),
+}
+
+
+def get_rss():
+    """Returns the current resident set size of this process in bytes (or None if unknown)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process in bytes (or None if unknown)"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024  # (macOS reports bytes, Linux kilobytes)
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank pct percentile of sorted_values (or None if empty)"""
+    if not sorted_values:
+        return None
+    index = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class Command(BaseCommand):
+    help = ("Send test messages through an Anymail backend to a local ESP simulator, "
+            "and report throughput, latency and memory use.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--esp', choices=sorted(BACKENDS), default="postmark",
+                            help="Which ESP's backend to test (default postmark)")
+        parser.add_argument('--messages', type=int, default=1000,
+                            help="Total number of messages to send (default 1000)")
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Number of sending threads, each with its own connection (default 4)")
+        parser.add_argument('--batch-size', type=int, default=1,
+                            help="Messages per send_messages call (default 1)")
+        parser.add_argument('--recipients', type=int, default=1,
+                            help="'to' recipients per message (default 1)")
+        parser.add_argument('--body-size', type=int, default=1000,
+                            help="Bytes of text body per message (default 1000)")
+        parser.add_argument('--attachment-size', type=int, default=0,
+                            help="Bytes of attachment per message (default 0, no attachment)")
+        parser.add_argument('--send-retries', type=int, default=None,
+                            help="Override the backend's SEND_RETRIES setting (e.g., to retry simulated 429s)")
+        parser.add_argument('--simulator-url', default=None,
+                            help="Root url of an already running anymail_esp_simulator "
+                                 "(default is to run one in this process, using the simulator options below)")
+        parser.add_argument('--json', action='store_true',
+                            help="Output the results as JSON (e.g., to compare against a baseline in CI)")
+        add_simulator_arguments(parser)
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1 or options['concurrency'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--messages, --concurrency and --batch-size must be at least 1")
+        esp = options['esp']
+        simulator = None
+        if options['simulator_url']:
+            api_url = options['simulator_url'].rstrip('/') + SIMULATED_ESPS[esp].api_path
+        else:
+            simulator = get_simulator(options)
+            simulator.start()
+            api_url = simulator.api_url(esp)
+        try:
+            results = self.run_load_test(esp, api_url, options)
+        finally:
+            if simulator is not None:
+                simulator.stop()
+        if simulator is not None:
+            results['simulator_status_codes'] = {str(code): count
+                                                 for code, count in simulator.stats['status_codes'].items()}
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.write_report(results)
+
+    def build_message(self, n, options):
+        message = mail.EmailMessage(
+            subject="Load test message %d" % n,
+            body=("Load test body. " * (options['body_size'] // 16 + 1))[:options['body_size']],
+            from_email="Anymail Load Test <loadtest@simulator.anymail.test>",
+            to=["to%d.%d@simulator.anymail.test" % (n, i) for i in range(options['recipients'])])
+        if options['attachment_size'] > 0:
+            message.attach("attachment.bin", os.urandom(options['attachment_size']), "application/octet-stream")
+        return message
+
+    def run_load_test(self, esp, api_url, options):
+        backend, connection_kwargs = BACKENDS[esp]
+        connection_kwargs = dict(connection_kwargs, api_url=api_url)
+        if options['send_retries'] is not None:
+            connection_kwargs['send_retries'] = options['send_retries']
+        batches = queue.Queue()
+        batch_size = options['batch_size']
+        for start in range(0, options['messages'], batch_size):
+            batches.put([self.build_message(n, options)
+                         for n in range(start, min(start + batch_size, options['messages']))])
+
+        lock = threading.Lock()
+        latencies = []  # seconds for each send_messages call
+        counts = {'sent': 0, 'failed': 0, 'retries': 0}
+        errors = []
+
+        def worker():
+            connection = mail.get_connection(backend, fail_silently=True, **connection_kwargs)
+            connection.open()
+            try:
+                while True:
+                    try:
+                        batch = batches.get_nowait()
+                    except queue.Empty:
+                        return
+                    start = monotonic()
+                    sent = connection.send_messages(batch) or 0
+                    elapsed = monotonic() - start
+                    retries = sum(message.anymail_status.retries for message in batch
+                                  if message.anymail_status is not None)
+                    with lock:
+                        latencies.append(elapsed)
+                        counts['sent'] += sent
+                        counts['failed'] += len(batch) - sent
+                        counts['retries'] += retries
+            except Exception as err:  # (report unexpected errors, rather than losing them in the thread)
+                errors.append(err)
+            finally:
+                connection.close()
+
+        rss_start = get_rss()
+        start = monotonic()
+        threads = [threading.Thread(target=worker, name="anymail-load-test-%d" % i)
+                   for i in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = monotonic() - start
+        if errors:
+            raise CommandError("Error sending load test messages: %r" % errors[0])
+
+        latencies.sort()
+        return {
+            'esp': esp,
+            'messages': options['messages'],
+            'concurrency': options['concurrency'],
+            'batch_size': batch_size,
+            'sent': counts['sent'],
+            'failed': counts['failed'],
+            'retries': counts['retries'],
+            'elapsed': elapsed,
+            'messages_per_second': counts['sent'] / elapsed if elapsed > 0 else None,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'rss_start': rss_start,
+            'rss_end': get_rss(),
+            'rss_peak': get_peak_rss(),
+        }
+
+    def write_report(self, results):
+        def ms(seconds):
+            return "-" if seconds is None else "%.1fms" % (seconds * 1000)
+
+        def mb(size):
+            return "-" if size is None else "%.1fMB" % (size / (1024.0 * 1024.0))
+
+        self.stdout.write("{esp}: {messages} messages, concurrency {concurrency}, batch size {batch_size}".format(
+            **results))
+        self.stdout.write("Sent {sent}, failed {failed}, retries {retries} in {elapsed:.2f}s".format(**results))
+        if results['messages_per_second'] is not None:
+            self.stdout.write("Throughput: %.1f messages/sec" % results['messages_per_second'])
+        latency = results['latency']
+        self.stdout.write("Latency per send_messages call: p50 %s, p90 %s, p99 %s, max %s" % (
+            ms(latency['p50']), ms(latency['p90']), ms(latency['p99']), ms(latency['max'])))
+        self.stdout.write("RSS: start %s, end %s, peak %s" % (
+            mb(results['rss_start']), mb(results['rss_end']), mb(results['rss_peak'])))
+        if 'simulator_status_codes' in results:
+            self.stdout.write("Simulator responses: %s" % ", ".join(
+                "%s: %d" % (code, count) for code, count in sorted(results['simulator_status_codes'].items())))
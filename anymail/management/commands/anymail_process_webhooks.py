@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...webhook_dispatch import get_webhook_dispatcher
+
+
+class Command(BaseCommand):
+    help = "Dispatch webhook events queued by Anymail's spool or cache WEBHOOK_DISPATCH."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Dispatch the events that are waiting now, then exit "
+                                 "(default is to keep running, polling for new events)")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Maximum number of webhook calls to dispatch at a time")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait between checks of an empty queue")
+        parser.add_argument('--purge-after', type=float, default=24 * 3600,
+                            help="Delete dispatched and failed spool items this many seconds old (default 1 day)")
+
+    def handle(self, *args, **options):
+        dispatcher = get_webhook_dispatcher()
+        if not hasattr(dispatcher, 'process_pending'):
+            raise CommandError("The ANYMAIL WEBHOOK_DISPATCH setting must be 'spool' or 'cache' "
+                               "(or another dispatcher that queues events) to use this command")
+        last_purge = 0
+        try:
+            while True:
+                if hasattr(dispatcher, 'purge') and time.time() - last_purge > 3600:
+                    dispatcher.purge(options['purge_after'])
+                    last_purge = time.time()
+
+                counts = dispatcher.process_pending(limit=options['batch_size'])
+                if any(counts.values()):
+                    self.stdout.write("Dispatched {dispatched}, retrying {retrying}, failed {failed}".format(**counts))
+                if options['once']:
+                    if sum(counts.values()) < options['batch_size']:
+                        break  # nothing more waiting
+                else:
+                    if sum(counts.values()) == 0:
+                        time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
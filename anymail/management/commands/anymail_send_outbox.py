@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import Outbox
+
+
+class Command(BaseCommand):
+    help = "Send email messages queued in the Anymail outbox (by the OutboxBackend)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Send the messages that are ready now, then exit "
+                                 "(default is to keep running, polling for new messages)")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Maximum number of messages to claim from the outbox at a time")
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Number of messages to send in parallel")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait between checks of an empty outbox")
+        parser.add_argument('--purge-after', type=float, default=7 * 24 * 3600,
+                            help="Delete sent and failed messages this many seconds old (default 7 days)")
+
+    def handle(self, *args, **options):
+        outbox = Outbox()
+        last_purge = 0
+        try:
+            while True:
+                if time.time() - last_purge > 3600:
+                    outbox.spool.purge(options['purge_after'])
+                    last_purge = time.time()
+
+                counts = outbox.send_pending(limit=options['batch_size'], concurrency=options['concurrency'])
+                if any(counts.values()):
+                    self.stdout.write("Sent {sent}, retrying {retrying}, failed {failed}".format(**counts))
+                if options['once']:
+                    if sum(counts.values()) < options['batch_size']:
+                        break  # outbox has nothing more ready
+                else:
+                    if sum(counts.values()) == 0:
+                        time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
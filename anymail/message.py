@@ -1,8 +1,12 @@
+from base64 import b64encode
+from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 from email.utils import unquote
+import mimetypes
 import os
 
 from django.core.mail import EmailMessage, EmailMultiAlternatives, make_msgid
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
 
 from .utils import UNSET
 
@@ -48,18 +52,165 @@ class AnymailMessage(AnymailMessageMixin, EmailMultiAlternatives):
     pass
 
 
+class AnymailInlineImage(MIMEImage, object):  # (object makes py2's classic MIMEImage new-style, for property)
+    """A MIMEImage that keeps its original (unencoded) content.
+
+    Anymail backends use anymail_content (or anymail_b64content, which is
+    computed once and cached) directly, rather than decoding and re-encoding
+    the MIME payload. The MIME payload (wrapped base64 lines) is only generated
+    if something needs it -- e.g., sending the message through Django's SMTP backend.
+    """
+
+    def __init__(self, content, subtype=None, **params):
+        self.anymail_content = content
+        self._anymail_b64content = None
+        self._anymail_mime_payload = None
+        self._anymail_initializing = True  # MIMEImage.__init__ sets (and encodes) the raw payload
+        MIMEImage.__init__(self, content, subtype, _encoder=_defer_base64_encoding, **params)
+        self._anymail_initializing = False
+
+    @property
+    def anymail_b64content(self):
+        """The original content, base64 encoded as a single ascii str"""
+        if self._anymail_b64content is None:
+            self._anymail_b64content = b64encode(self.anymail_content).decode('ascii')
+        return self._anymail_b64content
+
+    def _get_mime_payload(self):
+        if self._anymail_mime_payload is None and self.anymail_content is not None:
+            b64content = self.anymail_b64content
+            self._anymail_mime_payload = "".join(
+                b64content[start:start + 76] + "\n" for start in range(0, len(b64content), 76))
+        return self._anymail_mime_payload
+
+    def _set_mime_payload(self, payload):
+        if self._anymail_initializing:
+            return  # the payload will be lazily generated from anymail_content
+        if payload is not None:
+            # the payload has been replaced: anymail_content is no longer valid
+            self.anymail_content = None
+            self._anymail_b64content = None
+        self._anymail_mime_payload = payload
+
+    # email.message.Message keeps its payload in _payload
+    _payload = property(_get_mime_payload, _set_mime_payload)
+
+
+def _defer_base64_encoding(image):
+    image['Content-Transfer-Encoding'] = 'base64'
+
+
+class AnymailFileAttachment(MIMEBase, object):  # (object makes py2's classic MIMEBase new-style, for property)
+    """An attachment whose content is read from a file only when it's needed.
+
+    path is a filesystem path, or (if storage is given) the name of a file
+    in that Django Storage. Anymail backends read the file while sending
+    the message -- in chunks, if the request is streamed -- so the content
+    isn't held in memory with the message (or pickled with it, e.g., in an
+    outbox). The MIME payload is generated from the file whenever something
+    needs it -- e.g., sending the message through Django's SMTP backend.
+
+    >>> message.attach(AnymailFileAttachment("reports/2016.pdf", storage=default_storage))
+    """
+
+    def __init__(self, path, filename=None, mimetype=None, storage=None):
+        self.anymail_path = path
+        self.anymail_storage = storage
+        self._anymail_mime_payload = None
+        if filename is None:
+            filename = os.path.basename(path)
+        if mimetype is None:
+            mimetype, _ = mimetypes.guess_type(filename)
+            if mimetype is None:
+                mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
+        maintype, subtype = mimetype.split('/', 1)
+        MIMEBase.__init__(self, maintype, subtype)
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.add_header('Content-Disposition', 'attachment', filename=filename)
+
+    def anymail_open(self):
+        """Return the file, opened for reading bytes (the caller must close it)"""
+        if self.anymail_storage is not None:
+            return self.anymail_storage.open(self.anymail_path, 'rb')
+        return open(self.anymail_path, 'rb')
+
+    @property
+    def anymail_size(self):
+        """The size of the file's content, in bytes"""
+        if self.anymail_storage is not None:
+            return self.anymail_storage.size(self.anymail_path)
+        return os.path.getsize(self.anymail_path)
+
+    def _get_mime_payload(self):
+        if self.anymail_path is None:
+            return self._anymail_mime_payload
+        # (not cached: the file may be large, and this is rarely needed more than once)
+        with self.anymail_open() as f:
+            b64content = b64encode(f.read()).decode('ascii')
+        return "".join(b64content[start:start + 76] + "\n" for start in range(0, len(b64content), 76))
+
+    def _set_mime_payload(self, payload):
+        if payload is not None:
+            # the payload has been replaced: the file is no longer the content
+            self.anymail_path = None
+            self.anymail_storage = None
+        self._anymail_mime_payload = payload
+
+    # email.message.Message keeps its payload in _payload
+    _payload = property(_get_mime_payload, _set_mime_payload)
+
+
 def attach_inline_image_file(message, path, subtype=None, idstring="img", domain=None):
-    """Add inline image from file path to an EmailMessage, and return its content id"""
+    """Add inline image from file path to an EmailMessage, and return its content id
+
+    The file is read when the message is sent (not now).
+    """
     filename = os.path.basename(path)
+    if subtype is None:
+        subtype = _image_subtype(path)
+        if subtype is None:
+            mimetype, _ = mimetypes.guess_type(filename)
+            if mimetype is None or not mimetype.startswith('image/'):
+                raise TypeError("Could not guess image MIME subtype")
+            subtype = mimetype.split('/', 1)[1]
+    content_id = make_msgid(idstring, domain)  # Content ID per RFC 2045 section 7 (with <...>)
+    image = AnymailFileAttachment(path, filename, "image/%s" % subtype)
+    del image['Content-Disposition']
+    image.add_header('Content-Disposition', 'inline', filename=filename)
+    image.add_header('Content-ID', content_id)
+    message.attach(image)
+    return unquote(content_id)  # Without <...>, for use as the <img> tag src
+
+
+# (signature, MIME image subtype) for common image formats
+# (imghdr is deprecated and was removed in Python 3.13)
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+]
+
+
+def _image_subtype(path):
+    """Return the MIME image subtype of the file at path, from its first bytes, or None if unknown"""
     with open(path, 'rb') as f:
-        content = f.read()
-    return attach_inline_image(message, content, filename, subtype, idstring, domain)
+        header = f.read(12)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    for signature, subtype in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return subtype
+    return None
 
 
 def attach_inline_image(message, content, filename=None, subtype=None, idstring="img", domain=None):
     """Add inline image to an EmailMessage, and return its content id"""
     content_id = make_msgid(idstring, domain)  # Content ID per RFC 2045 section 7 (with <...>)
-    image = MIMEImage(content, subtype)
+    image = AnymailInlineImage(content, subtype)
     image.add_header('Content-Disposition', 'inline', filename=filename)
     image.add_header('Content-ID', content_id)
     message.attach(image)
@@ -92,6 +243,30 @@ class AnymailStatus(object):
         self.status = None  # set of ANYMAIL_STATUSES across all recipients, or None for not yet sent to ESP
         self.recipients = {}  # per-recipient: { email: AnymailRecipientStatus, ... }
         self.esp_response = None
+        self.retries = 0  # number of times the send API call was retried
+        self.retry_delay = 0  # total seconds spent waiting between retries
+        self.timings = {}  # seconds spent in each phase of sending: { phase: seconds, ... }
+        self.request_size = None  # bytes in the send API request body(s), if known
+        self.response_size = None  # bytes in the send API response body(s), if known
+
+    def add_timing(self, phase, seconds):
+        """Add seconds to phase's timing (a message sent in several API calls adds each call's time)"""
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def add_sizes(self, request_size=None, response_size=None):
+        """Add the sizes of an API call's request and response bodies (None if unknown)"""
+        if request_size is not None:
+            self.request_size = (self.request_size or 0) + request_size
+        if response_size is not None:
+            self.response_size = (self.response_size or 0) + response_size
+
+    def add_call_stats(self, other):
+        """Add other AnymailStatus's retries, timings and sizes (for a separate API call sending this message)"""
+        self.retries += other.retries
+        self.retry_delay += other.retry_delay
+        for phase, seconds in other.timings.items():
+            self.add_timing(phase, seconds)
+        self.add_sizes(other.request_size, other.response_size)
 
     def set_recipient_status(self, recipients):
         self.recipients.update(recipients)
@@ -0,0 +1,237 @@
+import threading
+from bisect import bisect_left
+
+import six
+from django.utils.module_loading import import_string
+
+from .exceptions import AnymailConfigurationError, AnymailRecipientsRefused
+
+
+# Histogram bucket upper bounds (in seconds) for Anymail's latency metrics
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra is not None else [])
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, six.text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """A thread-safe, in-process count for each combination of label values"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}  # (label values): count
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, label_values=()):
+        return self._values.get(label_values, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """Yields the (name, label str, value) for each exposition line"""
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, count in values:
+            yield self.name, _format_labels(self.labels, label_values), count
+
+
+class Histogram(Counter):
+    """A thread-safe, in-process distribution of observations in fixed buckets, for each combination of label values
+
+    (Each observation is just a bisect and a few increments, so these are cheap to update.)
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, label_values=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts = self._values[label_values]
+            except KeyError:
+                # (bucket counts, then +Inf bucket, then sum)
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def get(self, label_values=()):
+        """Returns the (count, sum) of observations"""
+        counts = self._values.get(label_values)
+        return (sum(counts[:-1]), counts[-1]) if counts else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else _format_value(bound)
+                yield self.name + "_bucket", _format_labels(self.labels, label_values, ("le", le)), cumulative
+            labels = _format_labels(self.labels, label_values)
+            yield self.name + "_sum", labels, counts[-1]
+            yield self.name + "_count", labels, cumulative
+
+
+class MetricsRegistry(object):
+    """A collection of Counters and Histograms, which can be exported in Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def exposition(self):
+        """Returns the metrics as a str in Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()  # Anymail's metrics for this process
+
+send_total = registry.counter(
+    "anymail_send_total", "Messages Anymail tried to send, by ESP, outcome and ESP API HTTP status",
+    labels=("esp", "outcome", "status_code"))
+send_duration = registry.histogram(
+    "anymail_send_duration_seconds", "Time to send a message to the ESP (including retries)",
+    labels=("esp",))
+webhook_events_total = registry.counter(
+    "anymail_webhook_events_total", "Webhook events received, by ESP and normalized event type",
+    labels=("esp", "event_type"))
+webhook_parse_duration = registry.histogram(
+    "anymail_webhook_parse_duration_seconds", "Time to parse the events in a webhook call",
+    labels=("esp",))
+webhook_dispatch_duration = registry.histogram(
+    "anymail_webhook_dispatch_duration_seconds", "Time to run signal receivers for the events in a webhook call",
+    labels=("esp",))
+
+
+def get_send_status_code(status, error=None):
+    """Returns the ESP API HTTP status for a send with AnymailStatus status (which raised error if not None), or None"""
+    response = getattr(error, 'response', None)
+    if response is None and status is not None:
+        response = status.esp_response
+    if isinstance(response, list):
+        response = response[0] if response else None  # (chunked batch send)
+    status_code = getattr(response, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(error, 'status_code', None)
+    return status_code
+
+
+def record_send(esp_name, message, error=None):
+    """Updates the send metrics for message (after a send attempt, which raised AnymailError error if not None)"""
+    status = getattr(message, 'anymail_status', None)
+    if error is not None:
+        outcome = "rejected" if isinstance(error, AnymailRecipientsRefused) else "error"
+    elif status is None or status.status is None:
+        outcome = "not_sent"  # (no recipients, or cancelled by pre_send)
+    elif status.status.issubset({"invalid", "rejected"}):
+        outcome = "rejected"  # (with ignore_recipient_status)
+    else:
+        outcome = "sent"
+
+    status_code = get_send_status_code(status, error)
+    send_total.inc((esp_name, outcome, "" if status_code is None else str(status_code)))
+    if status is not None and 'total' in status.timings:
+        send_duration.observe(status.timings['total'], (esp_name,))
+
+
+def record_webhook(esp_name, event_counts, parse_time, dispatch_time):
+    """Updates the webhook metrics for a webhook call with event_counts {event_type: count}"""
+    for event_type, count in event_counts.items():
+        webhook_events_total.inc((esp_name, event_type), count)
+    webhook_parse_duration.observe(parse_time, (esp_name,))
+    webhook_dispatch_duration.observe(dispatch_time, (esp_name,))
+
+
+class StatsdMetricsSink(object):
+    """Reports each send's AnymailStatus to a statsd-style client (anything with timing and incr methods)
+
+    Sends (with prefix "anymail" and, e.g., esp_name "SendGrid"):
+    - anymail.sendgrid.sent: count of messages sent to the ESP
+    - anymail.sendgrid.error, anymail.sendgrid.error.<status_code>: count of failed sends
+      (and of those with an ESP API HTTP status)
+    - anymail.sendgrid.<phase>: timing (in milliseconds) of each of status.timings
+    - anymail.sendgrid.request_bytes, anymail.sendgrid.response_bytes: count of bytes
+    """
+
+    def __init__(self, client, prefix="anymail"):
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, esp_name, status, error=None, status_code=None, **kwargs):
+        prefix = "%s.%s" % (self.prefix, esp_name.lower())
+        if error is None:
+            self.client.incr(prefix + ".sent")
+        else:
+            self.client.incr(prefix + ".error")
+            if status_code is not None:
+                self.client.incr("%s.error.%s" % (prefix, status_code))
+        for phase, seconds in status.timings.items():
+            self.client.timing("%s.%s" % (prefix, phase), seconds * 1000)
+        if status.request_size is not None:
+            self.client.incr(prefix + ".request_bytes", status.request_size)
+        if status.response_size is not None:
+            self.client.incr(prefix + ".response_bytes", status.response_size)
+
+
+def get_metrics_sink(sink):
+    """Returns a callable sink(esp_name, status, error, status_code) for the METRICS_SINK setting, or None
+
+    sink can be a callable, a statsd-style client object, or the import path of either.
+    """
+    if not sink:
+        return None
+    if isinstance(sink, six.string_types):
+        try:
+            sink = import_string(sink)
+        except ImportError as err:
+            raise AnymailConfigurationError("Couldn't import Anymail METRICS_SINK %r: %s" % (sink, err))
+    if hasattr(sink, 'timing') and hasattr(sink, 'incr'):
+        return StatsdMetricsSink(sink)
+    if not callable(sink):
+        raise AnymailConfigurationError(
+            "Anymail METRICS_SINK must be a callable or a statsd-style client (not %r)" % sink)
+    return sink
@@ -0,0 +1,141 @@
+import logging
+import pickle
+from copy import copy
+from multiprocessing.pool import ThreadPool
+
+from django.core.mail import get_connection
+
+from .backends.routing import is_failover_error
+from .exceptions import AnymailError
+from .spool import SQLiteSpool
+from .utils import get_anymail_setting
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """A durable queue of EmailMessages waiting to be sent through a real email backend.
+
+    Messages are stored (pickled) in a SQLite database file, so they survive
+    process restarts, and can be sent by any process with access to the file.
+    """
+
+    def __init__(self, path=None, backend=None, max_attempts=None, retry_backoff=None, **kwargs):
+        if path is None:
+            path = get_anymail_setting('outbox_path', kwargs=kwargs)
+        if backend is None:
+            backend = get_anymail_setting('outbox_backend', kwargs=kwargs)
+        if max_attempts is None:
+            max_attempts = get_anymail_setting('outbox_max_attempts', kwargs=kwargs, default=5)
+        if retry_backoff is None:
+            retry_backoff = get_anymail_setting('outbox_retry_backoff', kwargs=kwargs, default=30)
+        self.spool = SQLiteSpool(path, table='anymail_outbox')
+        self.backend = backend  # import path of the email backend that really sends the messages
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff  # seconds before first retry (doubled for each later retry)
+        self.max_retry_delay = 3600
+
+    def put(self, email_messages):
+        """Add EmailMessages to the outbox, and return a list of their outbox ids"""
+        pickled = []
+        for message in email_messages:
+            message = copy(message)
+            message.connection = None  # (can't be pickled, and the outbox will use its own)
+            message.anymail_status = None
+            pickled.append(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        return self.spool.put(pickled)
+
+    def get_status(self, outbox_id):
+        """Return a dict describing the outbox message's state, or None if it's not in the outbox
+
+        After the message has been sent, dict['result'] has its message_id, status and recipients.
+        """
+        return self.spool.get(outbox_id)
+
+    def send_pending(self, limit=100, concurrency=1, lease_seconds=300):
+        """Send up to limit messages that are waiting in the outbox.
+
+        Returns a dict with the number of messages 'sent', 'retrying', and 'failed'.
+
+        With concurrency > 1, messages are sent in parallel over a single
+        connection, which must be safe to share between threads (all Anymail
+        backends are).
+
+        Delivery is at-least-once: a message still being sent when its lease_seconds
+        run out can be claimed (and sent again) by another worker.
+        """
+        items = self.spool.claim(limit, lease_seconds=lease_seconds)
+        counts = {'sent': 0, 'retrying': 0, 'failed': 0}
+        if not items:
+            return counts
+
+        connection = get_connection(self.backend, fail_silently=False)
+        connection.open()
+        try:
+            if concurrency > 1 and len(items) > 1:
+                pool = ThreadPool(min(concurrency, len(items)))
+                try:
+                    results = pool.map(lambda item: self._send_item(item, connection), items)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [self._send_item(item, connection) for item in items]
+        finally:
+            connection.close()
+
+        for result in results:
+            counts[result] += 1
+        return counts
+
+    def _send_item(self, item, connection):
+        try:
+            message = pickle.loads(item.data)
+        except Exception as err:
+            logger.exception("Anymail outbox message %s could not be loaded", item.id)
+            self.spool.fail(item, error=repr(err))
+            return 'failed'
+
+        message.connection = connection
+        try:
+            connection.send_messages([message])
+        except Exception as err:
+            if is_failover_error(err):
+                # The ESP is unavailable (which might work later)
+                return self._retry_or_fail(item, message, err)
+            # Problems with the message itself, or the ESP rejected it (which will happen again)
+            if not isinstance(err, AnymailError):
+                logger.exception("Error sending Anymail outbox message %s", item.id)
+            self.spool.fail(item, error=str(err), result=self.status_result(message))
+            return 'failed'
+
+        if not self.spool.complete(item, result=self.status_result(message)):
+            logger.warning("Anymail outbox message %s was sent after its lease expired "
+                           "(another worker may also have sent it)", item.id)
+        return 'sent'
+
+    def _retry_or_fail(self, item, message, err):
+        attempts = item.attempts + 1
+        if attempts >= self.max_attempts:
+            self.spool.fail(item, error=str(err), result=self.status_result(message))
+            return 'failed'
+        delay = min(self.retry_backoff * 2 ** (attempts - 1), self.max_retry_delay)
+        self.spool.retry(item, delay, error=str(err))
+        return 'retrying'
+
+    @staticmethod
+    def status_result(message):
+        """Return message.anymail_status in a json-serializable form (or None if there isn't one)"""
+        status = getattr(message, 'anymail_status', None)
+        if status is None:
+            return None
+
+        def jsonable(value):
+            return sorted(value) if isinstance(value, set) else value
+
+        return {
+            'message_id': jsonable(status.message_id),
+            'status': jsonable(status.status),
+            'recipients': {email: {'message_id': recipient.message_id, 'status': recipient.status}
+                           for email, recipient in status.recipients.items()},
+        }
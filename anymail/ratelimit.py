@@ -0,0 +1,120 @@
+import math
+import threading
+import time
+
+import six
+from django.core.cache import caches
+
+from .exceptions import AnymailConfigurationError
+
+
+RATE_UNITS = {
+    's': 1, 'sec': 1, 'second': 1,
+    'm': 60, 'min': 60, 'minute': 60,
+    'h': 3600, 'hr': 3600, 'hour': 3600,
+}
+
+
+def parse_rate(rate):
+    """Returns rate as a number of requests per second.
+
+    rate can be a number (requests per second), or a str like "20/s", "600/m" or "10000/h".
+
+    >>> parse_rate("600/m")
+    10.0
+    """
+    if isinstance(rate, six.string_types):
+        try:
+            count, unit = rate.split('/', 1)
+            rate = float(count) / RATE_UNITS[unit.strip().lower()]
+        except (KeyError, ValueError):
+            raise AnymailConfigurationError(
+                "Invalid Anymail rate limit %r: use a number of requests per second, "
+                "or a string like '20/s', '600/m', or '10000/h'" % rate)
+    if rate <= 0:
+        raise AnymailConfigurationError("Anymail rate limit must be positive (not %r)" % rate)
+    return float(rate)
+
+
+class LocalRateLimiter(object):
+    """A thread-safe token bucket rate limiter, for a single process.
+
+    Each key has a bucket that holds up to burst tokens, refilled at rate
+    tokens per second. (Implemented as the equivalent "generic cell rate
+    algorithm," which just tracks when each bucket would next be full.)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._full_at = {}  # key: time when bucket would be full again
+
+    def acquire(self, key, rate, burst):
+        """Takes a token from key's bucket, and returns the seconds to wait before using it"""
+        interval = 1.0 / rate
+        with self._lock:
+            now = time.time()
+            full_at = max(self._full_at.get(key, now), now) + interval
+            self._full_at[key] = full_at
+        return max(0.0, full_at - now - burst * interval)
+
+    def clear(self):
+        with self._lock:
+            self._full_at = {}
+
+
+class CacheRateLimiter(object):
+    """A rate limiter that shares its budget through a Django cache.
+
+    All processes using the same cache (e.g., memcached or redis) share one
+    budget per key. Allows burst requests in each burst/rate-second window,
+    using the cache's atomic add and incr. A request that doesn't fit in the
+    current window reserves a place in a later one: the cache also tracks
+    the first window that may still have room, so requests go straight there
+    (rather than trying each full window in turn).
+    """
+
+    key_prefix = "anymail:ratelimit"
+
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def acquire(self, key, rate, burst):
+        """Takes a place in a window for key, and returns the seconds to wait before that window starts"""
+        cache = self.cache
+        window_length = float(burst) / rate
+        now = time.time()
+        current_window = int(now // window_length)
+        next_key = "%s:%s:next" % (self.key_prefix, key)
+        window = max(current_window, cache.get(next_key, current_window))
+        while True:
+            cache_key = "%s:%s:%d" % (self.key_prefix, key, window)
+            timeout = int(math.ceil((window - current_window + 2) * window_length))
+            cache.add(cache_key, 0, timeout)
+            try:
+                count = cache.incr(cache_key)
+            except ValueError:
+                continue  # expired between add and incr; try again
+            if count == burst:
+                # (only the request that fills the window moves next_key on)
+                cache.set(next_key, window + 1, timeout + int(math.ceil(window_length)))
+            if count <= burst:
+                return max(0.0, window * window_length - now)
+            window = max(window + 1, cache.get(next_key, 0))
+
+
+local_rate_limiter = LocalRateLimiter()  # shared by all backends in the process
+
+
+def get_rate_limiter(name, cache_alias='default'):
+    """Returns the rate limiter for the RATE_LIMITER setting ("local" or "cache")"""
+    if name == "local":
+        return local_rate_limiter
+    elif name == "cache":
+        return CacheRateLimiter(cache_alias)
+    else:
+        raise AnymailConfigurationError(
+            "Unknown Anymail RATE_LIMITER %r: use 'local' or 'cache'" % name)
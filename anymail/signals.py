@@ -1,9 +1,18 @@
 from django.dispatch import Signal
 
 
+# Sending a message: pre_send receivers can modify the message, or raise AnymailCancelSend
+pre_send = Signal(providing_args=['message', 'esp_name'])
+
+# After sending a message to the ESP (before any error for rejected recipients is raised)
+post_send = Signal(providing_args=['message', 'status', 'esp_name', 'payload', 'response', 'timings'])
+
 # Delivery and tracking events for sent messages
 tracking = Signal(providing_args=['event', 'esp_name'])
 
+# All the delivery and tracking events from a single webhook call (as a list)
+tracking_batch = Signal(providing_args=['events', 'esp_name'])
+
 # Event for receiving inbound messages
 inbound = Signal(providing_args=['event', 'esp_name'])
 
@@ -0,0 +1,348 @@
+"""A local HTTP server that simulates ESP send APIs, for load testing Anymail's backends
+
+Usage::
+
+    simulator = ESPSimulator(latency=0.05, error_rate=0.01)
+    simulator.start()  # (serves in a background thread)
+    connection = get_connection("anymail.backends.postmark.PostmarkBackend",
+                                server_token="simulated", api_url=simulator.api_url("postmark"))
+    ...
+    simulator.stop()
+
+See the anymail_esp_simulator and anymail_load_test management commands.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+# noinspection PyUnresolvedReferences
+from six.moves import BaseHTTPServer, socketserver
+
+
+class SimulatedESP(object):
+    """Base for an ESP's simulated send API (subclasses implement the ESP's endpoints and response formats)"""
+
+    name = None  # used in the simulator's urls
+    api_path = None  # path to the simulated API, relative to the simulator's root url
+    endpoints = ()  # regexes for the send endpoints, relative to api_path
+    is_json = True  # whether the send endpoints require a JSON request body
+    max_payload_size = 20 * 1024 * 1024  # largest request body the ESP allows (bytes)
+
+    def get_max_payload_size(self, endpoint):
+        """Returns the largest request body (in bytes) the ESP allows for endpoint"""
+        return self.max_payload_size
+
+    def send_response(self, endpoint, data):
+        """Returns the (status_code, response data) for a successful send to endpoint
+
+        data is the parsed JSON request body if is_json, else None.
+        """
+        raise NotImplementedError()
+
+    def error_response(self, status_code, message):
+        """Returns the response data for an error"""
+        return {"message": message}
+
+    @staticmethod
+    def new_message_id():
+        return str(uuid.uuid4())
+
+
+class SimulatedMailgun(SimulatedESP):
+    name = "mailgun"
+    api_path = "/mailgun/v3/"
+    endpoints = (r'^[^/]+/messages$',)
+    is_json = False
+    max_payload_size = 25 * 1024 * 1024
+
+    def send_response(self, endpoint, data):
+        # (Mailgun's only success response; the one id covers all recipients)
+        return 200, {"id": "<%s@simulator.anymail.test>" % self.new_message_id(),
+                     "message": "Queued. Thank you."}
+
+
+class SimulatedMandrill(SimulatedESP):
+    name = "mandrill"
+    api_path = "/mandrill/api/1.0/"
+    endpoints = (r'^messages/send\.json$', r'^messages/send-template\.json$')
+    max_payload_size = 25 * 1024 * 1024
+
+    def send_response(self, endpoint, data):
+        try:
+            recipients = [to["email"] for to in data["message"]["to"]]
+        except (KeyError, TypeError):
+            return 500, self.error_response(500, "Validation error: message.to is required")
+        return 200, [{"email": email, "status": "sent", "_id": self.new_message_id(), "reject_reason": None}
+                     for email in recipients]
+
+    def error_response(self, status_code, message):
+        return {"status": "error", "code": -1, "name": "GeneralError", "message": message}
+
+
+class SimulatedPostmark(SimulatedESP):
+    name = "postmark"
+    api_path = "/postmark/"
+    endpoints = (r'^email$', r'^email/withTemplate/?$', r'^email/batch$', r'^email/batchWithTemplates$')
+    max_payload_size = 10 * 1024 * 1024  # (for a single message)
+    max_batch_payload_size = 50 * 1024 * 1024
+
+    def get_max_payload_size(self, endpoint):
+        if endpoint in ("email/batch", "email/batchWithTemplates"):
+            return self.max_batch_payload_size
+        return self.max_payload_size
+
+    def send_response(self, endpoint, data):
+        if endpoint == "email/batch":
+            messages = data
+        elif endpoint == "email/batchWithTemplates":
+            messages = data.get("Messages") if isinstance(data, dict) else None
+        else:
+            return 200, self.message_result(data)
+        if not isinstance(messages, list):
+            return 422, self.error_response(422, "Invalid batch request")
+        return 200, [self.message_result(message) for message in messages]
+
+    def message_result(self, message):
+        try:
+            to = message["To"]
+        except (KeyError, TypeError):
+            return {"ErrorCode": 300, "Message": "Invalid email request: no recipients"}
+        return {"To": to, "SubmittedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "MessageID": self.new_message_id(), "ErrorCode": 0, "Message": "OK"}
+
+    def error_response(self, status_code, message):
+        return {"ErrorCode": 500 if status_code >= 500 else 300, "Message": message}  # (0 would mean success)
+
+
+class SimulatedSendGrid(SimulatedESP):
+    name = "sendgrid"
+    api_path = "/sendgrid/api/"
+    endpoints = (r'^mail\.send\.json$',)
+    is_json = False
+
+    def send_response(self, endpoint, data):
+        return 200, {"message": "success"}
+
+    def error_response(self, status_code, message):
+        return {"message": "error", "errors": [message]}
+
+
+SIMULATED_ESPS = {esp.name: esp()
+                  for esp in (SimulatedMailgun, SimulatedMandrill, SimulatedPostmark, SimulatedSendGrid)}
+
+
+class ESPSimulatorServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, simulator):
+        self.simulator = simulator
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, ESPSimulatorRequestHandler)
+
+
+class ESPSimulatorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # (keep-alive, like the real ESPs)
+    disable_nagle_algorithm = True  # (else small responses can wait for delayed ACKs)
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        esp, endpoint = simulator.resolve(self.path.split('?', 1)[0])
+        body_size, body = self.read_body(None if esp is None else simulator.get_max_payload_size(esp, endpoint))
+        simulator.wait()
+        if esp is None:
+            return self.respond(404, {"message": "Not found: %s" % self.path})
+        status_code, data = simulator.handle(esp, endpoint, body_size, body)
+        headers = {}
+        if status_code == 429:
+            headers['Retry-After'] = str(simulator.retry_after)
+        self.respond(status_code, data, headers)
+
+    def read_body(self, max_size=None):
+        """Reads the request body, returning (size, body); body is None if it's larger than max_size"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = iter(self.read_chunk, b"")
+        else:
+            chunks = self.read_content(int(self.headers.get('Content-Length') or 0))
+        size = 0
+        body = []
+        for chunk in chunks:
+            size += len(chunk)
+            if body is not None:
+                if max_size is not None and size > max_size:
+                    body = None  # (but keep reading, so the connection can be reused)
+                else:
+                    body.append(chunk)
+        return size, None if body is None else b"".join(body)
+
+    def read_content(self, length):
+        while length > 0:
+            chunk = self.rfile.read(min(length, 65536))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def read_chunk(self):
+        """Reads one chunk of a chunked transfer-encoded body (b"" at the end)"""
+        chunk_size = int(self.rfile.readline().split(b';', 1)[0], 16)
+        if chunk_size == 0:
+            while self.rfile.readline().strip():  # (trailers)
+                pass
+            return b""
+        chunk = self.rfile.read(chunk_size)
+        self.rfile.readline()  # (CRLF after each chunk)
+        return chunk
+
+    def respond(self, status_code, data, headers=None):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.simulator.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ESPSimulator(object):
+    """Simulates the Mailgun, Mandrill, Postmark and SendGrid send APIs on a local HTTP server
+
+    :param float latency: seconds to wait before each response
+    :param float latency_jitter: maximum additional (random) seconds to wait
+    :param float error_rate: fraction of sends (0.0-1.0) to answer with error_status
+    :param int error_status: HTTP status for simulated errors (e.g., 503 to test retries)
+    :param int throttle_every: if set, after each throttle_every requests, answer
+        the next throttle_count requests with a 429 (rate limited) response
+    :param int throttle_count: length of each burst of 429 responses
+    :param int retry_after: Retry-After header (seconds) for 429 responses
+    :param int max_payload_size: if set, overrides each ESP's request body size limit (bytes)
+
+    Requests to esp.api_path + an endpoint the ESP doesn't have get a 404;
+    request bodies larger than the ESP's limit get a 413; and invalid JSON
+    (for ESPs whose APIs use JSON) gets a 400. The simulator counts the
+    responses it sends by status code in :attr:`stats`.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, latency_jitter=0.0,
+                 error_rate=0.0, error_status=500, throttle_every=None, throttle_count=1, retry_after=0,
+                 max_payload_size=None, verbose=False, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_every = throttle_every
+        self.throttle_count = throttle_count
+        self.retry_after = retry_after
+        self.max_payload_size = max_payload_size
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._request_count = 0
+            self.stats = {'requests': 0, 'bytes_received': 0, 'status_codes': {}}
+
+    @property
+    def url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    def api_url(self, esp_name):
+        """Returns the simulated API url for esp_name, for the backend's API_URL setting"""
+        return self.url + SIMULATED_ESPS[esp_name.lower()].api_path
+
+    def start(self):
+        """Starts serving in a background (daemon) thread"""
+        self.server = ESPSimulatorServer((self.host, self.port), self)
+        self.port = self.server.server_address[1]  # (in case port was 0)
+        self._thread = threading.Thread(target=self.server.serve_forever, name="anymail-esp-simulator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serves in the current thread (until interrupted)"""
+        self.server = ESPSimulatorServer((self.host, self.port), self)
+        self.port = self.server.server_address[1]
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self._thread.join()
+            self.server = None
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def resolve(self, path):
+        """Returns the (SimulatedESP, endpoint) for a request path, or (None, None)"""
+        for esp in SIMULATED_ESPS.values():
+            if path.startswith(esp.api_path):
+                endpoint = path[len(esp.api_path):]
+                if any(re.match(pattern, endpoint) for pattern in esp.endpoints):
+                    return esp, endpoint
+        return None, None
+
+    def get_max_payload_size(self, esp, endpoint):
+        return self.max_payload_size if self.max_payload_size is not None else esp.get_max_payload_size(endpoint)
+
+    def wait(self):
+        delay = self.latency
+        if self.latency_jitter:
+            delay += self.random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, esp, endpoint, body_size, body):
+        """Returns the (status_code, response data) for a request to esp's endpoint"""
+        with self._lock:
+            count = self._request_count
+            self._request_count += 1
+            throttled = (self.throttle_every is not None
+                         and count % (self.throttle_every + self.throttle_count) >= self.throttle_every)
+            failed = not throttled and self.error_rate > 0 and self.random.random() < self.error_rate
+
+        max_payload_size = self.get_max_payload_size(esp, endpoint)
+        if body is None or body_size > max_payload_size:
+            status_code, data = 413, esp.error_response(
+                413, "Request size %d exceeds limit of %d bytes" % (body_size, max_payload_size))
+        elif throttled:
+            status_code, data = 429, esp.error_response(429, "Rate limit exceeded (simulated)")
+        elif failed:
+            status_code, data = self.error_status, esp.error_response(self.error_status, "Simulated error")
+        else:
+            try:
+                parsed = json.loads(body.decode('utf-8')) if esp.is_json else None
+            except ValueError:
+                status_code, data = 400, esp.error_response(400, "Invalid JSON in request body")
+            else:
+                status_code, data = esp.send_response(endpoint, parsed)
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_received'] += body_size
+            status_codes = self.stats['status_codes']
+            status_codes[status_code] = status_codes.get(status_code, 0) + 1
+        return status_code, data
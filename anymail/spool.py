@@ -0,0 +1,164 @@
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+from .utils import SQLiteStore
+
+
+class SpoolItem(object):
+    """An item claimed from a SQLiteSpool"""
+
+    def __init__(self, id, data, attempts, lease_expires=None):
+        self.id = id
+        self.data = data  # bytes
+        self.attempts = attempts  # number of previous (failed) attempts to process the item
+        self.lease_expires = lease_expires  # time this claim's lease ends (identifies the claim)
+
+
+class SQLiteSpool(SQLiteStore):
+    """A durable, multi-process work queue of bytes items, stored in a SQLite database file.
+
+    Workers claim() items, which leases them for lease_seconds. Each claimed item
+    must then be completed, retried, or failed. (Items claimed by a worker that dies
+    become available again once their lease expires.) Completed and failed items are
+    kept, with their result, until purged.
+
+    Processing is at-least-once: if a lease expires while its worker is still busy,
+    another worker can claim and process the same item. Only the worker holding the
+    current lease can then complete, retry, or fail it (the others' calls return False).
+
+    Each method uses its own SQLite connection, so a spool can be shared between threads.
+    """
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS {table} ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " data BLOB NOT NULL,"
+        " state TEXT NOT NULL,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " available_at REAL NOT NULL,"
+        " updated_at REAL NOT NULL,"
+        " result TEXT,"
+        " error TEXT)",
+        "CREATE INDEX IF NOT EXISTS {table}_available ON {table} (state, available_at)",
+    ]
+
+    def __init__(self, path, table='spool', timeout=30):
+        super(SQLiteSpool, self).__init__(path, table, timeout)
+
+    def put(self, items):
+        """Add bytes items to the spool, and return a list of their ids"""
+        now = time.time()
+        ids = []
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for data in items:
+                    cursor = conn.execute(
+                        "INSERT INTO {table} (data, state, available_at, updated_at)"
+                        " VALUES (?, ?, ?, ?)".format(table=self.table),
+                        (sqlite3.Binary(data), self.PENDING, now, now))
+                    ids.append(cursor.lastrowid)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return ids
+
+    def claim(self, limit=100, lease_seconds=300):
+        """Lease up to limit available items (oldest first), and return them as SpoolItems"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT id, data, attempts FROM {table}"
+                    " WHERE state IN (?, ?) AND available_at <= ?"
+                    " ORDER BY available_at, id LIMIT ?".format(table=self.table),
+                    (self.PENDING, self.CLAIMED, now, limit)).fetchall()
+                conn.executemany(
+                    "UPDATE {table} SET state = ?, available_at = ?, updated_at = ?"
+                    " WHERE id = ?".format(table=self.table),
+                    [(self.CLAIMED, now + lease_seconds, now, row[0]) for row in rows])
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return [SpoolItem(id, bytes(data), attempts, now + lease_seconds) for (id, data, attempts) in rows]
+
+    def complete(self, item, result=None):
+        """Mark a claimed SpoolItem done, saving result (which must be json-serializable)
+
+        Returns False (and does nothing) if item's lease has expired and it has been claimed again.
+        """
+        return self._update(item, self.DONE, result=result)
+
+    def retry(self, item, delay, error=None):
+        """Return a claimed SpoolItem to the spool, to be claimed again after delay seconds
+
+        Returns False (and does nothing) if item's lease has expired and it has been claimed again.
+        """
+        return self._update(item, self.PENDING, delay=delay, error=error, attempted=True)
+
+    def fail(self, item, error=None, result=None):
+        """Mark a claimed SpoolItem permanently failed
+
+        Returns False (and does nothing) if item's lease has expired and it has been claimed again.
+        """
+        return self._update(item, self.FAILED, error=error, result=result, attempted=True)
+
+    def _update(self, item, state, delay=0, error=None, result=None, attempted=False):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # (a claim sets available_at to its lease_expires, so that identifies the current claim)
+            cursor = conn.execute(
+                "UPDATE {table} SET state = ?, available_at = ?, updated_at = ?,"
+                " attempts = attempts + ?, result = ?, error = ?"
+                " WHERE id = ? AND state = ? AND available_at = ?".format(table=self.table),
+                (state, now + delay, now, 1 if attempted else 0,
+                 json.dumps(result) if result is not None else None, error,
+                 item.id, self.CLAIMED, item.lease_expires))
+            return cursor.rowcount == 1
+
+    def get(self, id):
+        """Return a dict describing the item with id (without its data), or None if it doesn't exist"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT state, attempts, available_at, updated_at, result, error"
+                " FROM {table} WHERE id = ?".format(table=self.table), (id,)).fetchone()
+        if row is None:
+            return None
+        state, attempts, available_at, updated_at, result, error = row
+        return {
+            'id': id,
+            'state': state,
+            'attempts': attempts,
+            'available_at': available_at,
+            'updated_at': updated_at,
+            'result': json.loads(result) if result is not None else None,
+            'error': error,
+        }
+
+    def counts(self):
+        """Return a dict of {state: number of items}"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT state, COUNT(*) FROM {table} GROUP BY state".format(table=self.table)).fetchall()
+        return dict(rows)
+
+    def purge(self, older_than):
+        """Delete done and failed items last updated more than older_than seconds ago.
+
+        Returns the number of items deleted.
+        """
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM {table} WHERE state IN (?, ?) AND updated_at < ?".format(table=self.table),
+                (self.DONE, self.FAILED, time.time() - older_than))
+            return cursor.rowcount
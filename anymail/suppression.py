@@ -0,0 +1,224 @@
+import hashlib
+import math
+import threading
+import time
+from contextlib import closing
+
+from django.core.cache import caches
+
+from .signals import EventType
+from .utils import InstanceRegistry, SQLiteStore, get_anymail_setting
+
+
+# Tracking event types that mean a recipient shouldn't be sent more mail
+SUPPRESS_EVENT_TYPES = {EventType.BOUNCED, EventType.COMPLAINED, EventType.UNSUBSCRIBED}
+
+# Tracking event types that mean a recipient wants mail again
+UNSUPPRESS_EVENT_TYPES = {EventType.SUBSCRIBED}
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+class BloomFilter(object):
+    """A fixed-size set of str that can answer "definitely not in the set" without false negatives.
+
+    Sized to hold capacity items with about error_rate false positives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        # Standard sizing: m = -n ln(p) / (ln 2)^2 bits, k = (m/n) ln 2 hashes
+        ln2 = math.log(2)
+        num_bits = max(8, int(-capacity * math.log(error_rate) / (ln2 * ln2)))
+        self.num_bits = num_bits
+        self.num_hashes = max(1, int(round(float(num_bits) / capacity * ln2)))
+        self.capacity = capacity
+        self.count = 0
+        self.bits = bytearray((num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # (Kirsch-Mitzenmacher: k hashes from two halves of a single digest)
+        digest = hashlib.md5(item.encode('utf-8')).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class BaseSuppressionList(object):
+    """Base for stores of recipient emails that shouldn't be sent to (and why)
+
+    Emails are normalized (lowercased) before they're stored or checked.
+    """
+
+    def add(self, email, reason):
+        raise NotImplementedError("%s.%s must implement add" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def remove(self, email):
+        raise NotImplementedError("%s.%s must implement remove" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def get_reasons(self, emails):
+        """Returns a dict {email: reason} for each of emails (normalized) that is suppressed"""
+        raise NotImplementedError("%s.%s must implement get_reasons" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def record_event(self, event):
+        """Updates the list from an AnymailTrackingEvent"""
+        if not event.recipient:
+            return
+        if event.event_type in SUPPRESS_EVENT_TYPES:
+            self.add(event.recipient, event.event_type)
+        elif event.event_type in UNSUPPRESS_EVENT_TYPES:
+            self.remove(event.recipient)
+
+
+class SQLiteSuppressionList(BaseSuppressionList, SQLiteStore):
+    """Stores suppressed emails in a SQLite database file, shared by all processes that can reach it.
+
+    An in-memory BloomFilter of the stored emails answers most checks (for
+    recipients who aren't suppressed) without querying the database. It's
+    reloaded every refresh_interval seconds, to pick up emails added by
+    other processes.
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS {table} ("
+        " email TEXT PRIMARY KEY,"
+        " reason TEXT NOT NULL,"
+        " updated_at REAL NOT NULL)",
+    ]
+
+    def __init__(self, path=None, table='anymail_suppressions', refresh_interval=None, timeout=30, **kwargs):
+        if path is None:
+            path = get_anymail_setting('suppression_list_path', kwargs=kwargs)
+        if refresh_interval is None:
+            refresh_interval = get_anymail_setting('suppression_list_refresh', kwargs=kwargs, default=60)
+        SQLiteStore.__init__(self, path, table, timeout)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._bloom_loaded_at = 0
+
+    def add(self, email, reason):
+        email = normalize_email(email)
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO {table} (email, reason, updated_at)"
+                         " VALUES (?, ?, ?)".format(table=self.table),
+                         (email, reason, time.time()))
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(email)
+
+    def remove(self, email):
+        # (the email stays in the bloom filter until it's reloaded; that just costs a query)
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM {table} WHERE email = ?".format(table=self.table),
+                         (normalize_email(email),))
+
+    def _get_bloom(self):
+        with self._lock:
+            if self._bloom is None or time.time() - self._bloom_loaded_at >= self.refresh_interval:
+                with closing(self._connect()) as conn:
+                    emails = [row[0] for row in conn.execute("SELECT email FROM {table}".format(table=self.table))]
+                # (room to grow until the next reload)
+                bloom = BloomFilter(capacity=max(1024, 2 * len(emails)))
+                for email in emails:
+                    bloom.add(email)
+                self._bloom = bloom
+                self._bloom_loaded_at = time.time()
+            return self._bloom
+
+    def get_reasons(self, emails):
+        bloom = self._get_bloom()
+        candidates = [email for email in set(normalize_email(email) for email in emails) if email in bloom]
+        if not candidates:
+            return {}
+        reasons = {}
+        with closing(self._connect()) as conn:
+            for start in range(0, len(candidates), 500):  # (SQLite limits the number of query params)
+                batch = candidates[start:start + 500]
+                rows = conn.execute("SELECT email, reason FROM {table} WHERE email IN ({params})".format(
+                    table=self.table, params=", ".join("?" * len(batch))), batch)
+                reasons.update(rows.fetchall())
+        return reasons
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM {table}".format(table=self.table)).fetchone()[0]
+
+
+class CacheSuppressionList(BaseSuppressionList):
+    """Stores suppressed emails in a Django cache, so all processes using the same cache share them
+
+    (Checks all of a message's recipients with a single get_many.) Entries
+    expire after timeout seconds (default None, never -- though your cache
+    may still evict them).
+    """
+
+    key_prefix = "anymail:suppressed"
+
+    def __init__(self, cache_alias=None, timeout=None, **kwargs):
+        if cache_alias is None:
+            cache_alias = get_anymail_setting('suppression_list_cache', kwargs=kwargs, default="default")
+        if timeout is None:
+            timeout = get_anymail_setting('suppression_list_timeout', kwargs=kwargs, default=None)
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def cache_key(self, email):
+        # (emails can contain characters some cache backends don't allow in keys)
+        return "%s:%s" % (self.key_prefix, hashlib.sha1(email.encode('utf-8')).hexdigest())
+
+    def add(self, email, reason):
+        self.cache.set(self.cache_key(normalize_email(email)), reason, self.timeout)
+
+    def remove(self, email):
+        self.cache.delete(self.cache_key(normalize_email(email)))
+
+    def get_reasons(self, emails):
+        keys = {self.cache_key(email): email for email in set(normalize_email(email) for email in emails)}
+        return {keys[key]: reason for key, reason in self.cache.get_many(list(keys)).items()}
+
+
+SUPPRESSION_LISTS = {
+    "sqlite": SQLiteSuppressionList,
+    "cache": CacheSuppressionList,
+}
+
+_suppression_lists = InstanceRegistry(
+    SUPPRESSION_LISTS,
+    "Unknown Anymail SUPPRESSION_LIST %r: use 'sqlite', 'cache', "
+    "or the import path of a suppression list class")
+
+
+def get_suppression_list(name=None):
+    """Returns the suppression list for name (or the SUPPRESSION_LIST setting), or None if disabled
+
+    name can be None or False (the default, no suppression list), "sqlite", "cache",
+    or the import path of a BaseSuppressionList subclass.
+    """
+    if name is None:
+        name = get_anymail_setting('suppression_list', default=None)
+    if not name:
+        return None
+    return _suppression_lists.get(name)
+
+
+def record_suppression_event(sender, event, esp_name, **kwargs):
+    """A tracking signal receiver that updates the SUPPRESSION_LIST from bounce, complaint and unsubscribe events"""
+    suppression_list = get_suppression_list()
+    if suppression_list is not None:
+        suppression_list.record_event(event)
@@ -1,5 +1,6 @@
 from django.conf.urls import url
 
+from .views import MetricsView
 from .webhooks.mailgun import MailgunTrackingWebhookView
 from .webhooks.mandrill import MandrillTrackingWebhookView
 from .webhooks.postmark import PostmarkTrackingWebhookView
@@ -12,4 +13,5 @@ urlpatterns = [
     url(r'^mandrill/tracking/$', MandrillTrackingWebhookView.as_view(), name='mandrill_tracking_webhook'),
     url(r'^postmark/tracking/$', PostmarkTrackingWebhookView.as_view(), name='postmark_tracking_webhook'),
     url(r'^sendgrid/tracking/$', SendGridTrackingWebhookView.as_view(), name='sendgrid_tracking_webhook'),
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
 ]
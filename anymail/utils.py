@@ -1,19 +1,30 @@
+import base64
+import hashlib
 import mimetypes
+import sqlite3
+import threading
+import time
 from base64 import b64encode
+from collections import OrderedDict
 from datetime import datetime
 from email.mime.base import MIMEBase
 from email.utils import formatdate, parseaddr, unquote
+from io import BytesIO
 from time import mktime
 
 import six
 from django.conf import settings
 from django.core.mail.message import sanitize_address, DEFAULT_ATTACHMENT_MIME_TYPE
+from django.utils.module_loading import import_string
 from django.utils.timezone import utc
 
 from .exceptions import AnymailConfigurationError
 
 UNSET = object()  # Used as non-None default value
 
+# A clock for measuring durations (Python 2 doesn't have time.monotonic)
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 def combine(*args):
     """
@@ -124,25 +135,38 @@ class Attachment(object):
 
     Normalized to have these properties:
     name: attachment filename; may be None
-    content: bytestream
+    content: bytestream (read from the file, each time it's used, for file attachments)
     mimetype: the content type; guessed if not explicit
     inline: bool, True if attachment has a Content-ID header
     content_id: for inline, the Content-ID (*with* <>); may be None
     cid: for inline, the Content-ID *without* <>; may be empty string
+    is_file: bool, True if content is read from a file (an AnymailFileAttachment)
     """
 
-    def __init__(self, attachment, encoding):
+    def __init__(self, attachment, encoding, encoding_cache=None):
         # Note that an attachment can be either a tuple of (filename, content, mimetype)
         # or a MIMEBase object. (Also, both filename and mimetype may be missing.)
         self._attachment = attachment
         self.encoding = encoding  # should we be checking attachment["Content-Encoding"] ???
+        self.encoding_cache = encoding_cache  # optional EncodedContentCache for b64content
         self.inline = False
         self.content_id = None
         self.cid = ""
+        self._b64content = None
+        self.is_file = False
 
         if isinstance(attachment, MIMEBase):
             self.name = attachment.get_filename()
-            self.content = attachment.get_payload(decode=True)
+            if getattr(attachment, 'anymail_path', None) is not None:
+                # AnymailFileAttachment: don't read the file until the content is needed
+                self.is_file = True
+                self._file_source = attachment
+            elif getattr(attachment, 'anymail_content', None) is not None:
+                # AnymailInlineImage: use the original content (and cached base64) as-is
+                self.content = attachment.anymail_content
+                self._b64content_source = attachment
+            else:
+                self.content = attachment.get_payload(decode=True)
             self.mimetype = attachment.get_content_type()
 
             if get_content_disposition(attachment) == 'inline':
@@ -160,13 +184,123 @@ class Attachment(object):
         if self.mimetype is None:
             self.mimetype = DEFAULT_ATTACHMENT_MIME_TYPE
 
+    _b64content_source = None  # an attachment with a cached anymail_b64content
+    _file_source = None  # an AnymailFileAttachment
+    _content = None
+
     @property
-    def b64content(self):
-        """Content encoded as a base64 ascii string"""
-        content = self.content
+    def content(self):
+        if self._file_source is not None:
+            with self.open() as f:
+                return f.read()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+    @property
+    def size(self):
+        """Size of the content in bytes (without reading it, for file attachments)"""
+        if self._file_source is not None:
+            return self._file_source.anymail_size
+        content = self._content
         if isinstance(content, six.text_type):
             content = content.encode(self.encoding)
-        return b64encode(content).decode("ascii")
+        return len(content)
+
+    def open(self):
+        """Return a file-like object for reading the content as bytes (the caller must close it)"""
+        if self._file_source is not None:
+            return self._file_source.anymail_open()
+        content = self._content
+        if isinstance(content, six.text_type):
+            content = content.encode(self.encoding)
+        return BytesIO(content)
+
+    @property
+    def b64content(self):
+        """Content encoded as a base64 ascii string"""
+        if self._b64content is None:
+            if self._b64content_source is not None:
+                self._b64content = self._b64content_source.anymail_b64content
+            else:
+                content = self.content
+                if isinstance(content, six.text_type):
+                    content = content.encode(self.encoding)
+                if self.encoding_cache is not None:
+                    self._b64content = self.encoding_cache.b64encode(content)
+                else:
+                    self._b64content = b64encode(content).decode("ascii")
+        return self._b64content
+
+
+class EncodedContentCache(object):
+    """A thread-safe LRU cache of base64-encoded content.
+
+    Useful when the same attachment is sent with many messages. Content is
+    found by identity (the same bytes object sent again, without rehashing it),
+    or else by a digest of the content. Each entry keeps the first content
+    object it was encoded from (so its identity stays valid), and counts both
+    that and the encoded str against max_size. (Content that would be larger
+    than max_size on its own isn't cached.)
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (len, digest): (content, encoded str), least recently used first
+        self._keys_by_id = {}  # id(entry content): (len, digest)
+
+    def b64encode(self, content):
+        """Return content (bytes) encoded as a base64 ascii str"""
+        with self._lock:
+            key = self._keys_by_id.get(id(content))
+            if key is not None and self._entries[key][0] is content:
+                return self._use(key)
+        key = (len(content), hashlib.sha1(content).digest())
+        with self._lock:
+            if key in self._entries:
+                return self._use(key)
+
+        encoded = b64encode(content).decode("ascii")
+        entry_size = len(content) + len(encoded)
+        if entry_size <= self.max_size:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (content, encoded)
+                    self._keys_by_id[id(content)] = key
+                    self.size += entry_size
+                    self._evict()
+        return encoded
+
+    def _use(self, key):
+        """Return the encoded str for key, now most recently used (caller must hold the lock)"""
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+        return entry[1]
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_size:
+            _, (content, encoded) = self._entries.popitem(last=False)
+            del self._keys_by_id[id(content)]
+            self.size -= len(content) + len(encoded)
+
+
+# Shared by all backends using ATTACHMENT_ENCODING_CACHE_SIZE
+attachment_encoding_cache = EncodedContentCache()
 
 
 def get_content_disposition(mimeobj):
@@ -238,6 +372,78 @@ def get_anymail_setting(name, default=UNSET, esp_name=None, kwargs=None, allow_b
                 return default
 
 
+class InstanceRegistry(object):
+    """Process-wide shared instances of classes chosen by name (e.g., in an Anymail setting)
+
+    classes is a dict of {name: class (or other callable returning an instance)}.
+    Any other name is imported as the path of a class, unless import_paths is False.
+    The instance for each name is created (with no args) the first time it's
+    requested, and then shared by every caller. An unknown name raises
+    AnymailConfigurationError(unknown_message % name).
+
+    >>> _dispatchers = InstanceRegistry({"thread": ThreadWebhookDispatcher, ...},
+    ...                                 "Unknown Anymail WEBHOOK_DISPATCH %r: use ...")
+    >>> _dispatchers.get("thread")
+    """
+
+    def __init__(self, classes, unknown_message, import_paths=True):
+        self.classes = classes
+        self.unknown_message = unknown_message
+        self.import_paths = import_paths
+        self.instances = {}  # name: instance
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        try:
+            return self.instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self.instances:
+                self.instances[name] = self.get_class(name)()
+            return self.instances[name]
+
+    def get_class(self, name):
+        try:
+            return self.classes[name]
+        except KeyError:
+            if self.import_paths:
+                try:
+                    return import_string(name)
+                except ImportError:
+                    pass
+            raise AnymailConfigurationError(self.unknown_message % name)
+
+
+class SQLiteStore(object):
+    """Base for classes that keep their data in a table in a SQLite database file
+
+    Subclasses set schema to a list of SQL statements (formatted with {table})
+    that create the table and its indexes if they don't exist yet.
+
+    _connect() returns a new autocommit connection each time, so a store can be
+    shared between threads. The first one also enables write-ahead logging
+    (so readers in other processes don't block writers) and creates the table.
+    """
+
+    schema = []
+
+    def __init__(self, path, table, timeout=30):
+        self.path = path
+        self.table = table
+        self.timeout = timeout  # seconds to wait for other processes' locks
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)  # (autocommit)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                conn.execute(statement.format(table=self.table))
+            self._initialized = True
+        return conn
+
+
 def collect_all_methods(cls, method_name):
     """Return list of all `method_name` methods for cls and its superclass chain.
 
@@ -259,6 +465,17 @@ def collect_all_methods(cls, method_name):
     return methods
 
 
+def get_request_basic_auth(request):
+    """Returns the 'user:pass' str from a Django request's HTTP basic auth header, or None if it doesn't have one"""
+    try:
+        authtype, authdata = request.META['HTTP_AUTHORIZATION'].split()
+        if authtype.lower() == "basic":
+            return base64.b64decode(authdata).decode('utf-8')
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
 EPOCH = datetime(1970, 1, 1, tzinfo=utc)
 
 
@@ -0,0 +1,36 @@
+import six
+from django.http import Http404, HttpResponse
+from django.views.generic import View
+
+from .metrics import registry
+from .utils import get_anymail_setting, get_request_basic_auth
+
+
+class MetricsView(View):
+    """Serves Anymail's in-process metrics in Prometheus text exposition format
+
+    Disabled (404) unless the METRICS_VIEW setting is True. If METRICS_AUTHORIZATION
+    is set, requests must use one of its HTTP basic-auth 'user:pass' strings.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, **kwargs):
+        self.enabled = get_anymail_setting('metrics_view', default=False, kwargs=kwargs)
+        self.basic_auth = get_anymail_setting('metrics_authorization', default=[], kwargs=kwargs)
+        # Allow a single string:
+        if isinstance(self.basic_auth, six.string_types):
+            self.basic_auth = [self.basic_auth]
+        super(MetricsView, self).__init__(**kwargs)
+
+    def is_authorized(self, request):
+        return not self.basic_auth or get_request_basic_auth(request) in self.basic_auth
+
+    def get(self, request, *args, **kwargs):
+        if not self.enabled:
+            raise Http404("Anymail METRICS_VIEW is not enabled")
+        if not self.is_authorized(request):
+            response = HttpResponse(status=401)
+            response['WWW-Authenticate'] = 'Basic realm="Anymail metrics"'
+            return response
+        return HttpResponse(registry.exposition(), content_type=self.content_type)
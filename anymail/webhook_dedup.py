@@ -0,0 +1,140 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .utils import InstanceRegistry, get_anymail_setting
+
+
+def event_key(esp_name, event):
+    """Returns a str identifying event: the ESP's event_id if it has one, else a stable hash of the event.
+
+    (Without an event_id, uses the raw esp_event if it's JSON-like data,
+    or the normalized event fields otherwise.)
+    """
+    if event.event_id:
+        return "%s:%s" % (esp_name, event.event_id)
+    try:
+        raw = json.dumps(event.esp_event, sort_keys=True, default=repr) \
+            if isinstance(event.esp_event, (dict, list)) else None
+    except (TypeError, ValueError):
+        raw = None
+    if raw is None:
+        raw = repr(sorted((field, repr(value)) for field, value in vars(event).items() if field != 'esp_event'))
+    return "%s:sha1:%s" % (esp_name, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+
+class BaseWebhookDedup(object):
+    """Base for stores that remember the webhook events already dispatched, for ttl seconds.
+
+    The webhook view drops events whose event_key has been seen (via unseen),
+    and calls mark_seen after each event's signals have been sent successfully.
+    """
+
+    def __init__(self, ttl=None, **kwargs):
+        if ttl is None:
+            ttl = get_anymail_setting('webhook_dedup_ttl', kwargs=kwargs, default=24 * 3600)
+        self.ttl = ttl
+
+    def is_seen(self, key):
+        raise NotImplementedError("%s.%s must implement is_seen" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def add(self, key):
+        raise NotImplementedError("%s.%s must implement add" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def unseen(self, esp_name, events):
+        """Yields the events (from iterable events) that haven't already been seen"""
+        for event in events:
+            if not self.is_seen(event_key(esp_name, event)):
+                yield event
+
+    def mark_seen(self, esp_name, event):
+        self.add(event_key(esp_name, event))
+
+
+class LocalWebhookDedup(BaseWebhookDedup):
+    """Remembers up to max_size recently-seen events in the process's memory (least recently seen are forgotten)"""
+
+    def __init__(self, ttl=None, max_size=None, **kwargs):
+        super(LocalWebhookDedup, self).__init__(ttl, **kwargs)
+        if max_size is None:
+            max_size = get_anymail_setting('webhook_dedup_size', kwargs=kwargs, default=100000)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # key: expiration time (oldest first)
+
+    def is_seen(self, key):
+        with self._lock:
+            expires = self._seen.get(key)
+            if expires is None:
+                return False
+            if expires <= time.time():
+                del self._seen[key]
+                return False
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+            self._seen[key] = time.time() + self.ttl
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+
+class CacheWebhookDedup(BaseWebhookDedup):
+    """Remembers seen events in a Django cache, so all processes using the same cache share them"""
+
+    key_prefix = "anymail:webhook-seen"
+
+    def __init__(self, ttl=None, cache_alias=None, **kwargs):
+        super(CacheWebhookDedup, self).__init__(ttl, **kwargs)
+        if cache_alias is None:
+            cache_alias = get_anymail_setting('webhook_dedup_cache', kwargs=kwargs, default="default")
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def cache_key(self, key):
+        # (event ids can contain characters or lengths some cache backends don't allow in keys)
+        return "%s:%s" % (self.key_prefix, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def is_seen(self, key):
+        return self.cache.get(self.cache_key(key)) is not None
+
+    def add(self, key):
+        self.cache.set(self.cache_key(key), 1, self.ttl)
+
+
+WEBHOOK_DEDUPS = {
+    "local": LocalWebhookDedup,
+    "cache": CacheWebhookDedup,
+}
+
+_dedups = InstanceRegistry(
+    WEBHOOK_DEDUPS,
+    "Unknown Anymail WEBHOOK_DEDUP %r: use 'local', 'cache', "
+    "or the import path of a webhook dedup class")
+
+
+def get_webhook_dedup(name=None):
+    """Returns the webhook de-duplication store for name (or the WEBHOOK_DEDUP setting), or None if disabled
+
+    name can be None or False (the default, no de-duplication), "local", "cache",
+    or the import path of a BaseWebhookDedup subclass.
+    """
+    if name is None:
+        name = get_anymail_setting('webhook_dedup', default=None)
+    if not name:
+        return None
+    return _dedups.get(name)
@@ -0,0 +1,309 @@
+import logging
+import pickle
+import threading
+import time
+from io import BytesIO
+
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+from six.moves import queue
+
+from .exceptions import AnymailWebhookQueueFull
+from .spool import SQLiteSpool
+from .utils import InstanceRegistry, get_anymail_setting
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_request(view, request):
+    """Return a picklable dict capturing a (validated) webhook request, for dispatch_snapshot
+
+    Omits the Authorization header (which has already been checked).
+    """
+    meta = {key: value for key, value in request.META.items()
+            if (key.startswith('HTTP_') and key != 'HTTP_AUTHORIZATION')
+            or key in ('CONTENT_TYPE', 'SERVER_NAME', 'SERVER_PORT')}
+    return {
+        'view': "%s.%s" % (view.__class__.__module__, view.__class__.__name__),
+        'method': request.method,
+        'scheme': request.scheme,
+        'path': request.META.get('PATH_INFO', request.path_info),
+        'query_string': request.META.get('QUERY_STRING', ''),
+        'meta': meta,
+        'body': request.body,
+        'received': time.time(),
+        'attempts': 0,
+    }
+
+
+def request_from_snapshot(snapshot):
+    """Return an HttpRequest equivalent to the one captured in snapshot"""
+    body = snapshot['body']
+    environ = dict(snapshot['meta'])
+    environ.update({
+        'REQUEST_METHOD': snapshot['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': snapshot['path'],
+        'QUERY_STRING': snapshot['query_string'],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+        'wsgi.url_scheme': snapshot['scheme'],
+    })
+    return WSGIRequest(environ)
+
+
+def dispatch_snapshot(snapshot):
+    """Parse the events in a snapshot_request, and send their signals"""
+    view_class = import_string(snapshot['view'])
+    view = view_class()
+    close_old_connections()  # (like a request, in case receivers use the database)
+    try:
+        view.process_request(request_from_snapshot(snapshot))
+    finally:
+        close_old_connections()
+
+
+class BaseWebhookDispatcher(object):
+    """Base for asynchronous webhook dispatchers.
+
+    The webhook view calls enqueue(snapshot) with a validated request's
+    snapshot_request. The dispatcher must later call dispatch_snapshot
+    (or raise AnymailWebhookQueueFull if it can't accept more).
+    """
+
+    def __init__(self, max_pending=None, **kwargs):
+        if max_pending is None:
+            max_pending = get_anymail_setting('webhook_queue_size', kwargs=kwargs, default=1000)
+        self.max_pending = max_pending
+
+    def enqueue(self, snapshot):
+        raise NotImplementedError("%s.%s must implement enqueue" %
+                                  (self.__class__.__module__, self.__class__.__name__))
+
+    def queue_full(self):
+        return AnymailWebhookQueueFull("Anymail webhook queue has %d events waiting" % self.max_pending)
+
+
+class ThreadWebhookDispatcher(BaseWebhookDispatcher):
+    """Dispatches webhooks from worker threads in the web server process.
+
+    Simple, but events are lost if the process exits while they're waiting.
+    """
+
+    def __init__(self, max_pending=None, threads=None, **kwargs):
+        super(ThreadWebhookDispatcher, self).__init__(max_pending, **kwargs)
+        if threads is None:
+            threads = get_anymail_setting('webhook_dispatch_threads', kwargs=kwargs, default=2)
+        self.num_threads = threads
+        self.queue = queue.Queue(maxsize=self.max_pending)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def enqueue(self, snapshot):
+        self._start_workers()
+        try:
+            self.queue.put_nowait(snapshot)
+        except queue.Full:
+            raise self.queue_full()
+
+    def join(self):
+        """Wait until all waiting events have been dispatched"""
+        self.queue.join()
+
+    def _start_workers(self):
+        if len(self._threads) < self.num_threads:
+            with self._lock:
+                while len(self._threads) < self.num_threads:
+                    thread = threading.Thread(target=self._work, name="anymail-webhooks-%d" % len(self._threads))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                dispatch_snapshot(snapshot)
+            except Exception:
+                logger.exception("Error dispatching Anymail webhook events")
+            finally:
+                self.queue.task_done()
+
+
+class SpoolWebhookDispatcher(BaseWebhookDispatcher):
+    """Stores webhooks in a SQLiteSpool, for the anymail_process_webhooks command to dispatch
+
+    Waiting events survive process restarts. Failed dispatches are retried
+    (with backoff) up to max_attempts times.
+    """
+
+    def __init__(self, max_pending=None, path=None, max_attempts=None, retry_backoff=None, **kwargs):
+        super(SpoolWebhookDispatcher, self).__init__(max_pending, **kwargs)
+        if path is None:
+            path = get_anymail_setting('webhook_spool_path', kwargs=kwargs)
+        if max_attempts is None:
+            max_attempts = get_anymail_setting('webhook_max_attempts', kwargs=kwargs, default=5)
+        if retry_backoff is None:
+            retry_backoff = get_anymail_setting('webhook_retry_backoff', kwargs=kwargs, default=30)
+        self.spool = SQLiteSpool(path, table='anymail_webhooks')
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+
+    def enqueue(self, snapshot):
+        counts = self.spool.counts()
+        if counts.get(SQLiteSpool.PENDING, 0) + counts.get(SQLiteSpool.CLAIMED, 0) >= self.max_pending:
+            raise self.queue_full()
+        self.spool.put([pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)])
+
+    def process_pending(self, limit=100, lease_seconds=300):
+        """Dispatch up to limit waiting webhooks, and return a dict of counts 'dispatched', 'retrying', 'failed'"""
+        counts = {'dispatched': 0, 'retrying': 0, 'failed': 0}
+        for item in self.spool.claim(limit, lease_seconds=lease_seconds):
+            try:
+                dispatch_snapshot(pickle.loads(item.data))
+            except Exception as err:
+                logger.exception("Error dispatching Anymail webhook events (spool item %s)", item.id)
+                attempts = item.attempts + 1
+                if attempts >= self.max_attempts:
+                    self.spool.fail(item, error=repr(err))
+                    counts['failed'] += 1
+                else:
+                    self.spool.retry(item, self.retry_backoff * 2 ** (attempts - 1), error=repr(err))
+                    counts['retrying'] += 1
+            else:
+                self.spool.complete(item)
+                counts['dispatched'] += 1
+        return counts
+
+    def purge(self, older_than):
+        return self.spool.purge(older_than)
+
+
+class CacheWebhookDispatcher(BaseWebhookDispatcher):
+    """Stores webhooks in a list in a Django cache, for the anymail_process_webhooks command to dispatch
+
+    Lets any number of processes using the same (shared) cache dispatch the events.
+    This is best-effort: an event is lost if the cache evicts it before
+    it's dispatched. Failed dispatches are re-queued up to max_attempts times.
+
+    Workers claim list indexes with cache.incr on the head (and enqueue reserves
+    them with cache.incr on the tail), so each index goes to exactly one worker.
+    A worker that claims an index before its event has been stored leaves a
+    claimed_marker there (with cache.add), and enqueue moves on to the next index.
+    """
+
+    key_prefix = "anymail:webhooks"
+    item_timeout = 7 * 24 * 3600
+    claimed_marker = "anymail:claimed"  # (snapshots are dicts)
+
+    def __init__(self, max_pending=None, cache_alias=None, max_attempts=None, **kwargs):
+        super(CacheWebhookDispatcher, self).__init__(max_pending, **kwargs)
+        if cache_alias is None:
+            cache_alias = get_anymail_setting('webhook_queue_cache', kwargs=kwargs, default="default")
+        if max_attempts is None:
+            max_attempts = get_anymail_setting('webhook_max_attempts', kwargs=kwargs, default=5)
+        self.cache_alias = cache_alias
+        self.max_attempts = max_attempts
+        # The list is items head+1 through tail (head and tail are only ever incremented;
+        # head can pass tail when workers find the list empty, see _pop)
+        self.head_key = "%s:head" % self.key_prefix
+        self.tail_key = "%s:tail" % self.key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def item_key(self, index):
+        return "%s:item:%d" % (self.key_prefix, index)
+
+    def _get_head_and_tail(self):
+        cache = self.cache
+        cache.add(self.head_key, 0, None)
+        cache.add(self.tail_key, 0, None)
+        positions = cache.get_many([self.head_key, self.tail_key])
+        return positions.get(self.head_key, 0), positions.get(self.tail_key, 0)
+
+    def enqueue(self, snapshot):
+        head, tail = self._get_head_and_tail()
+        if tail - head >= self.max_pending:
+            raise self.queue_full()
+        self._append(snapshot)
+
+    def _append(self, snapshot):
+        cache = self.cache
+        while True:
+            index = cache.incr(self.tail_key)
+            key = self.item_key(index)
+            if cache.add(key, snapshot, self.item_timeout):
+                return
+            cache.delete(key)  # a worker already claimed this index (see _pop): use the next one
+
+    def _pop(self):
+        """Return the next snapshot from the list, or None if it's empty"""
+        cache = self.cache
+        while True:
+            head, tail = self._get_head_and_tail()
+            if head >= tail:
+                return None
+            index = cache.incr(self.head_key)  # (this worker's alone)
+            key = self.item_key(index)
+            if cache.add(key, self.claimed_marker, self.item_timeout):
+                # Nothing stored there yet: another worker took the last event first (so index
+                # is past the tail), or enqueue has reserved the index but not yet stored its event.
+                # Either way, the marker makes enqueue store that event at a later index.
+                if index > tail:
+                    return None
+                continue
+            snapshot = cache.get(key)
+            cache.delete(key)
+            if snapshot is not None:
+                return snapshot
+            logger.warning("Anymail webhook event %d was missing from the cache (lost)", index)
+
+    def process_pending(self, limit=100, **kwargs):
+        """Dispatch up to limit waiting webhooks, and return a dict of counts 'dispatched', 'retrying', 'failed'"""
+        counts = {'dispatched': 0, 'retrying': 0, 'failed': 0}
+        for _ in range(limit):
+            snapshot = self._pop()
+            if snapshot is None:
+                break
+            try:
+                dispatch_snapshot(snapshot)
+            except Exception:
+                logger.exception("Error dispatching Anymail webhook events")
+                snapshot['attempts'] += 1
+                if snapshot['attempts'] >= self.max_attempts:
+                    counts['failed'] += 1
+                else:
+                    self._append(snapshot)
+                    counts['retrying'] += 1
+            else:
+                counts['dispatched'] += 1
+        return counts
+
+
+WEBHOOK_DISPATCHERS = {
+    "thread": ThreadWebhookDispatcher,
+    "spool": SpoolWebhookDispatcher,
+    "cache": CacheWebhookDispatcher,
+}
+
+_dispatchers = InstanceRegistry(
+    WEBHOOK_DISPATCHERS,
+    "Unknown Anymail WEBHOOK_DISPATCH %r: use 'sync', 'thread', 'spool', 'cache', "
+    "or the import path of a webhook dispatcher class")
+
+
+def get_webhook_dispatcher(name=None):
+    """Returns the webhook dispatcher for name (or the WEBHOOK_DISPATCH setting), or None for "sync"
+
+    name can be "sync" (the default), "thread", "spool", "cache",
+    or the import path of a BaseWebhookDispatcher subclass.
+    """
+    if name is None:
+        name = get_anymail_setting('webhook_dispatch', default="sync")
+    if name == "sync":
+        return None
+    return _dispatchers.get(name)
@@ -1,15 +1,19 @@
-import base64
 import re
 import six
 import warnings
+from collections import defaultdict
 
 from django.http import HttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
-from ..exceptions import AnymailInsecureWebhookWarning, AnymailWebhookValidationFailure
-from ..utils import get_anymail_setting, collect_all_methods
+from ..exceptions import AnymailInsecureWebhookWarning, AnymailWebhookQueueFull, AnymailWebhookValidationFailure
+from ..jsoncodec import get_json_codec
+from ..metrics import record_webhook
+from ..webhook_dedup import get_webhook_dedup
+from ..webhook_dispatch import get_webhook_dispatcher, snapshot_request
+from ..utils import get_anymail_setting, get_request_basic_auth, collect_all_methods, monotonic
 
 
 class AnymailBasicAuthMixin(object):
@@ -42,16 +46,7 @@ class AnymailBasicAuthMixin(object):
     def validate_request(self, request):
         """If configured for webhook basic auth, validate request has correct auth."""
         if self.basic_auth:
-            valid = False
-            try:
-                authtype, authdata = request.META['HTTP_AUTHORIZATION'].split()
-                if authtype.lower() == "basic":
-                    auth = base64.b64decode(authdata).decode('utf-8')
-                    if auth in self.basic_auth:
-                        valid = True
-            except (IndexError, KeyError, TypeError, ValueError):
-                valid = False
-            if not valid:
+            if get_request_basic_auth(request) not in self.basic_auth:
                 # noinspection PyUnresolvedReferences
                 raise AnymailWebhookValidationFailure(
                     "Missing or invalid basic auth in Anymail %s webhook" % self.esp_name)
@@ -71,12 +66,18 @@ class AnymailBaseWebhookView(AnymailBasicAuthMixin, View):
     def __init__(self, **kwargs):
         super(AnymailBaseWebhookView, self).__init__(**kwargs)
         self.validators = collect_all_methods(self.__class__, 'validate_request')
+        self.json_codec = get_json_codec()
+        self.dispatcher = get_webhook_dispatcher()  # None to process events in the request
+        self.dedup = get_webhook_dedup()  # None to dispatch every event (even repeats)
 
     # Subclass implementation:
 
     # Where to send events: either ..signals.inbound or ..signals.tracking
     signal = None
 
+    # Where to send the list of all events from a single call (e.g., ..signals.tracking_batch), or None
+    batch_signal = None
+
     def validate_request(self, request):
         """Check validity of webhook post, or raise AnymailWebhookValidationFailure.
 
@@ -94,9 +95,10 @@ class AnymailBaseWebhookView(AnymailBasicAuthMixin, View):
         pass
 
     def parse_events(self, request):
-        """Return a list of normalized AnymailWebhookEvent extracted from ESP post data.
+        """Return a list (or iterable) of normalized AnymailWebhookEvent extracted from ESP post data.
 
-        Subclasses must implement.
+        Subclasses must implement. (Every event is parsed before any is
+        dispatched, so invalid data doesn't leave a batch partly processed.)
         """
         raise NotImplementedError()
 
@@ -116,13 +118,50 @@ class AnymailBaseWebhookView(AnymailBasicAuthMixin, View):
         # - Any other errors (e.g., in signal dispatch) will turn into HTTP 500
         #   responses (via normal Django error handling). ESPs generally
         #   treat that as "try again later".
+        if self.dispatcher is not None:
+            request.body  # read now, so it's still available after validators parse request.POST
         self.run_validators(request)
-        events = self.parse_events(request)
-        esp_name = self.esp_name
-        for event in events:
-            self.signal.send(sender=self.__class__, event=event, esp_name=esp_name)
+        if self.dispatcher is not None:
+            # Acknowledge now, and parse and dispatch the events later
+            try:
+                self.dispatcher.enqueue(snapshot_request(self, request))
+            except AnymailWebhookQueueFull:
+                return HttpResponse("Too many events waiting; try again later", status=503)
+            return HttpResponse()
+        self.process_request(request)
         return HttpResponse()
 
+    def process_request(self, request):
+        """Parse the events from a validated request, and send their signals"""
+        esp_name = self.esp_name
+        sender = self.__class__
+        start = monotonic()
+        parse_time = None
+        event_counts = defaultdict(int)
+        try:
+            # Parse the whole batch before sending any signals, so invalid data raises an error
+            # (and the ESP retries) before any of the batch's events have been dispatched
+            events = list(self.parse_events(request))
+            parse_time = monotonic() - start
+            if self.dedup is not None:
+                events = list(self.dedup.unseen(esp_name, events))  # (drop ESP retries of dispatched events)
+            if events and self.batch_signal is not None and self.batch_signal.has_listeners(sender):
+                self.batch_signal.send(sender=sender, events=events, esp_name=esp_name)
+            send_events = self.signal.has_listeners(sender)
+            for event in events:
+                if send_events:
+                    self.signal.send(sender=sender, event=event, esp_name=esp_name)
+                if self.dedup is not None:
+                    # (only once its receivers have succeeded, so if a later event's receiver fails,
+                    # the ESP's retry of the batch won't re-dispatch this one)
+                    self.dedup.mark_seen(esp_name, event)
+                event_counts[event.event_type] += 1
+        finally:
+            if parse_time is None:
+                parse_time = monotonic() - start  # (parse_events raised an error)
+            record_webhook(esp_name, event_counts, parse_time=parse_time,
+                           dispatch_time=monotonic() - start - parse_time)
+
     # Request validation (subclasses shouldn't need to override):
 
     def run_validators(self, request):
@@ -1,4 +1,3 @@
-import json
 from datetime import datetime
 
 import hashlib
@@ -7,7 +6,7 @@ from django.utils.timezone import utc
 
 from .base import AnymailBaseWebhookView
 from ..exceptions import AnymailWebhookValidationFailure
-from ..signals import tracking, AnymailTrackingEvent, EventType, RejectReason
+from ..signals import tracking, tracking_batch, AnymailTrackingEvent, EventType, RejectReason
 from ..utils import get_anymail_setting, combine
 
 
@@ -48,6 +47,7 @@ class MailgunTrackingWebhookView(MailgunBaseWebhookView):
     """Handler for Mailgun delivery and engagement tracking webhooks"""
 
     signal = tracking
+    batch_signal = tracking_batch
 
     event_types = {
         # Map Mailgun event: Anymail normalized type
@@ -101,7 +101,7 @@ class MailgunTrackingWebhookView(MailgunBaseWebhookView):
         # However, it also includes the original message headers,
         # which have the metadata separately as X-Mailgun-Variables.
         try:
-            headers = json.loads(esp_event['message-headers'])
+            headers = self.json_codec.loads(esp_event['message-headers'])
         except (KeyError, ):
             metadata = None
         else:
@@ -109,7 +109,7 @@ class MailgunTrackingWebhookView(MailgunBaseWebhookView):
                          if field == 'X-Mailgun-Variables']
             if len(variables) >= 1:
                 # Each X-Mailgun-Variables value is JSON. Parse and merge them all into single dict:
-                metadata = combine(*[json.loads(value) for value in variables])
+                metadata = combine(*[self.json_codec.loads(value) for value in variables])
             else:
                 metadata = None
 
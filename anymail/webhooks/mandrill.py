@@ -1,4 +1,3 @@
-import json
 from datetime import datetime
 
 import hashlib
@@ -8,7 +7,7 @@ from django.utils.timezone import utc
 
 from .base import AnymailBaseWebhookView
 from ..exceptions import AnymailWebhookValidationFailure, AnymailConfigurationError
-from ..signals import tracking, AnymailTrackingEvent, EventType
+from ..signals import tracking, tracking_batch, AnymailTrackingEvent, EventType
 from ..utils import get_anymail_setting, getfirst
 
 
@@ -54,7 +53,7 @@ class MandrillBaseWebhookView(MandrillSignatureMixin, AnymailBaseWebhookView):
     warn_if_no_basic_auth = False  # because we validate against signature
 
     def parse_events(self, request):
-        esp_events = json.loads(request.POST['mandrill_events'])
+        esp_events = self.json_codec.loads(request.POST['mandrill_events'])
         return [self.esp_to_anymail_event(esp_event) for esp_event in esp_events]
 
     def esp_to_anymail_event(self, esp_event):
@@ -64,6 +63,7 @@ class MandrillBaseWebhookView(MandrillSignatureMixin, AnymailBaseWebhookView):
 class MandrillTrackingWebhookView(MandrillBaseWebhookView):
 
     signal = tracking
+    batch_signal = tracking_batch
 
     event_types = {
         # Message events:
@@ -1,10 +1,8 @@
-import json
-
 from django.utils.dateparse import parse_datetime
 
 from .base import AnymailBaseWebhookView
 from ..exceptions import AnymailConfigurationError
-from ..signals import tracking, AnymailTrackingEvent, EventType, RejectReason
+from ..signals import tracking, tracking_batch, AnymailTrackingEvent, EventType, RejectReason
 from ..utils import getfirst
 
 
@@ -12,7 +10,7 @@ class PostmarkBaseWebhookView(AnymailBaseWebhookView):
     """Base view class for Postmark webhooks"""
 
     def parse_events(self, request):
-        esp_event = json.loads(request.body.decode('utf-8'))
+        esp_event = self.json_codec.loads(request.body)
         return [self.esp_to_anymail_event(esp_event)]
 
     def esp_to_anymail_event(self, esp_event):
@@ -23,6 +21,7 @@ class PostmarkTrackingWebhookView(PostmarkBaseWebhookView):
     """Handler for Postmark delivery and engagement tracking webhooks"""
 
     signal = tracking
+    batch_signal = tracking_batch
 
     event_types = {
         # Map Postmark event type: Anymail normalized (event type, reject reason)
@@ -1,17 +1,16 @@
-import json
 from datetime import datetime
 
 from django.utils.timezone import utc
 
 from .base import AnymailBaseWebhookView
-from ..signals import tracking, AnymailTrackingEvent, EventType, RejectReason
+from ..signals import tracking, tracking_batch, AnymailTrackingEvent, EventType, RejectReason
 
 
 class SendGridBaseWebhookView(AnymailBaseWebhookView):
     """Base view class for SendGrid webhooks"""
 
     def parse_events(self, request):
-        esp_events = json.loads(request.body.decode('utf-8'))
+        esp_events = self.json_codec.loads(request.body)
         return [self.esp_to_anymail_event(esp_event) for esp_event in esp_events]
 
     def esp_to_anymail_event(self, esp_event):
@@ -22,6 +21,7 @@ class SendGridTrackingWebhookView(SendGridBaseWebhookView):
     """Handler for SendGrid delivery and engagement tracking webhooks"""
 
     signal = tracking
+    batch_signal = tracking_batch
 
     event_types = {
         # Map SendGrid event: Anymail normalized type
@@ -5,7 +5,10 @@ from django.test import SimpleTestCase
 import requests
 import six
 from mock import patch
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
 
+from anymail.backends.base_requests import persistent_sessions
+from anymail.ratelimit import local_rate_limiter
 from anymail.exceptions import AnymailAPIError
 
 from .utils import AnymailTestMixin
@@ -94,13 +97,33 @@ class RequestsBackendMockAPITestCase(SimpleTestCase, AnymailTestMixin):
         return self.get_api_call_arg('headers', 5, required)
 
     def get_api_call_files(self, required=True):
-        """Returns the files sent to the mock ESP API"""
-        return self.get_api_call_arg('files', 7, required)
+        """Returns the files sent to the mock ESP API (with file-like content read, as requests would)"""
+        files = self.get_api_call_arg('files', 7, required)
+
+        def read_content(value):
+            if isinstance(value, tuple) and hasattr(value[1], 'read'):
+                return (value[0], value[1].read()) + value[2:]
+            return value
+
+        if isinstance(files, dict):
+            return {field: read_content(value) for (field, value) in files.items()}
+        elif files is not None:
+            return [(field, read_content(value)) for (field, value) in files]
+        return files
 
     def get_api_call_auth(self, required=True):
         """Returns the auth sent to the mock ESP API"""
         return self.get_api_call_arg('auth', 8, required)
 
+    def assert_streamed_multipart(self, body, data, files):
+        """Verifies StreamingBody body has the same content requests would have sent for data and files"""
+        boundary = body.content_type.split("boundary=")[1]
+        expected = requests.Request('POST', 'https://api.example.com/', data=data, files=files).prepare()
+        expected_boundary = expected.headers['Content-Type'].split("boundary=")[1]
+        expected_body = expected.body.replace(expected_boundary.encode('ascii'), boundary.encode('ascii'))
+        self.assertEqual(len(body), len(expected_body))
+        self.assertEqual(body.read(), expected_body)
+
     def assert_esp_not_called(self, msg=None):
         if self.mock_request.called:
             raise AssertionError(msg or "ESP API was called and shouldn't have been")
@@ -174,3 +197,187 @@ class SessionSharingTestCasesMixin(object):
 
         connection.close()
         self.assertEqual(self.mock_close.call_count, 1)
+
+    def test_concurrent_send_messages(self):
+        """With SEND_CONCURRENCY, messages are sent in parallel over one shared session"""
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(5)]
+        connection = mail.get_connection(send_concurrency=3)
+        sent = connection.send_messages(messages)
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(self.mock_request.call_args_list), 5)  # (call_count isn't thread-safe)
+        sessions = set(call[0][0] for call in self.mock_request.call_args_list)  # arg[0] (self) is session
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(self.mock_close.call_count, 1)
+        for message in messages:
+            self.assertIn('to@example.com', message.anymail_status.recipients)
+
+    def test_concurrent_send_messages_errors(self):
+        self.set_mock_response(status_code=500)
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(3)]
+        with self.assertRaises(AnymailAPIError):
+            mail.get_connection(send_concurrency=3).send_messages(messages)
+        self.assertEqual(len(self.mock_request.call_args_list), 3)  # all messages were attempted
+        self.assertEqual(self.mock_close.call_count, 1)
+
+        sent = mail.get_connection(send_concurrency=3, fail_silently=True).send_messages(messages)
+        self.assertEqual(sent, 0)
+
+    def test_concurrent_connection_pool_size(self):
+        connection = mail.get_connection(send_concurrency=25)
+        connection.open()
+        self.addCleanup(connection.close)
+        adapter = connection.session.get_adapter("https://api.example.com/")
+        self.assertEqual(adapter._pool_maxsize, 25)
+
+    def test_persistent_sessions(self):
+        """With PERSISTENT_SESSIONS, separate connections borrow the same session without closing it"""
+        self.addCleanup(persistent_sessions.clear)
+        with self.settings(ANYMAIL_PERSISTENT_SESSIONS=True):
+            mail.send_mail('Subject 1', 'body', 'from@example.com', ['to@example.com'])
+            session1 = self.mock_request.call_args[0][0]
+            mail.send_mail('Subject 2', 'body', 'from@example.com', ['to@example.com'])
+            session2 = self.mock_request.call_args[0][0]
+        self.assertIs(session1, session2)
+        self.assertEqual(self.mock_close.call_count, 0)
+
+        persistent_sessions.clear()
+        self.assertEqual(self.mock_close.call_count, 1)
+
+    def test_persistent_session_idle_timeout(self):
+        """Persistent sessions left idle are closed the next time one is borrowed"""
+        self.addCleanup(persistent_sessions.clear)
+        with self.settings(ANYMAIL_PERSISTENT_SESSIONS=True, ANYMAIL_SESSION_IDLE_TIMEOUT=10):
+            with patch('time.time', return_value=1000.0):
+                mail.send_mail('Subject 1', 'body', 'from@example.com', ['to@example.com'])
+                session1 = self.mock_request.call_args[0][0]
+            with patch('time.time', return_value=1005.0):
+                mail.send_mail('Subject 2', 'body', 'from@example.com', ['to@example.com'])
+                session2 = self.mock_request.call_args[0][0]
+            self.assertIs(session1, session2)
+            self.assertEqual(self.mock_close.call_count, 0)
+
+            with patch('time.time', return_value=1100.0):
+                mail.send_mail('Subject 3', 'body', 'from@example.com', ['to@example.com'])
+                session3 = self.mock_request.call_args[0][0]
+            self.assertIsNot(session1, session3)
+            self.assertEqual(self.mock_close.call_count, 1)
+
+    def retry_responses(self, *responses):
+        """Set mock_request to return (or raise) each of responses in turn, then the normal mock response"""
+        success = self.mock_request.return_value
+        self.mock_request.side_effect = list(responses) + [success]
+
+    def mock_retry_response(self, status_code=503, retry_after=None):
+        response = self.MockResponse(status_code, b"Service unavailable")
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        return response
+
+    @staticmethod
+    def connect_error(message="Connection refused"):
+        """A requests.ConnectionError like requests raises when it can't connect to the ESP"""
+        reason = NewConnectionError(None, "Failed to establish a new connection: %s" % message)
+        return requests.ConnectionError(MaxRetryError(None, "/api", reason=reason))
+
+    @patch('time.sleep')
+    def test_send_retries(self, mock_sleep):
+        """With SEND_RETRIES, connection failures and 429/5xx responses are retried with backoff"""
+        self.retry_responses(self.mock_retry_response(503, retry_after="3"), self.connect_error())
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        with self.settings(ANYMAIL_SEND_RETRIES=2, ANYMAIL_SEND_RETRY_BACKOFF=1):
+            message.send()
+        self.assertEqual(self.mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(mock_sleep.call_args_list[0][0][0], 3)  # honors Retry-After
+        backoff = mock_sleep.call_args_list[1][0][0]
+        self.assertTrue(0 <= backoff <= 2)  # jittered: up to 1 * 2**1
+        self.assertEqual(message.anymail_status.retries, 2)
+        self.assertEqual(message.anymail_status.retry_delay, 3 + backoff)
+        self.assertIn('to@example.com', message.anymail_status.recipients)
+
+    @patch('time.sleep')
+    def test_send_retries_exhausted(self, mock_sleep):
+        self.set_mock_response(status_code=429)
+        with self.settings(ANYMAIL_SEND_RETRIES=2):
+            with self.assertRaises(AnymailAPIError):
+                mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_request.call_count, 3)
+
+        self.mock_request.reset_mock()
+        self.mock_request.side_effect = self.connect_error()
+        with self.settings(ANYMAIL_SEND_RETRIES=2):
+            with self.assertRaises(requests.ConnectionError):
+                mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_request.call_count, 3)
+
+        self.mock_request.reset_mock()
+        self.mock_request.side_effect = requests.ConnectTimeout("Connection timed out")
+        with self.settings(ANYMAIL_SEND_RETRIES=2):
+            with self.assertRaises(requests.ConnectTimeout):
+                mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_request.call_count, 3)
+
+    @patch('time.sleep')
+    @patch('random.uniform', return_value=5)
+    def test_send_retries_connection_error_time_limit(self, mock_uniform, mock_sleep):
+        """A connection error is re-raised if the retry delay would exceed SEND_RETRY_TIME_LIMIT"""
+        self.mock_request.side_effect = self.connect_error()
+        with self.settings(ANYMAIL_SEND_RETRIES=2, ANYMAIL_SEND_RETRY_TIME_LIMIT=1):
+            with self.assertRaisesMessage(requests.ConnectionError, "Connection refused"):
+                mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_request.call_count, 1)
+        self.assertEqual(mock_sleep.call_count, 0)
+
+    @patch('time.sleep')
+    def test_send_retries_not_after_sending(self, mock_sleep):
+        """Connection errors that can happen after the ESP received the request aren't retried"""
+        errors = [
+            requests.ConnectionError(ProtocolError("Connection aborted.", OSError("Remote end closed connection"))),
+            requests.exceptions.SSLError("EOF occurred in violation of protocol"),
+            requests.ReadTimeout("Read timed out"),
+        ]
+        for error in errors:
+            self.mock_request.reset_mock()
+            self.retry_responses(error)
+            with self.settings(ANYMAIL_SEND_RETRIES=2):
+                with self.assertRaises(type(error)):
+                    mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(self.mock_request.call_count, 1, msg=repr(error))
+
+    @patch('time.sleep')
+    def test_send_retries_not_attempted(self, mock_sleep):
+        # no retries by default:
+        self.retry_responses(self.mock_retry_response(503))
+        with self.assertRaises(AnymailAPIError):
+            mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        self.assertEqual(self.mock_request.call_count, 1)
+
+        with self.settings(ANYMAIL_SEND_RETRIES=2):
+            # 500 errors may occur after the ESP has accepted the message:
+            self.mock_request.reset_mock()
+            self.retry_responses(self.mock_retry_response(500))
+            with self.assertRaises(AnymailAPIError):
+                mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(self.mock_request.call_count, 1)
+
+            # Retry-After beyond the SEND_RETRY_TIME_LIMIT:
+            self.mock_request.reset_mock()
+            self.retry_responses(self.mock_retry_response(503, retry_after="Wed, 21 Oct 2015 07:28:00 GMT"))
+            with patch('time.time', return_value=1445412000.0):  # 07:20:00 GMT
+                with self.assertRaises(AnymailAPIError):
+                    mail.send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+            self.assertEqual(self.mock_request.call_count, 1)
+        self.assertEqual(mock_sleep.call_count, 0)
+
+    @patch('time.sleep')
+    @patch('time.time', return_value=1000.0)
+    def test_rate_limit(self, mock_time, mock_sleep):
+        """With RATE_LIMIT, API calls are paced to the limit"""
+        self.addCleanup(local_rate_limiter.clear)
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(4)]
+        mail.get_connection(rate_limit="2/s", rate_limit_burst=2).send_messages(messages)
+        self.assertEqual(self.mock_request.call_count, 4)
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list], [0.5, 1.0])
@@ -1,6 +1,7 @@
-from django.core.mail import get_connection
+from django.core.mail import EmailMessage, get_connection
 from django.test import SimpleTestCase
 from django.test.utils import override_settings
+from mock import patch
 
 from .utils import AnymailTestMixin
 
@@ -33,3 +34,38 @@ class BackendSettingsTests(SimpleTestCase, AnymailTestMixin):
                                     username='username_from_kwargs', password='password_from_kwargs')
         self.assertEqual(connection.username, 'username_from_kwargs')
         self.assertEqual(connection.password, 'password_from_kwargs')
+
+    @override_settings(ANYMAIL={'MAILGUN_API_KEY': 'key1', 'MAILGUN_RATE_LIMIT': '600/m'})
+    def test_rate_limit_key(self):
+        connection = get_connection('anymail.backends.mailgun.MailgunBackend')
+        self.assertEqual(connection.rate_limit, 10.0)
+        self.assertEqual(connection.get_rate_limit_key(None), 'mailgun')
+
+        # per API key, without exposing the key
+        key1 = get_connection('anymail.backends.mailgun.MailgunBackend',
+                              rate_limit_per_api_key=True).get_rate_limit_key(None)
+        key2 = get_connection('anymail.backends.mailgun.MailgunBackend', api_key='key2',
+                              rate_limit_per_api_key=True).get_rate_limit_key(None)
+        self.assertTrue(key1.startswith('mailgun:'))
+        self.assertNotIn('key1', key1)
+        self.assertNotEqual(key1, key2)
+
+    def test_message_attr_plan(self):
+        """Each payload class computes (and caches) its own message attr plan"""
+        from anymail.backends.mandrill import MandrillPayload
+        from anymail.backends.postmark import PostmarkPayload
+        mandrill_plan = MandrillPayload.get_message_attr_plan()
+        self.assertIs(MandrillPayload.get_message_attr_plan(), mandrill_plan)
+        self.assertIn('ip_pool', [attr for (attr, _, _, _) in mandrill_plan])
+        self.assertNotIn('ip_pool', [attr for (attr, _, _, _) in PostmarkPayload.get_message_attr_plan()])
+
+    @override_settings(ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token'})
+    def test_message_attr_plan_uses_payload_methods(self):
+        """Converters and setters are looked up on each payload, so overrides still work"""
+        from anymail.backends.postmark import PostmarkPayload
+        PostmarkPayload.get_message_attr_plan()  # (make sure the plan is already cached)
+        message = EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        backend = get_connection('anymail.backends.postmark.PostmarkBackend')
+        with patch.object(PostmarkPayload, 'set_subject', autospec=True) as mock_set_subject:
+            payload = PostmarkPayload(message, {}, backend)
+        mock_set_subject.assert_called_once_with(payload, 'Subject')
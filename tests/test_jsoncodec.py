@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import sys
+import unittest
+from datetime import datetime
+from decimal import Decimal
+from uuid import UUID
+
+from django.core import mail
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from anymail import jsoncodec
+from anymail.exceptions import AnymailConfigurationError, AnymailSerializationError
+from anymail.jsoncodec import FastJSONCodec, JSONCodec, get_json_codec
+
+from .utils import AnymailTestMixin
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class CompactJSONCodec(FastJSONCodec):
+    """A stand-in 'fast' codec, which can't handle default or non-ascii input"""
+
+    name = "compact"
+
+    def _dumps(self, obj, default):
+        if default is not None:
+            raise TypeError("default not supported")
+        return json.dumps(obj, separators=(',', ':'))
+
+    def _loads(self, s):
+        if not isinstance(s, bytes) or any(c > 127 for c in bytearray(s)):
+            raise ValueError("ascii bytes only")
+        return json.loads(s.decode('ascii'))
+
+
+class JSONCodecTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_json(self):
+        codec = JSONCodec()
+        self.assertEqual(codec.dumps({"a": ["’"]}), '{"a": ["\\u2019"]}')
+        self.assertEqual(codec.loads('{"a": ["\\u2019"]}'), {"a": ["’"]})
+        self.assertEqual(codec.loads('{"a": ["’"]}'.encode('utf-8')), {"a": ["’"]})
+        self.assertEqual(codec.dumps(Decimal("1.5"), default=str), '"1.5"')
+
+    def test_fast_codec_fallback(self):
+        """Anything a fast codec can't handle is retried with json (including its errors)"""
+        codec = CompactJSONCodec()
+        self.assertEqual(codec.dumps({"a": [1, 2]}), '{"a":[1,2]}')
+        self.assertEqual(codec.dumps({"a": Decimal("1.5")}, default=str), '{"a": "1.5"}')
+        with self.assertRaisesRegex(TypeError, "not JSON serializable"):
+            codec.dumps({"a": Decimal("1.5")})
+
+        self.assertEqual(codec.loads(b'{"a":[1,2]}'), {"a": [1, 2]})
+        self.assertEqual(codec.loads('{"a": ["’"]}'), {"a": ["’"]})
+        with self.assertRaises(ValueError):
+            codec.loads(b'{"a":')
+
+    @unittest.skipIf(orjson is None, "orjson not installed")
+    def test_orjson(self):
+        codec = get_json_codec("orjson")
+        self.assertEqual(codec.dumps({"a": ["’"]}), '{"a":["’"]}')
+        self.assertEqual(codec.loads(b'{"a": ["\\u2019"]}'), {"a": ["’"]})
+        self.assertEqual(codec.dumps({"a": Decimal("1.5")}, default=str), '{"a":"1.5"}')
+        self.assertEqual(codec.dumps({1: "int key"}), '{"1": "int key"}')  # (retried with json)
+        # Documented differences from json.dumps:
+        uuid = UUID("d0e2c2a8-7d3b-4a31-a0a4-3a8d0e2b9f6c")
+        self.assertEqual(codec.dumps({"a": uuid}), '{"a":"%s"}' % uuid)
+        self.assertEqual(codec.dumps({"a": float('nan')}), '{"a":null}')
+
+    @unittest.skipIf(ujson is None, "ujson not installed")
+    def test_ujson(self):
+        codec = get_json_codec("ujson")
+        self.assertEqual(json.loads(codec.dumps({"a": ["’"]})), {"a": ["’"]})
+        self.assertEqual(codec.loads(b'{"a": ["\\u2019"]}'), {"a": ["’"]})
+        # Decimals are always numbers (whatever the ujson version, and even if it retries with json):
+        self.assertEqual(json.loads(codec.dumps({"a": Decimal("1.5")}, default=str)), {"a": 1.5})
+        self.assertEqual(json.loads(codec.dumps({"a": Decimal("1.5")})), {"a": 1.5})
+        with patch.object(codec, 'supports_default', False):
+            self.assertEqual(json.loads(codec.dumps({"a": Decimal("1.5")}, default=str)), {"a": 1.5})
+        with self.assertRaisesRegex(TypeError, "not JSON serializable"):
+            codec.dumps({"a": datetime(2017, 1, 2, 3, 4, 5)})
+
+
+class CodecConsistencyTests(SimpleTestCase, AnymailTestMixin):
+    """Codecs must serialize (and fail to serialize) what json.dumps does
+
+    (Apart from the fast libraries' differences documented in their codecs.)
+    """
+
+    # Values json.dumps can't serialize (without a default), but some fast JSON libraries can
+    unserializable_values = [
+        datetime(2017, 1, 2, 3, 4, 5),
+        UUID("d0e2c2a8-7d3b-4a31-a0a4-3a8d0e2b9f6c"),
+        Decimal("1.5"),
+    ]
+
+    # codec name: types that library serializes anyway
+    serialized_anyway = {
+        "orjson": (UUID,),
+        "ujson": (Decimal,),
+    }
+
+    # codecs that don't write non-finite floats the way json.dumps does
+    non_finite_differs = {"orjson", "ujson"}
+
+    def get_codecs(self):
+        codecs = [JSONCodec(), CompactJSONCodec()]
+        if orjson is not None:
+            codecs.append(jsoncodec.OrjsonCodec())
+        if ujson is not None:
+            codecs.append(jsoncodec.UjsonCodec())
+        return codecs
+
+    def test_unserializable_values(self):
+        for codec in self.get_codecs():
+            for value in self.unserializable_values:
+                if isinstance(value, self.serialized_anyway.get(codec.name, ())):
+                    continue
+                with self.assertRaises(TypeError, msg="%s codec serialized %r" % (codec.name, value)):
+                    codec.dumps({"a": [value]})
+                self.assertEqual(json.loads(codec.dumps({"a": [value]}, default=str)), {"a": [str(value)]},
+                                 msg=codec.name)
+
+    def test_non_finite_floats(self):
+        for codec in self.get_codecs():
+            if codec.name in self.non_finite_differs:
+                continue
+            serialized = codec.dumps({"a": [float('nan'), float('inf'), -float('inf')]})
+            self.assertEqual(serialized.replace(" ", ""), '{"a":[NaN,Infinity,-Infinity]}', msg=codec.name)
+
+    def test_serialization_error(self):
+        """A send with unserializable data fails the same way with any codec"""
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        message.esp_extra = {'Metadata': {'sent': datetime(2017, 1, 2, 3, 4, 5)}}
+        for codec in self.get_codecs():
+            connection = mail.get_connection('anymail.backends.postmark.PostmarkBackend',
+                                             server_token='test_server_token')
+            connection.json_codec = codec
+            with self.assertRaisesMessage(AnymailSerializationError, "Don't know how to send this data"):
+                connection.send_messages([message])
+
+
+@patch.dict(jsoncodec._codecs.instances, clear=True)
+class GetJSONCodecTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_default(self):
+        # Python's json, even if faster libraries are installed
+        self.assertIs(type(get_json_codec()), JSONCodec)
+
+    @patch.dict(sys.modules, {'orjson': None, 'ujson': None})  # (makes import fail)
+    def test_auto(self):
+        self.assertIsInstance(get_json_codec("auto"), JSONCodec)
+        self.assertEqual(get_json_codec("auto").name, "json")
+
+    @override_settings(ANYMAIL={'JSON_CODEC': 'json'})
+    def test_setting(self):
+        self.assertEqual(get_json_codec().name, "json")
+
+    @patch.dict(sys.modules, {'orjson': None})
+    def test_not_installed(self):
+        with self.assertRaisesMessage(AnymailConfigurationError, "requires the orjson package"):
+            get_json_codec("orjson")
+
+    @override_settings(ANYMAIL={'JSON_CODEC': 'simplejson', 'POSTMARK_SERVER_TOKEN': 'test_server_token'})
+    def test_unknown(self):
+        with self.assertRaisesMessage(AnymailConfigurationError, "Unknown Anymail JSON_CODEC"):
+            get_json_codec()
+        with self.assertRaises(AnymailConfigurationError):
+            mail.get_connection('anymail.backends.postmark.PostmarkBackend')
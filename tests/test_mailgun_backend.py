@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 from datetime import date, datetime
+from io import BytesIO
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 
@@ -12,8 +13,9 @@ from django.test import SimpleTestCase
 from django.test.utils import override_settings
 from django.utils.timezone import get_fixed_timezone, override as override_current_timezone
 
+from anymail.backends.base_requests import StreamingBody
 from anymail.exceptions import AnymailAPIError, AnymailUnsupportedFeature
-from anymail.message import attach_inline_image_file
+from anymail.message import AnymailFileAttachment, attach_inline_image_file
 
 from .mock_requests_backend import RequestsBackendMockAPITestCase, SessionSharingTestCasesMixin
 from .utils import sample_image_content, sample_image_path, SAMPLE_IMAGE_FILENAME, AnymailTestMixin
@@ -355,6 +357,45 @@ class MailgunBackendAnymailFeatureTests(MailgunBackendMockAPITestCase):
         })
         self.assertEqual(self.message.merge_global_data, {'group': "Users", 'site': "ExampleCo"})
 
+    def test_merge_data_chunked(self):
+        """Batch sends larger than max_batch_size are split into multiple API calls"""
+        self.message.to = ['to%d@example.com' % i for i in range(5)]
+        self.message.cc = ['cc@example.com']
+        self.message.merge_data = {'to%d@example.com' % i: {'n': str(i)} for i in range(5)}
+        connection = mail.get_connection(max_batch_size=2, send_concurrency=3)
+        connection.send_messages([self.message])
+
+        self.assertEqual(len(self.mock_request.call_args_list), 3)  # (call_count isn't thread-safe)
+        calls = sorted([call[1]['data'] for call in self.mock_request.call_args_list],
+                       key=lambda data: data['to'][0])
+        self.assertEqual([data['to'] for data in calls], [
+            ['to0@example.com', 'to1@example.com'],
+            ['to2@example.com', 'to3@example.com'],
+            ['to4@example.com']])
+        self.assertEqual(calls[0]['cc'], ['cc@example.com'])
+        self.assertNotIn('cc', calls[1])
+        self.assertJSONEqual(calls[2]['recipient-variables'], {'to4@example.com': {'n': "4"}})
+
+        status = self.message.anymail_status
+        self.assertEqual(len(status.esp_response), 3)
+        self.assertEqual(set(status.recipients.keys()),
+                         {'to0@example.com', 'to1@example.com', 'to2@example.com', 'to3@example.com',
+                          'to4@example.com', 'cc@example.com'})
+        self.assertEqual(status.status, {'queued'})
+        self.assertEqual(status.response_size, 3 * len(self.DEFAULT_RAW_RESPONSE))  # summed for all chunks
+        self.assertIn('total', status.timings)
+        self.assertIn('post_to_esp', status.timings)
+
+    def test_merge_data_chunk_error(self):
+        self.set_mock_response(status_code=500)
+        self.message.to = ['to%d@example.com' % i for i in range(3)]
+        self.message.merge_data = {}
+        with self.assertRaises(AnymailAPIError):
+            mail.get_connection(max_batch_size=2).send_messages([self.message])
+        self.assertEqual(self.mock_request.call_count, 2)
+        # each chunk's API call is still recorded:
+        self.assertEqual(self.message.anymail_status.response_size, 2 * len(self.DEFAULT_RAW_RESPONSE))
+
     def test_only_merge_global_data(self):
         # Make sure merge_global_data distributed to recipient-variables
         # even when merge_data not set
@@ -463,6 +504,51 @@ class MailgunBackendRecipientsRefusedTests(MailgunBackendMockAPITestCase):
         self.assertEqual(sent, 0)
 
 
+class MailgunBackendStreamingTests(MailgunBackendMockAPITestCase):
+    """Test STREAMING_THRESHOLD"""
+
+    def test_streaming(self):
+        self.message.to = ['to1@example.com', 'Recipient \u2019 <to2@example.com>']
+        self.message.attach("large.bin", bytes(bytearray(range(256))) * 400, "application/octet-stream")
+        self.message.attach("\u2019text.txt", "Unicode \u2019 text", "text/plain")
+        attach_inline_image_file(self.message, sample_image_path())
+        self.message.send()
+        data = self.get_api_call_data()
+        files = self.get_api_call_files()
+
+        self.message.connection = mail.get_connection(streaming_threshold=100000)
+        self.message.send()
+        self.assertIsNone(self.get_api_call_files(required=False))
+        body = self.get_api_call_data()
+        self.assertIsInstance(body, StreamingBody)
+        self.assertEqual(self.get_api_call_headers()['Content-Type'], body.content_type)
+        self.assert_streamed_multipart(body, data, files)
+
+    def test_file_content(self):
+        """File-like attachment content is read in chunks while sending"""
+        fileobj = BytesIO(b"prefix" + bytes(bytearray(range(256))) * 1000)
+        fileobj.read(6)  # content is from the current position
+        self.message.attach("file.bin", fileobj, "application/octet-stream")
+        self.message.connection = mail.get_connection(streaming_threshold=0)
+        self.message.send()
+        body = self.get_api_call_data()
+        self.assertEqual(len(body), len(body.read()))
+        self.assertIn(bytes(bytearray(range(256))) * 1000 + b"\r\n--", b"".join(body))
+
+    def test_file_attachment(self):
+        """File attachments are read in chunks while sending"""
+        self.message.attach(AnymailFileAttachment(sample_image_path()))
+        self.message.send()
+        data = self.get_api_call_data()
+        files = self.get_api_call_files()
+        self.assertEqual(files, [('attachment', (SAMPLE_IMAGE_FILENAME, sample_image_content(), 'image/png'))])
+
+        self.message.connection = mail.get_connection(streaming_threshold=0)
+        self.message.send()
+        body = self.get_api_call_data()
+        self.assert_streamed_multipart(body, data, files)
+
+
 class MailgunBackendSessionSharingTestCase(SessionSharingTestCasesMixin, MailgunBackendMockAPITestCase):
     """Requests session sharing tests"""
     pass  # tests are defined in the mixin
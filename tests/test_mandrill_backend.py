@@ -13,6 +13,7 @@ from django.test import SimpleTestCase
 from django.test.utils import override_settings
 from django.utils.timezone import get_fixed_timezone, override as override_current_timezone
 
+from anymail.backends.base_requests import StreamingBody
 from anymail.exceptions import (AnymailAPIError, AnymailRecipientsRefused,
                                 AnymailSerializationError, AnymailUnsupportedFeature)
 from anymail.message import attach_inline_image
@@ -520,6 +521,23 @@ class MandrillBackendRecipientsRefusedTests(MandrillBackendMockAPITestCase):
         self.assertEqual(sent, 1)  # refused message is included in sent count
 
 
+class MandrillBackendStreamingTests(MandrillBackendMockAPITestCase):
+    """Test STREAMING_THRESHOLD"""
+
+    def test_streaming(self):
+        self.message.attach("large.bin", bytes(bytearray(range(256))) * 400, "application/octet-stream")
+        attach_inline_image(self.message, sample_image_content())
+        self.message.send()
+        expected = self.get_api_call_data()
+
+        self.message.connection = mail.get_connection(streaming_threshold=0)
+        self.message.send()
+        body = self.get_api_call_data()
+        self.assertIsInstance(body, StreamingBody)
+        self.assertEqual(len(body), len(expected))
+        self.assertEqual(body.read(), expected)
+
+
 class MandrillBackendSessionSharingTestCase(SessionSharingTestCasesMixin, MandrillBackendMockAPITestCase):
     """Requests session sharing tests"""
     pass  # tests are defined in the mixin
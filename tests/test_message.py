@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pickle
+import shutil
+import tempfile
+from base64 import b64encode
+from os import path
+
+from django.core import mail
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+from mock import patch
+
+from anymail.message import (AnymailFileAttachment, AnymailInlineImage,
+                             attach_inline_image, attach_inline_image_file)
+from anymail.utils import Attachment
+
+from .utils import AnymailTestMixin, SAMPLE_IMAGE_FILENAME, sample_image_content, sample_image_path
+
+
+class AnymailInlineImageTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(AnymailInlineImageTests, self).setUp()
+        self.content = sample_image_content()
+
+    def test_attach_inline_image(self):
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        cid = attach_inline_image(message, self.content, filename="sample.png")
+        image = message.attachments[0]
+        self.assertIsInstance(image, AnymailInlineImage)
+        self.assertEqual(image.get_content_type(), 'image/png')
+        self.assertEqual(image['Content-ID'], '<%s>' % cid)
+
+    def test_original_content(self):
+        """Anymail Attachments use the image's original content, and a single cached base64 encoding"""
+        image = AnymailInlineImage(self.content)
+        self.assertIsNone(image._anymail_mime_payload)  # not encoded yet
+
+        attachment = Attachment(image, 'utf-8')
+        self.assertIs(attachment.content, self.content)
+        self.assertEqual(attachment.b64content, b64encode(self.content).decode('ascii'))
+        self.assertIs(Attachment(image, 'utf-8').b64content, attachment.b64content)
+        self.assertIsNone(image._anymail_mime_payload)  # still not needed
+
+    def test_mime_payload(self):
+        """The MIME payload is still available (e.g., for Django's SMTP EmailBackend)"""
+        image = AnymailInlineImage(self.content)
+        self.assertEqual(image['Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(image.get_payload(decode=True), self.content)
+        lines = image.get_payload().splitlines()
+        self.assertEqual(max(len(line) for line in lines), 76)
+
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        attach_inline_image(message, self.content)
+        self.assertIn(lines[0], message.message().as_string())
+
+    def test_replaced_payload(self):
+        image = AnymailInlineImage(self.content)
+        image.set_payload("UmVwbGFjZWQ=\n")
+        self.assertIsNone(image.anymail_content)
+        self.assertEqual(Attachment(image, 'utf-8').content, b"Replaced")
+
+    def test_pickle(self):
+        image = pickle.loads(pickle.dumps(AnymailInlineImage(self.content)))
+        self.assertEqual(image.anymail_content, self.content)
+        self.assertEqual(image.get_payload(decode=True), self.content)
+
+
+class AnymailFileAttachmentTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(AnymailFileAttachmentTests, self).setUp()
+        self.path = sample_image_path()
+        self.content = sample_image_content()
+
+    def test_attachment(self):
+        attachment = AnymailFileAttachment(self.path)
+        self.assertEqual(attachment.get_content_type(), 'image/png')  # guessed from filename
+        self.assertEqual(attachment.get_filename(), SAMPLE_IMAGE_FILENAME)
+        self.assertEqual(attachment['Content-Disposition'], 'attachment; filename="%s"' % SAMPLE_IMAGE_FILENAME)
+
+        attachment = AnymailFileAttachment(self.path, filename="renamed.dat", mimetype="image/x-sample")
+        self.assertEqual(attachment.get_content_type(), 'image/x-sample')
+        self.assertEqual(attachment.get_filename(), "renamed.dat")
+
+    def test_read_when_needed(self):
+        """Anymail Attachments don't read the file until the content is used"""
+        with patch('anymail.message.open', create=True, side_effect=open) as mock_open:
+            attachment = Attachment(AnymailFileAttachment(self.path), 'utf-8')
+            self.assertTrue(attachment.is_file)
+            self.assertEqual(attachment.size, len(self.content))
+            self.assertEqual(mock_open.call_count, 0)
+            self.assertEqual(attachment.content, self.content)
+            self.assertEqual(mock_open.call_count, 1)
+        with attachment.open() as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(attachment.b64content, b64encode(self.content).decode('ascii'))
+
+    def test_storage(self):
+        storage = FileSystemStorage(location=path.dirname(self.path))
+        attachment = Attachment(AnymailFileAttachment(SAMPLE_IMAGE_FILENAME, storage=storage), 'utf-8')
+        self.assertEqual(attachment.name, SAMPLE_IMAGE_FILENAME)
+        self.assertEqual(attachment.size, len(self.content))
+        self.assertEqual(attachment.content, self.content)
+
+    def test_mime_payload(self):
+        """The MIME payload is generated from the file when needed (e.g., for Django's SMTP EmailBackend)"""
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        message.attach(AnymailFileAttachment(self.path))
+        attachment = message.attachments[0]
+        self.assertEqual(attachment['Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(attachment.get_payload(decode=True), self.content)
+        lines = attachment.get_payload().splitlines()
+        self.assertEqual(max(len(line) for line in lines), 76)
+        self.assertIn(lines[0], message.message().as_string())
+
+    def test_replaced_payload(self):
+        attachment = AnymailFileAttachment(self.path)
+        attachment.set_payload("UmVwbGFjZWQ=\n")
+        self.assertIsNone(attachment.anymail_path)
+        self.assertFalse(Attachment(attachment, 'utf-8').is_file)
+        self.assertEqual(Attachment(attachment, 'utf-8').content, b"Replaced")
+
+    def test_pickle(self):
+        """Pickling doesn't include the content"""
+        storage = FileSystemStorage(location=path.dirname(self.path))
+        pickled = pickle.dumps(AnymailFileAttachment(SAMPLE_IMAGE_FILENAME, storage=storage))
+        self.assertNotIn(self.content, pickled)
+        self.assertNotIn(b64encode(self.content)[:76], pickled)
+        attachment = pickle.loads(pickled)
+        self.assertEqual(attachment.get_payload(decode=True), self.content)
+
+    def test_attach_inline_image_file(self):
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        cid = attach_inline_image_file(message, self.path)
+        image = message.attachments[0]
+        self.assertIsInstance(image, AnymailFileAttachment)
+        self.assertEqual(image.get_content_type(), 'image/png')
+        self.assertEqual(image['Content-ID'], '<%s>' % cid)
+        attachment = Attachment(image, 'utf-8')
+        self.assertTrue(attachment.inline)
+        self.assertEqual(attachment.cid, cid)
+        self.assertEqual(attachment.name, SAMPLE_IMAGE_FILENAME)
+        self.assertEqual(attachment.content, self.content)
+
+    def test_attach_inline_image_file_subtype(self):
+        # determined from the start of the file's content, else from its filename extension
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        for filename, content, expected_type in [
+            ('photo', b'\xff\xd8\xff\xe0\x00\x10JFIF', 'image/jpeg'),
+            ('logo.png', b'GIF89a\x01\x00\x01\x00', 'image/gif'),  # (content wins)
+            ('logo.svg', b'<svg></svg>', 'image/svg+xml'),
+        ]:
+            image_path = path.join(tempdir, filename)
+            with open(image_path, 'wb') as f:
+                f.write(content)
+            attach_inline_image_file(message, image_path)
+            self.assertEqual(message.attachments[-1].get_content_type(), expected_type)
+
+        with open(path.join(tempdir, 'notes.txt'), 'wb') as f:
+            f.write(b'not an image')
+        with self.assertRaisesMessage(TypeError, "Could not guess image MIME subtype"):
+            attach_inline_image_file(message, path.join(tempdir, 'notes.txt'))
@@ -0,0 +1,108 @@
+import json
+
+from django.core import mail
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import Mock, call
+
+from anymail.exceptions import AnymailAPIError, AnymailConfigurationError
+from anymail.message import AnymailStatus
+from anymail.metrics import StatsdMetricsSink, get_metrics_sink
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+from .utils import AnymailTestMixin
+
+# For the METRICS_SINK import path test:
+metrics_sink = Mock(spec=['__call__'])
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.postmark.PostmarkBackend',
+                   ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token'})
+class SendTimingsTests(RequestsBackendMockAPITestCase):
+    DEFAULT_RAW_RESPONSE = b"""{
+        "To": "to@example.com",
+        "MessageID": "b4007d94-33f1-4e78-a783-97417d6c80e6",
+        "ErrorCode": 0,
+        "Message": "OK"
+    }"""
+
+    def setUp(self):
+        super(SendTimingsTests, self).setUp()
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+
+    def test_timings_and_sizes(self):
+        self.message.send()
+        status = self.message.anymail_status
+        self.assertEqual(set(status.timings), {'build_payload', 'serialize', 'post_to_esp', 'time_to_first_byte',
+                                               'parse_response', 'total'})
+        for seconds in status.timings.values():
+            self.assertGreaterEqual(seconds, 0)
+        self.assertLessEqual(status.timings['serialize'], status.timings['post_to_esp'])
+        self.assertEqual(status.request_size, len(self.get_api_call_data()))
+        self.assertEqual(json.loads(self.get_api_call_data())['To'], "to@example.com")
+        self.assertEqual(status.response_size, len(self.DEFAULT_RAW_RESPONSE))
+
+    def test_metrics_sink(self):
+        sink = Mock(spec=['__call__'])
+        mail.get_connection(metrics_sink=sink).send_messages([self.message])
+        sink.assert_called_once_with(esp_name="Postmark", status=self.message.anymail_status,
+                                     error=None, status_code=200)
+
+    @override_settings(ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token',
+                                'METRICS_SINK': 'tests.test_metrics.metrics_sink'})
+    def test_metrics_sink_setting(self):
+        metrics_sink.reset_mock()
+        self.message.send()
+        metrics_sink.assert_called_once_with(esp_name="Postmark", status=self.message.anymail_status,
+                                             error=None, status_code=200)
+
+    def test_metrics_sink_failed_send(self):
+        sink = Mock(spec=['__call__'])
+        self.set_mock_response(status_code=400, raw=b'{"ErrorCode": 300, "Message": "Invalid email request"}')
+        with self.assertRaises(AnymailAPIError) as cm:
+            mail.get_connection(metrics_sink=sink).send_messages([self.message])
+        sink.assert_called_once_with(esp_name="Postmark", status=self.message.anymail_status,
+                                     error=cm.exception, status_code=400)
+        self.assertIn('time_to_first_byte', self.message.anymail_status.timings)
+        self.assertIn('total', self.message.anymail_status.timings)
+
+    def test_metrics_sink_cancelled_send(self):
+        sink = Mock(spec=['__call__'])
+        self.message.to = []
+        mail.get_connection(metrics_sink=sink).send_messages([self.message])
+        self.assertEqual(sink.call_count, 0)
+
+
+class MetricsSinkTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_statsd_client(self):
+        client = Mock(spec=['timing', 'incr', 'gauge'])
+        sink = get_metrics_sink(client)
+        self.assertIsInstance(sink, StatsdMetricsSink)
+
+        status = AnymailStatus()
+        status.timings = {'post_to_esp': 0.25, 'total': 0.5}
+        status.request_size = 1000
+        status.response_size = 100
+        sink(esp_name="SendGrid", status=status)
+        client.incr.assert_has_calls([call("anymail.sendgrid.sent"),
+                                      call("anymail.sendgrid.request_bytes", 1000),
+                                      call("anymail.sendgrid.response_bytes", 100)])
+        client.timing.assert_has_calls([call("anymail.sendgrid.post_to_esp", 250.0),
+                                        call("anymail.sendgrid.total", 500.0)], any_order=True)
+
+        client.reset_mock()
+        sink(esp_name="SendGrid", status=status, error=AnymailAPIError("Bad request"), status_code=400)
+        client.incr.assert_has_calls([call("anymail.sendgrid.error"), call("anymail.sendgrid.error.400")])
+        self.assertNotIn(call("anymail.sendgrid.sent"), client.incr.call_args_list)
+
+    def test_callable(self):
+        sink = Mock(spec=['__call__'])
+        self.assertIs(get_metrics_sink(sink), sink)
+        self.assertIsNone(get_metrics_sink(None))
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(AnymailConfigurationError, "METRICS_SINK"):
+            get_metrics_sink("tests.test_metrics.no_such_sink")
+        with self.assertRaisesMessage(AnymailConfigurationError, "METRICS_SINK"):
+            get_metrics_sink(object())
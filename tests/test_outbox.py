@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import shutil
+import sqlite3
+import tempfile
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+from os import path
+
+from django.core import mail
+from django.core.management import call_command
+from mock import Mock, patch
+from six import StringIO
+
+from anymail.message import AnymailFileAttachment
+from anymail.outbox import Outbox
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+from .utils import SAMPLE_IMAGE_FILENAME, sample_image_content, sample_image_path
+
+
+class OutboxBackendTests(RequestsBackendMockAPITestCase):
+    """Test queuing messages with the OutboxBackend, and sending them later through Mailgun"""
+
+    DEFAULT_RAW_RESPONSE = b"""{
+        "id": "<20160306015544.116301.25145@example.com>",
+        "message": "Queued. Thank you."
+    }"""
+
+    def setUp(self):
+        super(OutboxBackendTests, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        settings_override = self.settings(
+            EMAIL_BACKEND='anymail.backends.outbox.OutboxBackend',
+            ANYMAIL={
+                'MAILGUN_API_KEY': 'test_api_key',
+                'OUTBOX_PATH': path.join(tempdir, 'outbox.sqlite3'),
+                'OUTBOX_BACKEND': 'anymail.backends.mailgun.MailgunBackend',
+                'OUTBOX_MAX_ATTEMPTS': 2,
+            })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.message = mail.EmailMultiAlternatives('Subject', 'Text Body', 'from@example.com',
+                                                   ['Recipient <to@example.com>'])
+        self.message.attach_alternative('<p>HTML Body</p>', 'text/html')
+
+    def test_send_later(self):
+        sent = self.message.send()
+        self.assertEqual(sent, 1)
+        self.assert_esp_not_called("message should be queued in the outbox")
+        outbox_id = self.message.anymail_status.message_id
+        self.assertEqual(self.message.anymail_status.status, {'queued'})
+        self.assertEqual(self.message.anymail_status.recipients['to@example.com'].message_id, outbox_id)
+
+        outbox = Outbox()
+        self.assertEqual(outbox.get_status(outbox_id)['state'], 'pending')
+        self.assertEqual(outbox.send_pending(), {'sent': 1, 'retrying': 0, 'failed': 0})
+        self.assert_esp_called('/example.com/messages')
+        data = self.get_api_call_data()
+        self.assertEqual(data['to'], ['Recipient <to@example.com>'])
+        self.assertEqual(data['html'], '<p>HTML Body</p>')
+
+        status = outbox.get_status(outbox_id)
+        self.assertEqual(status['state'], 'done')
+        self.assertEqual(status['result']['message_id'], '<20160306015544.116301.25145@example.com>')
+        self.assertEqual(status['result']['recipients']['to@example.com']['status'], 'queued')
+
+        # already sent:
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 0, 'failed': 0})
+        self.assertEqual(self.mock_request.call_count, 1)
+
+    def test_file_attachment(self):
+        """File attachments are stored in the outbox as a reference to the file, not the content"""
+        content = sample_image_content()
+        self.message.attach(AnymailFileAttachment(sample_image_path()))
+        self.message.send()
+        outbox = Outbox()
+        with closing(sqlite3.connect(outbox.spool.path)) as conn:
+            (data,) = conn.execute("SELECT data FROM anymail_outbox").fetchone()
+        self.assertNotIn(content, bytes(data))
+
+        outbox.send_pending()
+        self.assertEqual(self.get_api_call_files(),
+                         [('attachment', (SAMPLE_IMAGE_FILENAME, content, 'image/png'))])
+
+    @patch('time.time', return_value=1000.0)
+    def test_retries(self, mock_time):
+        self.set_mock_response(status_code=503)
+        self.message.send()
+        outbox_id = self.message.anymail_status.message_id
+        outbox = Outbox()
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 1, 'failed': 0})
+        status = outbox.get_status(outbox_id)
+        self.assertEqual(status['state'], 'pending')
+        self.assertEqual(status['attempts'], 1)
+        self.assertEqual(status['available_at'], 1030.0)  # OUTBOX_RETRY_BACKOFF default
+        self.assertIn('503', status['error'])
+
+        # not ready to retry yet:
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 0, 'failed': 0})
+
+        mock_time.return_value = 1031.0
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 0, 'failed': 1})  # OUTBOX_MAX_ATTEMPTS
+        self.assertEqual(outbox.get_status(outbox_id)['state'], 'failed')
+        self.assertEqual(self.mock_request.call_count, 2)
+
+    @patch('time.time', return_value=1000.0)
+    def test_expired_lease(self, mock_time):
+        """Only the worker holding an item's current lease can record its result"""
+        self.message.send()
+        outbox_id = self.message.anymail_status.message_id
+        spool = Outbox().spool
+        stale_item = spool.claim(lease_seconds=300)[0]
+        mock_time.return_value = 1301.0  # lease has expired...
+        current_item = spool.claim(lease_seconds=300)[0]  # ... so another worker claims it
+        self.assertEqual(current_item.id, stale_item.id)
+
+        self.assertFalse(spool.complete(stale_item, result={'message_id': 'stale'}))
+        self.assertEqual(spool.get(outbox_id)['state'], 'claimed')
+        self.assertTrue(spool.complete(current_item, result={'message_id': 'current'}))
+        self.assertEqual(spool.get(outbox_id)['result'], {'message_id': 'current'})
+        self.assertFalse(spool.retry(stale_item, 30))
+        self.assertEqual(spool.get(outbox_id)['state'], 'done')
+
+    def test_concurrent_sends_finish(self):
+        """send_pending waits for all its sending threads"""
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(3)]
+        mail.get_connection().send_messages(messages)
+        pools = []
+
+        def make_pool(processes):
+            pool = ThreadPool(processes)
+            pool.join = Mock(wraps=pool.join)
+            pools.append(pool)
+            return pool
+
+        with patch('anymail.outbox.ThreadPool', side_effect=make_pool):
+            Outbox().send_pending(concurrency=2)
+        self.assertEqual(len(pools), 1)
+        pools[0].join.assert_called_once_with()
+
+    def test_unsendable_message(self):
+        """Errors in the message itself aren't retried"""
+        self.message.attach_alternative('<p>Second HTML Body</p>', 'text/html')  # unsupported by Mailgun
+        self.message.send()
+        outbox_id = self.message.anymail_status.message_id
+        outbox = Outbox()
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 0, 'failed': 1})
+        self.assert_esp_not_called()
+        status = outbox.get_status(outbox_id)
+        self.assertEqual(status['state'], 'failed')
+        self.assertIn('multiple html parts', status['error'])
+
+    def test_rejected_message(self):
+        """ESP API errors that aren't from the ESP being unavailable aren't retried"""
+        self.set_mock_response(status_code=400, raw=b"Invalid from address")
+        self.message.send()
+        outbox_id = self.message.anymail_status.message_id
+        outbox = Outbox()
+        self.assertEqual(outbox.send_pending(), {'sent': 0, 'retrying': 0, 'failed': 1})
+        status = outbox.get_status(outbox_id)
+        self.assertEqual(status['state'], 'failed')
+        self.assertEqual(status['attempts'], 1)
+        self.assertIn('400', status['error'])
+
+    @patch('anymail.outbox.logger')  # (quiet expected error)
+    def test_unexpected_error(self, mock_logger):
+        self.mock_request.side_effect = ValueError("unexpected")
+        self.message.send()
+        self.assertEqual(Outbox().send_pending(), {'sent': 0, 'retrying': 0, 'failed': 1})
+        self.assertEqual(mock_logger.exception.call_count, 1)
+
+    def test_management_command(self):
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(5)]
+        mail.get_connection().send_messages(messages)
+        stdout = StringIO()
+        call_command('anymail_send_outbox', once=True, batch_size=2, concurrency=2, stdout=stdout)
+        self.assertEqual(len(self.mock_request.call_args_list), 5)  # (call_count isn't thread-safe)
+        for message in messages:
+            self.assertEqual(Outbox().get_status(message.anymail_status.message_id)['state'], 'done')
+        self.assertIn("Sent 2, retrying 0, failed 0", stdout.getvalue())
@@ -2,6 +2,7 @@
 
 from __future__ import unicode_literals
 
+import json
 from base64 import b64encode
 from decimal import Decimal
 from email.mime.base import MIMEBase
@@ -11,10 +12,13 @@ from django.core import mail
 from django.core.exceptions import ImproperlyConfigured
 from django.test import SimpleTestCase
 from django.test.utils import override_settings
+from mock import patch
 
+from anymail.backends.base_requests import StreamingBody
 from anymail.exceptions import (AnymailAPIError, AnymailSerializationError,
                                 AnymailUnsupportedFeature, AnymailRecipientsRefused)
-from anymail.message import attach_inline_image_file
+from anymail.jsoncodec import JSONCodec
+from anymail.message import AnymailFileAttachment, attach_inline_image, attach_inline_image_file
 
 from .mock_requests_backend import RequestsBackendMockAPITestCase, SessionSharingTestCasesMixin
 from .utils import sample_image_content, sample_image_path, SAMPLE_IMAGE_FILENAME, AnymailTestMixin, decode_att
@@ -334,7 +338,6 @@ class PostmarkBackendAnymailFeatureTests(PostmarkBackendMockAPITestCase):
 
     def test_template(self):
         self.message.template_id = 1234567
-        # Postmark doesn't support per-recipient merge_data
         self.message.merge_global_data = {'name': "Alice", 'group': "Developers"}
         self.message.send()
         self.assert_esp_called('/email/withTemplate/')
@@ -343,11 +346,76 @@ class PostmarkBackendAnymailFeatureTests(PostmarkBackendMockAPITestCase):
         self.assertEqual(data['TemplateModel'], {'name': "Alice", 'group': "Developers"})
 
     def test_merge_data(self):
+        self.set_mock_response(raw=b"""[{
+            "ErrorCode": 0, "Message": "OK", "MessageID": "b7bc2f4a-e38e-4336-af7d-e6c392c2f817",
+            "SubmittedAt": "2016-03-12T15:27:50.4468803-05:00", "To": "alice@example.com"
+        }, {
+            "ErrorCode": 0, "Message": "OK", "MessageID": "e2ecbbfc-fe12-463d-b933-9fe22915106d",
+            "SubmittedAt": "2016-03-12T15:27:50.4468803-05:00", "To": "bob@example.com"
+        }]""")
+        self.message.to = ['alice@example.com', 'Bob <bob@example.com>']
+        self.message.cc = ['cc@example.com']
+        self.message.template_id = 1234567
         self.message.merge_data = {
             'alice@example.com': {'name': "Alice", 'group': "Developers"},
+            'bob@example.com': {'name': "Bob"},  # and leave group undefined
         }
-        with self.assertRaisesMessage(AnymailUnsupportedFeature, 'merge_data'):
-            self.message.send()
+        self.message.merge_global_data = {'group': "Users", 'site': "ExampleCo"}
+        self.message.send()
+
+        self.assert_esp_called('/email/batchWithTemplates')
+        messages = self.get_api_call_json()['Messages']
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]['To'], 'alice@example.com')
+        self.assertEqual(messages[0]['Cc'], 'cc@example.com')
+        self.assertEqual(messages[0]['TemplateId'], 1234567)
+        self.assertEqual(messages[0]['TemplateModel'], {'name': "Alice", 'group': "Developers", 'site': "ExampleCo"})
+        self.assertEqual(messages[1]['To'], 'Bob <bob@example.com>')
+        self.assertNotIn('Cc', messages[1])  # cc only gets first copy
+        self.assertEqual(messages[1]['TemplateModel'], {'name': "Bob", 'group': "Users", 'site': "ExampleCo"})
+
+        recipients = self.message.anymail_status.recipients
+        self.assertEqual(recipients['alice@example.com'].message_id, "b7bc2f4a-e38e-4336-af7d-e6c392c2f817")
+        self.assertEqual(recipients['cc@example.com'].message_id, "b7bc2f4a-e38e-4336-af7d-e6c392c2f817")
+        self.assertEqual(recipients['bob@example.com'].message_id, "e2ecbbfc-fe12-463d-b933-9fe22915106d")
+        self.assertEqual(self.message.anymail_status.status, {'sent'})
+
+    def test_merge_data_partial_failure(self):
+        self.set_mock_response(raw=b"""[{
+            "ErrorCode": 0, "Message": "OK", "MessageID": "b7bc2f4a-e38e-4336-af7d-e6c392c2f817"
+        }, {
+            "ErrorCode": 1101, "Message": "Template 1234567 not found"
+        }]""")
+        self.message.to = ['alice@example.com', 'bob@example.com']
+        self.message.template_id = 1234567
+        self.message.merge_data = {}
+        self.message.send()
+        self.assertEqual(self.message.anymail_status.recipients['alice@example.com'].status, 'sent')
+        self.assertEqual(self.message.anymail_status.recipients['bob@example.com'].status, 'failed')
+
+    def test_merge_data_chunked(self):
+        """Batch sends with more "to" emails than the batch API allows are split into multiple calls"""
+        self.set_mock_response(raw=b"""[
+            {"ErrorCode": 0, "Message": "OK", "MessageID": "id1"},
+            {"ErrorCode": 0, "Message": "OK", "MessageID": "id2"}
+        ]""")
+        self.message.to = ['to1@example.com', 'to2@example.com', 'to3@example.com', 'to4@example.com']
+        self.message.bcc = ['bcc@example.com']
+        self.message.template_id = 1234567
+        self.message.merge_data = {'to3@example.com': {'name': "Three"}}
+        connection = mail.get_connection()
+        connection.max_batch_size = 2
+        connection.send_messages([self.message])
+
+        self.assertEqual(self.mock_request.call_count, 2)
+        messages = self.get_api_call_json()['Messages']
+        self.assertEqual([message['To'] for message in messages], ['to3@example.com', 'to4@example.com'])
+        self.assertEqual(messages[0]['TemplateModel'], {'name': "Three"})
+        self.assertNotIn('Bcc', messages[0])
+        self.assertEqual(len(self.message.anymail_status.esp_response), 2)
+        self.assertEqual(set(self.message.anymail_status.recipients.keys()),
+                         {'to1@example.com', 'to2@example.com', 'to3@example.com', 'to4@example.com',
+                          'bcc@example.com'})
 
     def test_missing_subject(self):
         """Make sure a missing subject omits Subject from API call.
@@ -541,6 +609,258 @@ class PostmarkBackendRecipientsRefusedTests(PostmarkBackendMockAPITestCase):
         self.assertEqual(status.recipients['spam@example.com'].status, 'rejected')
 
 
+class PostmarkBackendStreamingTests(PostmarkBackendMockAPITestCase):
+    """Test STREAMING_THRESHOLD"""
+
+    def setUp(self):
+        super(PostmarkBackendStreamingTests, self).setUp()
+        self.message.attach("large.bin", bytes(bytearray(range(256))) * 400 + b"odd", "application/octet-stream")
+        self.message.attach("text.txt", "Unicode \u2019 text", "text/plain")
+        attach_inline_image(self.message, sample_image_content())
+
+    def sent_body(self, **connection_kwargs):
+        self.message.connection = mail.get_connection(**connection_kwargs)
+        self.message.send()
+        return self.get_api_call_data()
+
+    def test_streaming(self):
+        expected = self.sent_body()  # without streaming
+        body = self.sent_body(streaming_threshold=100000)
+        self.assertIsInstance(body, StreamingBody)
+        self.assertEqual(len(body), len(expected))
+        self.assertEqual(b"".join(body), expected)
+        self.assertEqual(body.read(), expected)  # (reading restarts the stream)
+
+        body.seek(0)
+        chunks = [body.read(1000) for _ in range(len(expected) // 1000 + 1)]
+        self.assertEqual(b"".join(chunks), expected)
+        self.assertEqual(body.read(1000), b"")
+
+    def test_below_threshold(self):
+        expected = self.sent_body()
+        self.assertEqual(self.sent_body(streaming_threshold=1000000), expected)
+
+    def test_file_attachment(self):
+        """File attachments are read only while the body is sent"""
+        self.message.attach(AnymailFileAttachment(sample_image_path()))
+        expected = self.sent_body()
+        with patch('anymail.message.open', create=True, side_effect=open) as mock_open:
+            body = self.sent_body(streaming_threshold=0)
+            self.assertEqual(mock_open.call_count, 0)
+            self.assertEqual(body.read(), expected)
+            self.assertEqual(mock_open.call_count, 1)
+
+    @patch('time.sleep')
+    def test_streaming_retry(self, mock_sleep):
+        """A retried request resends the entire body"""
+        bodies = []
+
+        def mock_request(session, **kwargs):
+            bodies.append(kwargs['data'].read())
+            return self.MockResponse(503 if len(bodies) == 1 else 200, self.DEFAULT_RAW_RESPONSE)
+        self.mock_request.side_effect = mock_request
+        self.message.connection = mail.get_connection(streaming_threshold=0, send_retries=1)
+        self.message.send()
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual(json.loads(bodies[1].decode('ascii'))['Attachments'][0]['Name'], "large.bin")
+
+    def test_streaming_batch(self):
+        messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(2)]
+        messages[1].attach("large.bin", b"x" * 1000, "application/octet-stream")
+        self.set_mock_response(raw=b"""[{"ErrorCode": 0, "Message": "OK", "MessageID": "id1"},
+                                        {"ErrorCode": 0, "Message": "OK", "MessageID": "id2"}]""")
+        mail.get_connection(batch_send=True, streaming_threshold=100).send_messages(messages)
+        body = self.get_api_call_data()
+        self.assertIsInstance(body, StreamingBody)
+        data = json.loads(b"".join(body).decode('ascii'))
+        self.assertEqual(len(data), 2)
+        self.assertEqual(decode_att(data[1]['Attachments'][0]['Content']), b"x" * 1000)
+
+    def test_non_ascii(self):
+        """Streamed bodies are utf-8, for JSON codecs that don't escape non-ascii characters"""
+        class UnescapedJSONCodec(JSONCodec):
+            def dumps(self, obj, default=None):
+                return json.dumps(obj, default=default, ensure_ascii=False)
+
+        self.message.subject = "Caf\u00e9 \u2019"
+        self.message.connection = mail.get_connection()  # (not streamed: str bodies are sent as utf-8, too)
+        self.message.connection.json_codec = UnescapedJSONCodec()
+        self.message.send()
+        self.assertEqual(json.loads(self.get_api_call_data().decode('utf-8'))['Subject'], "Caf\u00e9 \u2019")
+
+        self.message.connection = mail.get_connection(streaming_threshold=0)
+        self.message.connection.json_codec = UnescapedJSONCodec()
+        self.message.send()
+        body = self.get_api_call_data()
+        self.assertIsInstance(body, StreamingBody)
+        raw = b"".join(body)
+        self.assertEqual(len(body), len(raw))
+        self.assertEqual(json.loads(raw.decode('utf-8'))['Subject'], "Caf\u00e9 \u2019")
+
+        # and batches:
+        messages = [mail.EmailMessage('Caf\u00e9 %d' % i, 'Body', 'from@example.com', ['to@example.com'])
+                    for i in range(2)]
+        messages[1].attach("large.bin", b"x" * 1000, "application/octet-stream")
+        self.set_mock_response(raw=b"""[{"ErrorCode": 0, "Message": "OK", "MessageID": "id1"},
+                                        {"ErrorCode": 0, "Message": "OK", "MessageID": "id2"}]""")
+        connection = mail.get_connection(batch_send=True, streaming_threshold=100)
+        connection.json_codec = UnescapedJSONCodec()
+        connection.send_messages(messages)
+        body = self.get_api_call_data()
+        raw = b"".join(body)
+        self.assertEqual(len(body), len(raw))
+        self.assertEqual([data['Subject'] for data in json.loads(raw.decode('utf-8'))], ["Caf\u00e9 0", "Caf\u00e9 1"])
+
+
+@override_settings(ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token', 'POSTMARK_BATCH_SEND': True})
+class PostmarkBackendBatchSendTests(PostmarkBackendMockAPITestCase):
+    """Test sending multiple messages through Postmark's batch API"""
+
+    DEFAULT_RAW_RESPONSE = b"""[{
+        "ErrorCode": 0, "Message": "OK", "MessageID": "b7bc2f4a-e38e-4336-af7d-e6c392c2f817",
+        "SubmittedAt": "2010-11-26T12:01:05.1794748-05:00", "To": "to1@example.com"
+    }, {
+        "ErrorCode": 406, "Message": "You tried to send to a recipient that has been marked as inactive."
+    }, {
+        "ErrorCode": 0, "Message": "OK", "MessageID": "e2ecbbfc-fe12-463d-b933-9fe22915106d",
+        "SubmittedAt": "2010-11-26T12:01:05.1794748-05:00", "To": "to3@example.com"
+    }]"""
+
+    def setUp(self):
+        super(PostmarkBackendBatchSendTests, self).setUp()
+        self.messages = [
+            mail.EmailMessage('Subject %d' % i, 'Body %d' % i, 'from@example.com', ['to%d@example.com' % i])
+            for i in (1, 2, 3)
+        ]
+
+    def test_batch_send(self):
+        sent = mail.get_connection(fail_silently=True).send_messages(self.messages)
+        self.assertEqual(sent, 2)
+        self.assertEqual(self.mock_request.call_count, 1)
+        self.assert_esp_called('/email/batch')
+        self.assertEqual(self.get_api_call_headers()["X-Postmark-Server-Token"], "test_server_token")
+        data = self.get_api_call_json()
+        self.assertEqual([item['To'] for item in data], ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+        self.assertEqual(data[0]['Subject'], 'Subject 1')
+
+        # response items are matched to the corresponding message
+        self.assertEqual(self.messages[0].anymail_status.status, {'sent'})
+        self.assertEqual(self.messages[0].anymail_status.message_id, "b7bc2f4a-e38e-4336-af7d-e6c392c2f817")
+        self.assertEqual(self.messages[1].anymail_status.recipients['to2@example.com'].status, 'rejected')
+        self.assertEqual(self.messages[2].anymail_status.message_id, "e2ecbbfc-fe12-463d-b933-9fe22915106d")
+        for message in self.messages:
+            self.assertEqual(message.anymail_status.esp_response.status_code, 200)
+
+    @patch('time.sleep')
+    def test_batch_send_retries(self, mock_sleep):
+        """A retried batch call is recorded on each message in the batch"""
+        success = self.mock_request.return_value
+        self.mock_request.side_effect = [self.MockResponse(429, b"Rate limit exceeded"), success]
+        mail.get_connection(fail_silently=True, send_retries=1).send_messages(self.messages)
+        self.assertEqual(self.mock_request.call_count, 2)
+        for message in self.messages:
+            self.assertEqual(message.anymail_status.retries, 1)
+            self.assertEqual(message.anymail_status.retry_delay, mock_sleep.call_args[0][0])
+
+    def test_batch_send_error(self):
+        """Without fail_silently, an error for any message is raised after the batch is sent"""
+        with self.assertRaises(AnymailRecipientsRefused) as cm:
+            mail.get_connection().send_messages(self.messages)
+        self.assertEqual(cm.exception.email_message, self.messages[1])
+        self.assertEqual(self.messages[2].anymail_status.status, {'sent'})
+
+    def test_batch_send_api_failure(self):
+        self.set_mock_response(status_code=500)
+        sent = mail.get_connection(fail_silently=True).send_messages(self.messages)
+        self.assertEqual(sent, 0)
+        with self.assertRaises(AnymailAPIError):
+            mail.get_connection().send_messages(self.messages)
+
+    def test_batch_send_chunks(self):
+        self.set_mock_response(raw=b'[{"ErrorCode": 0, "Message": "OK", "MessageID": "abc"}]')
+        connection = mail.get_connection()
+        connection.max_batch_size = 1
+        connection.send_messages(self.messages)
+        self.assertEqual(self.mock_request.call_count, 3)
+        self.assert_esp_called('/email/batch')
+
+    def test_batch_send_chunks_by_size(self):
+        """Batches are also split to stay within Postmark's batch request size limit"""
+        self.messages[0].attach("large.bin", b"x" * 3000, "application/octet-stream")
+        ok = b'{"ErrorCode": 0, "Message": "OK", "MessageID": "abc"}'
+        self.mock_request.side_effect = [self.MockResponse(raw=b'[' + ok + b']'),
+                                         self.MockResponse(raw=b'[' + ok + b', ' + ok + b']')]
+        connection = mail.get_connection()
+        connection.max_batch_payload_size = 3000
+        connection.send_messages(self.messages)
+        # the large message is sent on its own (Postmark will decide whether it's too large), the others together:
+        bodies = [call[1]['data'] for call in self.mock_request.call_args_list]
+        self.assertEqual([[item['To'] for item in json.loads(body.decode('utf-8'))] for body in bodies],
+                         [['to1@example.com'], ['to2@example.com', 'to3@example.com']])
+        self.assertLessEqual(len(bodies[1]), 3000)
+
+    def test_templates_sent_individually(self):
+        self.messages[1].template_id = 1234
+        self.messages[1].merge_global_data = {'name': "Alice"}
+        self.mock_request.side_effect = [
+            self.MockResponse(raw=b'{"ErrorCode": 0, "Message": "OK", "MessageID": "abc"}'),
+            self.MockResponse(raw=b'[{"ErrorCode": 0, "Message": "OK", "MessageID": "def"}, '
+                                  b'{"ErrorCode": 0, "Message": "OK", "MessageID": "ghi"}]'),
+        ]
+        sent = mail.get_connection().send_messages(self.messages)
+        self.assertEqual(sent, 3)
+        self.assertEqual(self.messages[1].anymail_status.message_id, "abc")
+        self.assertEqual(self.mock_request.call_count, 2)
+        self.assertTrue(self.mock_request.call_args_list[0][1]['url'].endswith('/email/withTemplate/'))
+        self.assert_esp_called('/email/batch')
+        self.assertEqual(len(self.get_api_call_json()), 2)
+
+    def test_batch_timings_and_sizes(self):
+        """Each batched message gets its own build timings, and the batch API call's"""
+        mail.get_connection(fail_silently=True).send_messages(self.messages)
+        request_size = len(self.get_api_call_data())
+        for message in self.messages:
+            status = message.anymail_status
+            self.assertEqual(set(status.timings), {'build_payload', 'serialize', 'post_to_esp', 'time_to_first_byte',
+                                                   'parse_response', 'total'})
+            self.assertGreaterEqual(status.timings['total'], status.timings['post_to_esp'])
+            self.assertEqual(status.request_size, request_size)
+            self.assertEqual(status.response_size, len(self.DEFAULT_RAW_RESPONSE))
+
+    def test_payloads_built_once(self):
+        self.messages[1].template_id = 1234
+        self.mock_request.side_effect = [
+            self.MockResponse(raw=b'{"ErrorCode": 0, "Message": "OK", "MessageID": "abc"}'),
+            self.MockResponse(raw=b'[{"ErrorCode": 0, "Message": "OK", "MessageID": "def"}, '
+                                  b'{"ErrorCode": 0, "Message": "OK", "MessageID": "ghi"}]'),
+        ]
+        connection = mail.get_connection()
+        with patch.object(connection, 'build_message_payload',
+                          wraps=connection.build_message_payload) as mock_build:
+            connection.send_messages(self.messages)
+        self.assertEqual(mock_build.call_count, 3)
+
+    def test_is_batchable(self):
+        """is_batchable agrees with the API endpoint the message's payload would use"""
+        connection = mail.get_connection()
+        message = self.messages[0]
+        cases = [
+            {}, {'template_id': 1234}, {'merge_global_data': {'name': "Alice"}},
+            {'merge_data': {'to1@example.com': {'name': "Alice"}}}, {'esp_extra': {'TemplateId': 1234}},
+            {'esp_extra': {'TrackLinks': "HtmlOnly"}},
+        ]
+        for attrs in cases:
+            for attr in ('template_id', 'merge_global_data', 'merge_data', 'esp_extra'):
+                if hasattr(message, attr):
+                    delattr(message, attr)
+            for attr, value in attrs.items():
+                setattr(message, attr, value)
+            payload = connection.build_message_payload(message, connection.send_defaults)
+            self.assertEqual(connection.is_batchable(message), payload.get_api_endpoint() == "email", attrs)
+
+
 class PostmarkBackendSessionSharingTestCase(SessionSharingTestCasesMixin, PostmarkBackendMockAPITestCase):
     """Requests session sharing tests"""
     pass  # tests are defined in the mixin
@@ -0,0 +1,195 @@
+import base64
+import json
+
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import Mock
+
+from anymail import metrics
+from anymail.exceptions import AnymailAPIError, AnymailRecipientsRefused
+from anymail.metrics import Counter, Histogram, MetricsRegistry
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+from .utils import AnymailTestMixin
+from .webhook_cases import WebhookTestCase
+
+
+class MetricsRegistryTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_counter(self):
+        counter = Counter("test_total", "Test counter", labels=("esp",))
+        counter.inc(("SendGrid",))
+        counter.inc(("SendGrid",), 2)
+        self.assertEqual(counter.get(("SendGrid",)), 3)
+        self.assertEqual(counter.get(("Mailgun",)), 0)
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)  # (buckets are inclusive upper bounds)
+        histogram.observe(5.0)
+        self.assertEqual(histogram.get(), (3, 5.15))
+        self.assertEqual(list(histogram.samples()), [
+            ("test_seconds_bucket", '{le="0.1"}', 2),
+            ("test_seconds_bucket", '{le="1.0"}', 2),
+            ("test_seconds_bucket", '{le="+Inf"}', 3),
+            ("test_seconds_sum", "", 5.15),
+            ("test_seconds_count", "", 3),
+        ])
+
+    def test_exposition(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("test_total", "Test counter", labels=("esp", "status"))
+        histogram = registry.histogram("test_seconds", "Test histogram", labels=("esp",), buckets=(1.0,))
+        counter.inc(("Post\"mark", "sent"))
+        histogram.observe(0.5, ("Postmark",))
+        self.assertEqual(registry.exposition(), "\n".join([
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{esp="Post\\"mark",status="sent"} 1',
+            '# HELP test_seconds Test histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{esp="Postmark",le="1.0"} 1',
+            'test_seconds_bucket{esp="Postmark",le="+Inf"} 1',
+            'test_seconds_sum{esp="Postmark"} 0.5',
+            'test_seconds_count{esp="Postmark"} 1',
+        ]) + "\n")
+
+        registry.clear()
+        self.assertNotIn("test_total{", registry.exposition())
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.postmark.PostmarkBackend',
+                   ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token'})
+class SendMetricsTests(RequestsBackendMockAPITestCase):
+    DEFAULT_RAW_RESPONSE = b"""{
+        "To": "to@example.com",
+        "MessageID": "b4007d94-33f1-4e78-a783-97417d6c80e6",
+        "ErrorCode": 0,
+        "Message": "OK"
+    }"""
+
+    def setUp(self):
+        super(SendMetricsTests, self).setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+
+    def test_sent(self):
+        self.message.send()
+        self.assertEqual(metrics.send_total.get(("Postmark", "sent", "200")), 1)
+        count, total = metrics.send_duration.get(("Postmark",))
+        self.assertEqual(count, 1)
+        self.assertEqual(total, self.message.anymail_status.timings['total'])
+
+    def test_api_error(self):
+        self.set_mock_response(status_code=500)
+        with self.assertRaises(AnymailAPIError):
+            self.message.send()
+        self.assertEqual(metrics.send_total.get(("Postmark", "error", "500")), 1)
+
+    def test_api_error_fail_silently(self):
+        self.set_mock_response(status_code=500)
+        self.message.send(fail_silently=True)
+        self.assertEqual(metrics.send_total.get(("Postmark", "error", "500")), 1)
+
+    def test_rejected(self):
+        self.set_mock_response(
+            status_code=422,
+            raw=b'{"ErrorCode":406,'
+                b'"Message":"You tried to send to a recipient that has been marked as inactive.\\n'
+                b'Found inactive addresses: to@example.com."}')
+        with self.assertRaises(AnymailRecipientsRefused):
+            self.message.send()
+        self.assertEqual(metrics.send_total.get(("Postmark", "rejected", "422")), 1)
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.postmark.PostmarkBackend',
+                   ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token', 'POSTMARK_BATCH_SEND': True})
+class BatchSendMetricsTests(RequestsBackendMockAPITestCase):
+    """Postmark's batch_send path records each message's metrics"""
+
+    DEFAULT_RAW_RESPONSE = b"""[
+        {"To": "to1@example.com", "MessageID": "id1", "ErrorCode": 0, "Message": "OK"},
+        {"ErrorCode": 406, "Message": "You tried to send to a recipient that has been marked as inactive."},
+        {"To": "to3@example.com", "MessageID": "id3", "ErrorCode": 0, "Message": "OK"}
+    ]"""
+
+    def setUp(self):
+        super(BatchSendMetricsTests, self).setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.messages = [mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to%d@example.com' % i])
+                         for i in (1, 2, 3)]
+
+    def test_batch_send(self):
+        sink = Mock(spec=['__call__'])
+        mail.get_connection(fail_silently=True, metrics_sink=sink).send_messages(self.messages)
+        self.assert_esp_called('/email/batch')
+        self.assertEqual(metrics.send_total.get(("Postmark", "sent", "200")), 2)
+        self.assertEqual(metrics.send_total.get(("Postmark", "rejected", "200")), 1)
+        self.assertEqual(metrics.send_duration.get(("Postmark",))[0], 3)
+        self.assertEqual(sink.call_count, 3)
+
+    def test_batch_api_error(self):
+        sink = Mock(spec=['__call__'])
+        self.set_mock_response(status_code=500)
+        mail.get_connection(fail_silently=True, metrics_sink=sink).send_messages(self.messages)
+        self.assertEqual(metrics.send_total.get(("Postmark", "error", "500")), 3)
+        self.assertEqual(metrics.send_duration.get(("Postmark",))[0], 3)  # (failed sends are timed, too)
+        self.assertEqual([kwargs['status_code'] for args, kwargs in sink.call_args_list], [500, 500, 500])
+
+
+class WebhookMetricsTests(WebhookTestCase):
+
+    def setUp(self):
+        super(WebhookMetricsTests, self).setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+
+    def test_webhook_metrics(self):
+        webhook = reverse('sendgrid_tracking_webhook')
+        response = self.client.post(webhook, content_type='application/json', data=json.dumps([
+            {"email": "bounce@example.com", "event": "bounce", "timestamp": 1461095250},
+            {"email": "one@example.com", "event": "delivered", "timestamp": 1461095250},
+            {"email": "two@example.com", "event": "delivered", "timestamp": 1461095250},
+        ]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.webhook_events_total.get(("SendGrid", "bounced")), 1)
+        self.assertEqual(metrics.webhook_events_total.get(("SendGrid", "delivered")), 2)
+        self.assertEqual(metrics.webhook_parse_duration.get(("SendGrid",))[0], 1)
+        self.assertEqual(metrics.webhook_dispatch_duration.get(("SendGrid",))[0], 1)
+
+
+class MetricsViewTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(MetricsViewTests, self).setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        self.url = reverse('metrics')
+
+    def test_disabled_by_default(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(ANYMAIL={'METRICS_VIEW': True})
+    def test_exposition(self):
+        metrics.send_total.inc(("SendGrid", "sent", "200"))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertIn('anymail_send_total{esp="SendGrid",outcome="sent",status_code="200"} 1\n',
+                      response.content.decode('utf-8'))
+
+    @override_settings(ANYMAIL={'METRICS_VIEW': True, 'METRICS_AUTHORIZATION': 'scraper:secret'})
+    def test_authorization(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('WWW-Authenticate', response)
+
+        credentials = base64.b64encode(b"scraper:secret").decode('ascii')
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Basic " + credentials)
+        self.assertEqual(response.status_code, 200)
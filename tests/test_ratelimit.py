@@ -0,0 +1,81 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from anymail.exceptions import AnymailConfigurationError
+from anymail.ratelimit import CacheRateLimiter, LocalRateLimiter, parse_rate
+
+from .utils import AnymailTestMixin
+
+
+class ParseRateTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate(20), 20.0)
+        self.assertEqual(parse_rate(0.5), 0.5)
+        self.assertEqual(parse_rate("20/s"), 20.0)
+        self.assertEqual(parse_rate("600/m"), 10.0)
+        self.assertEqual(parse_rate("7200 / hour"), 2.0)
+
+    def test_invalid_rate(self):
+        for rate in ["20", "20/fortnight", "fast/s", 0, "-1/s"]:
+            with self.assertRaises(AnymailConfigurationError):
+                parse_rate(rate)
+
+
+@patch('time.time', return_value=1000.0)
+class LocalRateLimiterTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(LocalRateLimiterTests, self).setUp()
+        self.limiter = LocalRateLimiter()
+
+    def test_rate(self, mock_time):
+        self.assertEqual([self.limiter.acquire('key', 2, 1) for _ in range(4)], [0, 0.5, 1.0, 1.5])
+        # other keys have separate buckets:
+        self.assertEqual(self.limiter.acquire('other', 2, 1), 0)
+
+    def test_burst(self, mock_time):
+        self.assertEqual([self.limiter.acquire('key', 2, 3) for _ in range(5)], [0, 0, 0, 0.5, 1.0])
+
+    def test_refill(self, mock_time):
+        for _ in range(3):
+            self.limiter.acquire('key', 2, 3)
+        mock_time.return_value = 1001.0  # refills two tokens
+        self.assertEqual([self.limiter.acquire('key', 2, 3) for _ in range(3)], [0, 0, 0.5])
+        mock_time.return_value = 1010.0  # full bucket (no more than burst tokens)
+        self.assertEqual([self.limiter.acquire('key', 2, 3) for _ in range(4)], [0, 0, 0, 0.5])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'anymail-ratelimit-tests'}})
+@patch('time.time', return_value=1000.25)
+class CacheRateLimiterTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(CacheRateLimiterTests, self).setUp()
+        self.limiter = CacheRateLimiter()
+        self.addCleanup(caches['default'].clear)
+
+    def test_windows(self, mock_time):
+        # window is burst/rate = 1 second, starting at 1000.0:
+        self.assertEqual([self.limiter.acquire('key', 2, 2) for _ in range(5)], [0, 0, 0.75, 0.75, 1.75])
+        self.assertEqual(self.limiter.acquire('other', 2, 2), 0)
+
+    def test_shared_budget(self, mock_time):
+        # separate limiters (e.g., in other processes) share the budget in the cache
+        other_limiter = CacheRateLimiter()
+        self.assertEqual(self.limiter.acquire('key', 1, 1), 0)
+        self.assertEqual(other_limiter.acquire('key', 1, 1), 0.75)
+        mock_time.return_value = 1001.5
+        self.assertEqual(self.limiter.acquire('key', 1, 1), 0.5)  # 1001 window reserved above
+
+    def test_backlog_skips_full_windows(self, mock_time):
+        # a request behind a deep backlog goes straight to the first window with room
+        waits = [self.limiter.acquire('key', 1, 1) for _ in range(100)]
+        self.assertEqual(waits[-1], 98.75)
+        cache = caches['default']
+        with patch.object(cache, 'incr', wraps=cache.incr) as mock_incr:
+            self.assertEqual(self.limiter.acquire('key', 1, 1), 99.75)
+        self.assertEqual(mock_incr.call_count, 1)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import requests
+from django.conf import settings
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from mock import patch
+
+from anymail.backends.routing import RoutingBackend, circuit_breakers
+from anymail.exceptions import AnymailAPIError, AnymailError, AnymailUnsupportedFeature
+from anymail.message import AnymailMessage
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+
+
+MAILGUN_RESPONSE = b"""{"id": "<mailgun-id@example.com>", "message": "Queued. Thank you."}"""
+POSTMARK_RESPONSE = b"""{"To": "to@example.com", "MessageID": "postmark-id", "ErrorCode": 0, "Message": "OK"}"""
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.routing.RoutingBackend',
+                   ANYMAIL={
+                       'MAILGUN_API_KEY': 'test_api_key',
+                       'POSTMARK_SERVER_TOKEN': 'test_server_token',
+                       'ROUTING_BACKENDS': [
+                           {'name': 'mailgun', 'backend': 'anymail.backends.mailgun.MailgunBackend', 'weight': 3},
+                           {'name': 'postmark', 'backend': 'anymail.backends.postmark.PostmarkBackend'},
+                       ],
+                       'ROUTING_RULES': [
+                           {'tags': ['receipt'], 'backends': ['postmark', 'mailgun']},
+                           {'from_domain': 'marketing.example.com', 'backends': ['mailgun']},
+                           {'min_size': 1000, 'backends': ['mailgun', 'postmark']},
+                       ],
+                       'ROUTING_FAILURE_THRESHOLD': 2,
+                   })
+class RoutingBackendTests(RequestsBackendMockAPITestCase):
+    """Test RoutingBackend with (mocked) Mailgun and Postmark backends"""
+
+    def setUp(self):
+        super(RoutingBackendTests, self).setUp()
+        self.addCleanup(circuit_breakers.clear)
+        self.esp_down = set()  # names of ESPs that will fail
+        self.esp_rejects = set()  # names of ESPs that will reject the message (HTTP 400)
+        self.mock_request.side_effect = self.mock_esp_request
+        self.message = AnymailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+
+    def mock_esp_request(self, session, method, url, **kwargs):
+        esp = 'mailgun' if 'mailgun' in url else 'postmark'
+        if esp in self.esp_down:
+            if esp == 'postmark':
+                raise requests.Timeout("Read timed out")
+            return self.MockResponse(503, b"Service unavailable")
+        if esp in self.esp_rejects:
+            return self.MockResponse(400, b"Invalid from address")
+        return self.MockResponse(200, MAILGUN_RESPONSE if esp == 'mailgun' else POSTMARK_RESPONSE)
+
+    def called_esps(self):
+        return ['mailgun' if 'mailgun' in call[1]['url'] else 'postmark' for call in self.mock_request.call_args_list]
+
+    @patch('random.uniform')
+    def test_weighted_routing(self, mock_uniform):
+        mock_uniform.return_value = 2.5  # (of 4: mailgun 3, postmark 1)
+        self.message.send()
+        mock_uniform.return_value = 3.5
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['mailgun', 'postmark'])
+        self.assertEqual(self.message.anymail_status.message_id, 'postmark-id')
+
+    def test_rules(self):
+        self.message.tags = ['receipt']
+        self.message.send()
+        self.message.tags = []
+        self.message.from_email = 'News <news@Marketing.Example.com>'
+        self.message.send()
+        self.message.from_email = 'from@example.com'
+        self.message.attach('report.csv', 'x' * 2000, 'text/csv')
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['postmark', 'mailgun', 'mailgun'])
+
+    @patch('random.uniform', return_value=0)  # mailgun first
+    def test_failover(self, mock_uniform):
+        self.esp_down = {'mailgun'}
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['mailgun', 'postmark'])
+        self.assertEqual(self.message.anymail_status.message_id, 'postmark-id')
+
+        # failover on timeouts, too:
+        self.mock_request.reset_mock()
+        self.esp_down = {'postmark'}
+        self.message.tags = ['receipt']
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['postmark', 'mailgun'])
+
+    def test_all_backends_fail(self):
+        self.esp_down = {'mailgun', 'postmark'}
+        self.message.tags = ['receipt']
+        with self.assertRaises(AnymailAPIError):  # the last error
+            self.message.send()
+        self.assertEqual(self.called_esps(), ['postmark', 'mailgun'])
+
+        sent = mail.get_connection(fail_silently=True).send_messages([self.message])
+        self.assertEqual(sent, 0)
+
+    @patch('random.uniform', return_value=0)  # mailgun first
+    def test_no_failover_for_local_errors(self, mock_uniform):
+        # OSError (socket.error on Python 3) can come from local problems, like an unreadable file
+        self.mock_request.side_effect = OSError("No such file or directory")
+        for _ in range(3):
+            with self.assertRaises(OSError):
+                self.message.send()
+        self.assertEqual(self.called_esps(), ['mailgun'] * 3)  # no failover, and no open circuit
+
+    @patch('random.uniform', return_value=0)  # mailgun first
+    def test_no_failover_for_client_errors(self, mock_uniform):
+        # An API error caused by the message (not the ESP being down) doesn't fail over or open the circuit
+        self.esp_rejects = {'mailgun'}
+        for _ in range(3):  # (more than ROUTING_FAILURE_THRESHOLD)
+            with self.assertRaises(AnymailAPIError):
+                self.message.send()
+        self.assertEqual(self.called_esps(), ['mailgun'] * 3)
+
+    def test_circuit_breakers_by_settings(self):
+        connection = mail.get_connection()
+        with self.settings(ANYMAIL=dict(settings.ANYMAIL, ROUTING_FAILURE_THRESHOLD=10)):
+            other_connection = mail.get_connection()
+        self.assertIsNot(connection.circuit_breakers['mailgun'], other_connection.circuit_breakers['mailgun'])
+        self.assertEqual(other_connection.circuit_breakers['mailgun'].failure_threshold, 10)
+        self.assertIs(connection.circuit_breakers['mailgun'], mail.get_connection().circuit_breakers['mailgun'])
+
+    def test_no_backends_attempted(self):
+        with patch.object(RoutingBackend, 'get_routes', return_value=[]):
+            with self.assertRaisesMessage(AnymailError, "No ROUTING_BACKENDS available"):
+                self.message.send()
+
+    def test_no_failover_for_message_errors(self):
+        self.message.tags = ['receipt']
+        self.message.send_at = 1651820000  # Postmark doesn't support send_at
+        with self.assertRaises(AnymailUnsupportedFeature):
+            self.message.send()
+        self.assert_esp_not_called()
+
+    @patch('time.time', return_value=1000.0)
+    def test_circuit_breaker(self, mock_time):
+        self.esp_down = {'postmark'}
+        self.message.tags = ['receipt']
+        self.message.send()
+        self.message.send()  # ROUTING_FAILURE_THRESHOLD reached
+        self.assertEqual(self.called_esps(), ['postmark', 'mailgun', 'postmark', 'mailgun'])
+
+        self.mock_request.reset_mock()
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['mailgun'])  # skips postmark without trying
+
+        # after ROUTING_RECOVERY_TIME, postmark gets a trial
+        self.mock_request.reset_mock()
+        self.esp_down = set()
+        mock_time.return_value = 1031.0
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['postmark'])
+        self.message.send()
+        self.assertEqual(self.called_esps(), ['postmark', 'postmark'])
+
+    @patch('time.time', return_value=1000.0)
+    def test_all_circuits_open(self, mock_time):
+        self.esp_down = {'mailgun'}
+        self.message.from_email = 'news@marketing.example.com'  # mailgun only
+        for _ in range(2):
+            mail.get_connection(fail_silently=True).send_messages([self.message])
+        self.esp_down = set()
+        self.mock_request.reset_mock()
+        self.message.send()  # tried even though mailgun's circuit is open
+        self.assertEqual(self.called_esps(), ['mailgun'])
+
+    @patch('random.uniform', return_value=0)  # mailgun first
+    def test_connection_reuse(self, mock_uniform):
+        """Each backend's connection is opened once, and closed with the RoutingBackend"""
+        connection = mail.get_connection()
+        connection.open()
+        for _ in range(3):
+            connection.send_messages([self.message])
+        sessions = set(call[0][0] for call in self.mock_request.call_args_list)
+        self.assertEqual(len(sessions), 1)
+        connection.close()
+        self.assertEqual(connection.opened_connections, [])
+
+    def test_unknown_backend_in_rules(self):
+        with self.settings(ANYMAIL={
+                'ROUTING_BACKENDS': ['anymail.backends.mailgun.MailgunBackend'],
+                'ROUTING_RULES': [{'tags': ['receipt'], 'backends': ['mailgun']}],
+                'MAILGUN_API_KEY': 'test_api_key'}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "refers to unknown backend"):
+                mail.get_connection()
+
+    def test_empty_rule_backends(self):
+        with self.settings(ANYMAIL={
+                'ROUTING_BACKENDS': ['anymail.backends.mailgun.MailgunBackend'],
+                'ROUTING_RULES': [{'tags': ['receipt'], 'backends': []}],
+                'MAILGUN_API_KEY': 'test_api_key'}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "needs a non-empty 'backends' list"):
+                mail.get_connection()
@@ -0,0 +1,160 @@
+from django.core import mail
+from django.test.utils import override_settings
+from mock import ANY, create_autospec, patch
+
+from anymail.backends.postmark import PostmarkBackend
+from anymail.exceptions import AnymailAPIError, AnymailCancelSend, AnymailRecipientsRefused
+from anymail.signals import post_send, pre_send
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+
+
+def pre_send_handler(sender, message, esp_name, **kwargs):
+    pass
+
+
+def post_send_handler(sender, message, status, esp_name, payload, response, timings, **kwargs):
+    pass
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.postmark.PostmarkBackend',
+                   ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token'})
+class SendSignalsTestCase(RequestsBackendMockAPITestCase):
+    DEFAULT_RAW_RESPONSE = b"""{
+        "To": "to@example.com",
+        "MessageID": "b4007d94-33f1-4e78-a783-97417d6c80e6",
+        "ErrorCode": 0,
+        "Message": "OK"
+    }"""
+
+    def setUp(self):
+        super(SendSignalsTestCase, self).setUp()
+        self.message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com'])
+
+    def connect(self, signal, handler):
+        mock_handler = create_autospec(handler)
+        signal.connect(mock_handler)
+        self.addCleanup(signal.disconnect, mock_handler)
+        return mock_handler
+
+
+class PreSendSignalTests(SendSignalsTestCase):
+
+    def test_modify_message(self):
+        def add_tag(sender, message, esp_name, **kwargs):
+            message.tags = ["modified"]
+            message.subject = "Modified subject"
+        handler = self.connect(pre_send, pre_send_handler)
+        handler.side_effect = add_tag
+        self.message.send()
+        handler.assert_called_once_with(signal=pre_send, sender=PostmarkBackend,
+                                        message=self.message, esp_name="Postmark")
+        data = self.get_api_call_json()
+        self.assertEqual(data['Subject'], "Modified subject")
+        self.assertEqual(data['Tag'], "modified")
+
+    def test_cancel_send(self):
+        handler = self.connect(pre_send, pre_send_handler)
+        handler.side_effect = AnymailCancelSend("don't send this")
+        sent = self.message.send()
+        self.assertEqual(sent, 0)
+        self.assert_esp_not_called()
+        self.assertIsNone(self.message.anymail_status.status)
+
+    def test_errors_propagate(self):
+        handler = self.connect(pre_send, pre_send_handler)
+        handler.side_effect = ValueError("receiver error")
+        with self.assertRaises(ValueError):
+            self.message.send()
+        self.assert_esp_not_called()
+
+
+class PostSendSignalTests(SendSignalsTestCase):
+
+    def test_post_send(self):
+        handler = self.connect(post_send, post_send_handler)
+        self.message.send()
+        handler.assert_called_once_with(signal=post_send, sender=PostmarkBackend, message=self.message,
+                                        status=self.message.anymail_status, esp_name="Postmark",
+                                        payload=ANY, response=ANY, timings=ANY)
+        kwargs = handler.call_args[1]
+        self.assertEqual(kwargs['payload'].data['To'], "to@example.com")
+        self.assertIs(kwargs['response'], self.message.anymail_status.esp_response)
+        timings = kwargs['timings']
+        self.assertIs(timings, self.message.anymail_status.timings)
+        self.assertLessEqual({'build_payload', 'post_to_esp', 'parse_response', 'total'}, set(timings))
+        self.assertGreaterEqual(timings['total'],
+                                timings['build_payload'] + timings['post_to_esp'] + timings['parse_response'])
+
+    def test_sent_before_recipients_refused(self):
+        handler = self.connect(post_send, post_send_handler)
+        self.set_mock_response(
+            status_code=422,
+            raw=b'{"ErrorCode":406,'
+                b'"Message":"You tried to send to a recipient that has been marked as inactive.\\n'
+                b'Found inactive addresses: to@example.com."}')
+        with self.assertRaises(AnymailRecipientsRefused):
+            self.message.send()
+        self.assertEqual(handler.call_count, 1)
+        self.assertEqual(handler.call_args[1]['status'].status, {'rejected'})
+
+    def test_not_sent_for_api_errors(self):
+        handler = self.connect(post_send, post_send_handler)
+        self.set_mock_response(status_code=500)
+        with self.assertRaises(AnymailAPIError):
+            self.message.send()
+        self.assertEqual(handler.call_count, 0)
+
+
+class BatchSendSignalsTests(SendSignalsTestCase):
+    """Postmark's batch_send path sends the same signals as individual sends"""
+
+    DEFAULT_RAW_RESPONSE = b"""[
+        {"To": "to1@example.com", "MessageID": "id1", "ErrorCode": 0, "Message": "OK"},
+        {"To": "to3@example.com", "MessageID": "id3", "ErrorCode": 0, "Message": "OK"}
+    ]"""
+
+    def setUp(self):
+        super(BatchSendSignalsTests, self).setUp()
+        self.messages = [mail.EmailMessage('Subject %d' % i, 'Body', 'from@example.com', ['to%d@example.com' % i])
+                         for i in (1, 2, 3)]
+
+    def test_pre_send(self):
+        def cancel_or_modify(sender, message, esp_name, **kwargs):
+            if message.to == ['to2@example.com']:
+                raise AnymailCancelSend("don't send this")
+            message.subject = "Modified " + message.subject
+        handler = self.connect(pre_send, pre_send_handler)
+        handler.side_effect = cancel_or_modify
+        sent = mail.get_connection(batch_send=True).send_messages(self.messages)
+        self.assertEqual(sent, 2)
+        self.assertEqual(handler.call_count, 3)
+        self.assert_esp_called('/email/batch')
+        data = self.get_api_call_json()
+        self.assertEqual([item['Subject'] for item in data], ["Modified Subject 1", "Modified Subject 3"])
+        self.assertIsNone(self.messages[1].anymail_status.status)
+
+    def test_post_send(self):
+        handler = self.connect(post_send, post_send_handler)
+        self.set_mock_response(raw=b'[{"MessageID": "id1", "ErrorCode": 0, "Message": "OK"},'
+                                   b' {"MessageID": "id2", "ErrorCode": 0, "Message": "OK"},'
+                                   b' {"MessageID": "id3", "ErrorCode": 0, "Message": "OK"}]')
+        mail.get_connection(batch_send=True).send_messages(self.messages)
+        self.assertEqual(handler.call_count, 3)
+        for message, call_args in zip(self.messages, handler.call_args_list):
+            kwargs = call_args[1]
+            self.assertIs(kwargs['message'], message)
+            self.assertEqual(kwargs['status'].status, {'sent'})
+            self.assertEqual(kwargs['payload'].data['To'], message.to[0])
+            self.assertIs(kwargs['response'], message.anymail_status.esp_response)
+
+
+class SendSignalsFastPathTests(SendSignalsTestCase):
+
+    def test_no_receivers(self):
+        """Signals aren't dispatched (or timings computed) if no one's listening"""
+        with patch.object(pre_send, 'send') as mock_pre_send, patch.object(post_send, 'send') as mock_post_send:
+            self.message.send()
+        self.assertEqual(mock_pre_send.call_count, 0)
+        self.assertEqual(mock_post_send.call_count, 0)
+        self.assert_esp_called('/email')
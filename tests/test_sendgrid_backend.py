@@ -15,6 +15,7 @@ from django.test import SimpleTestCase
 from django.test.utils import override_settings
 from django.utils.timezone import get_fixed_timezone, override as override_current_timezone
 
+from anymail.backends.base_requests import StreamingBody
 from anymail.exceptions import AnymailAPIError, AnymailSerializationError, AnymailUnsupportedFeature, AnymailWarning
 from anymail.message import attach_inline_image_file
 
@@ -582,6 +583,25 @@ class SendGridBackendAnymailFeatureTests(SendGridBackendMockAPITestCase):
         self.assertIn("Decimal('19.99') is not JSON serializable", str(err))  # original message
 
 
+class SendGridBackendStreamingTests(SendGridBackendMockAPITestCase):
+    """Test STREAMING_THRESHOLD"""
+
+    def test_streaming(self):
+        self.message.attach("large.bin", bytes(bytearray(range(256))) * 400, "application/octet-stream")
+        attach_inline_image_file(self.message, sample_image_path())
+        self.message.tags = ["tag"]  # (x-smtpapi field)
+        self.message.extra_headers = {"Message-ID": "<streaming@example.com>"}  # (else differs per send)
+        self.message.send()
+        data = self.get_api_call_data()
+        files = self.get_api_call_files()
+
+        self.message.connection = mail.get_connection(streaming_threshold=100000)
+        self.message.send()
+        body = self.get_api_call_data()
+        self.assertIsInstance(body, StreamingBody)
+        self.assert_streamed_multipart(body, data, files)
+
+
 class SendGridBackendRecipientsRefusedTests(SendGridBackendMockAPITestCase):
     """Should raise AnymailRecipientsRefused when *all* recipients are rejected or invalid"""
 
@@ -3,9 +3,9 @@ from datetime import datetime
 
 from django.core.urlresolvers import reverse
 from django.utils.timezone import utc
-from mock import ANY
+from mock import ANY, create_autospec
 
-from anymail.signals import AnymailTrackingEvent
+from anymail.signals import AnymailTrackingEvent, tracking, tracking_batch
 from anymail.webhooks.sendgrid import SendGridTrackingWebhookView
 from .webhook_cases import WebhookBasicAuthTestsMixin, WebhookTestCase
 
@@ -233,3 +233,77 @@ class SendGridDeliveryTestCase(WebhookTestCase):
         self.assertEqual(event.recipient, "recipient@example.com")
         self.assertEqual(event.user_agent, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_4) AppleWebKit/537.36")
         self.assertEqual(event.click_url, "http://www.example.com")
+
+
+def batch_handler(sender, events, esp_name, **kwargs):
+    """Prototypical tracking_batch signal handler"""
+    pass
+
+
+class SendGridBatchTestCase(WebhookTestCase):
+    """Test tracking_batch signal"""
+
+    raw_events = [{
+        "email": "recipient@example.com",
+        "timestamp": 1461095246,
+        "smtp-id": "<wrfRRvF7Q0GgwUo2CvDmEA@example.com>",
+        "sg_event_id": "event-%d" % n,
+        "event": event_type,
+    } for n, event_type in enumerate(["processed", "delivered", "open"])]
+
+    def setUp(self):
+        super(SendGridBatchTestCase, self).setUp()
+        self.batch_handler = create_autospec(batch_handler)
+        tracking_batch.connect(self.batch_handler)
+        self.addCleanup(tracking_batch.disconnect, self.batch_handler)
+
+    def call_webhook(self, raw_events):
+        webhook = reverse('sendgrid_tracking_webhook')
+        return self.client.post(webhook, content_type='application/json', data=json.dumps(raw_events))
+
+    def test_batch(self):
+        response = self.call_webhook(self.raw_events)
+        self.assertEqual(response.status_code, 200)
+        kwargs = self.assert_handler_called_once_with(self.batch_handler, sender=SendGridTrackingWebhookView,
+                                                      events=ANY, esp_name='SendGrid')
+        events = kwargs['events']
+        self.assertEqual([event.event_type for event in events], ["queued", "delivered", "opened"])
+        self.assertEqual([event.event_id for event in events], ["event-0", "event-1", "event-2"])
+        # tracking signal is still sent for each event:
+        self.assertEqual(self.tracking_handler.call_count, 3)
+        self.assertEqual([call[1]['event'] for call in self.tracking_handler.call_args_list], events)
+
+    def test_batch_only(self):
+        tracking.disconnect(self.tracking_handler)
+        response = self.call_webhook(self.raw_events)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.batch_handler.call_count, 1)
+        self.assertEqual(self.tracking_handler.call_count, 0)
+
+    def test_empty_batch(self):
+        response = self.call_webhook([])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.batch_handler.call_count, 0)
+
+
+class SendGridBatchParsingTestCase(WebhookTestCase):
+
+    def test_malformed_mid_batch(self):
+        """No events are dispatched from a batch that isn't valid JSON"""
+        raw_events = [{"email": "recipient@example.com", "timestamp": 1461095246,
+                       "sg_event_id": "event-%d" % n, "event": "delivered"} for n in range(2)]
+        body = json.dumps(raw_events)[:-1] + ', {"invalid'  # the third event is truncated
+        webhook = reverse('sendgrid_tracking_webhook')
+        with self.assertRaises(ValueError):
+            self.client.post(webhook, content_type='application/json', data=body)
+        self.assertEqual(self.tracking_handler.call_count, 0)
+
+    def test_invalid_event_mid_batch(self):
+        """No events are dispatched from a batch with an event that can't be converted"""
+        raw_events = [{"email": "recipient@example.com", "timestamp": 1461095246,
+                       "sg_event_id": "event-0", "event": "delivered"},
+                      {"email": "recipient@example.com"}]  # second event is missing 'event'
+        webhook = reverse('sendgrid_tracking_webhook')
+        with self.assertRaises(KeyError):
+            self.client.post(webhook, content_type='application/json', data=json.dumps(raw_events))
+        self.assertEqual(self.tracking_handler.call_count, 0)
@@ -0,0 +1,136 @@
+import json
+
+import requests
+from django.core import mail
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from six import StringIO
+
+from anymail.exceptions import AnymailAPIError
+from anymail.simulator import ESPSimulator
+
+from .utils import AnymailTestMixin
+
+
+BACKENDS = {
+    "mailgun": ("anymail.backends.mailgun.MailgunBackend", {"api_key": "simulated"}),
+    "mandrill": ("anymail.backends.mandrill.MandrillBackend", {"api_key": "simulated"}),
+    "postmark": ("anymail.backends.postmark.PostmarkBackend", {"server_token": "simulated"}),
+    "sendgrid": ("anymail.backends.sendgrid.SendGridBackend", {"api_key": "simulated"}),
+}
+
+
+@override_settings(ANYMAIL={})
+class ESPSimulatorTests(SimpleTestCase, AnymailTestMixin):
+    """Send through the real backends to the simulator"""
+
+    def start_simulator(self, **kwargs):
+        simulator = ESPSimulator(**kwargs)
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        return simulator
+
+    def get_connection(self, simulator, esp, **kwargs):
+        backend, connection_kwargs = BACKENDS[esp]
+        kwargs.update(connection_kwargs)
+        return mail.get_connection(backend, api_url=simulator.api_url(esp), **kwargs)
+
+    def make_message(self):
+        return mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to1@example.com', 'to2@example.com'])
+
+    def test_send_formats(self):
+        simulator = self.start_simulator()
+        for esp in sorted(BACKENDS):
+            message = self.make_message()
+            sent = self.get_connection(simulator, esp).send_messages([message])
+            self.assertEqual(sent, 1, esp)
+            self.assertLessEqual(message.anymail_status.status, {'sent', 'queued'}, esp)
+            self.assertEqual(set(message.anymail_status.recipients), {'to1@example.com', 'to2@example.com'}, esp)
+        self.assertEqual(simulator.stats['status_codes'], {200: 4})
+
+    def test_postmark_batch(self):
+        simulator = self.start_simulator()
+        messages = [self.make_message() for _ in range(3)]
+        sent = self.get_connection(simulator, "postmark", batch_send=True).send_messages(messages)
+        self.assertEqual(sent, 3)
+        self.assertEqual(simulator.stats['requests'], 1)
+        self.assertEqual(len(set(message.anymail_status.message_id for message in messages)), 3)
+
+    def test_errors(self):
+        simulator = self.start_simulator(error_rate=1.0, error_status=503)
+        with self.assertRaises(AnymailAPIError) as cm:
+            self.get_connection(simulator, "mandrill").send_messages([self.make_message()])
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(cm.exception.response.json()['status'], "error")
+
+        with self.assertRaises(AnymailAPIError) as cm:
+            self.get_connection(simulator, "postmark").send_messages([self.make_message()])
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertNotEqual(cm.exception.response.json()['ErrorCode'], 0)
+
+    def test_throttle_bursts(self):
+        simulator = self.start_simulator(throttle_every=1, throttle_count=2)
+        connection = self.get_connection(simulator, "postmark", send_retries=2)
+        message = self.make_message()
+        connection.send_messages([message])  # first request succeeds
+        connection.send_messages([message])  # next two are rate limited (and retried)
+        self.assertEqual(message.anymail_status.retries, 2)
+        self.assertEqual(message.anymail_status.status, {'sent'})
+        self.assertEqual(simulator.stats['status_codes'], {200: 2, 429: 2})
+
+    def test_max_payload_size(self):
+        simulator = self.start_simulator(max_payload_size=1000)
+        message = self.make_message()
+        message.attach("large.bin", b"x" * 2000, "application/octet-stream")
+        with self.assertRaises(AnymailAPIError) as cm:
+            self.get_connection(simulator, "mailgun").send_messages([message])
+        self.assertEqual(cm.exception.status_code, 413)
+
+        # (the connection is still usable after a rejected payload)
+        self.assertEqual(self.get_connection(simulator, "mailgun").send_messages([self.make_message()]), 1)
+
+    def test_postmark_batch_payload_size(self):
+        """Postmark allows larger request bodies for its batch API than for a single message"""
+        simulator = self.start_simulator()
+        body = json.dumps([{"To": "to@example.com", "TextBody": "x" * (6 * 1024 * 1024)}] * 2).encode('utf-8')
+        self.assertEqual(requests.post(simulator.api_url("postmark") + "email/batch", data=body).status_code, 200)
+        self.assertEqual(requests.post(simulator.api_url("postmark") + "email", data=body).status_code, 413)
+
+    def test_invalid_requests(self):
+        simulator = self.start_simulator()
+        response = requests.post(simulator.url + "/postmark/no-such-endpoint", data=b"{}")
+        self.assertEqual(response.status_code, 404)
+        response = requests.post(simulator.api_url("postmark") + "email", data=b"not json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["Message"], "Invalid JSON in request body")
+
+    def test_chunked_request_body(self):
+        simulator = self.start_simulator()
+        body = json.dumps({"To": "to@example.com"}).encode('utf-8')
+        response = requests.post(simulator.api_url("postmark") + "email", data=iter([body[:10], body[10:]]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["To"], "to@example.com")
+
+
+@override_settings(ANYMAIL={})
+class LoadTestCommandTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_load_test(self):
+        stdout = StringIO()
+        call_command('anymail_load_test', esp="sendgrid", messages=20, concurrency=2, batch_size=3,
+                     error_rate=0.5, seed=1, json=True, stdout=stdout)
+        results = json.loads(stdout.getvalue())
+        self.assertEqual(results['sent'] + results['failed'], 20)
+        self.assertGreater(results['failed'], 0)
+        self.assertEqual(sum(results['simulator_status_codes'].values()), 20)
+        self.assertEqual(results['simulator_status_codes']['200'], results['sent'])
+        self.assertLessEqual(results['latency']['p50'], results['latency']['max'])
+
+    def test_report(self):
+        stdout = StringIO()
+        call_command('anymail_load_test', esp="postmark", messages=5, concurrency=1, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("Sent 5, failed 0, retries 0", output)
+        self.assertIn("messages/sec", output)
+        self.assertIn("Latency per send_messages call: p50", output)
@@ -0,0 +1,171 @@
+import json
+import shutil
+import tempfile
+from os import path
+
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from anymail import suppression
+from anymail.exceptions import AnymailRecipientsRefused
+from anymail.signals import tracking
+from anymail.suppression import (BloomFilter, CacheSuppressionList, SQLiteSuppressionList,
+                                 get_suppression_list, record_suppression_event)
+
+from .mock_requests_backend import RequestsBackendMockAPITestCase
+from .utils import AnymailTestMixin
+from .webhook_cases import WebhookTestCase
+
+
+class BloomFilterTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        emails = ["user%d@example.com" % n for n in range(1000)]
+        for email in emails:
+            bloom.add(email)
+        self.assertTrue(all(email in bloom for email in emails))
+
+        false_positives = sum(1 for n in range(10000) if "other%d@example.com" % n in bloom)
+        self.assertLess(false_positives, 300)  # (about 1% expected)
+
+
+class SQLiteSuppressionListTests(SimpleTestCase, AnymailTestMixin):
+
+    def setUp(self):
+        super(SQLiteSuppressionListTests, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = path.join(tempdir, 'suppressions.sqlite3')
+        self.suppression_list = SQLiteSuppressionList(self.path)
+
+    def test_add_remove(self):
+        self.suppression_list.add("Bounce@Example.com", "bounced")
+        self.suppression_list.add("complaint@example.com", "complained")
+        reasons = self.suppression_list.get_reasons(["bounce@example.com", "ok@example.com", "COMPLAINT@example.com"])
+        self.assertEqual(reasons, {"bounce@example.com": "bounced", "complaint@example.com": "complained"})
+        self.suppression_list.remove("BOUNCE@example.com")
+        self.assertEqual(self.suppression_list.get_reasons(["bounce@example.com"]), {})
+        self.assertEqual(len(self.suppression_list), 1)
+
+    @patch('time.time', return_value=1000.0)
+    def test_shared_between_processes(self, mock_time):
+        """Other processes' additions are picked up when the bloom filter is reloaded"""
+        self.assertEqual(self.suppression_list.get_reasons(["bounce@example.com"]), {})  # (loads bloom filter)
+        SQLiteSuppressionList(self.path).add("bounce@example.com", "bounced")  # another process
+        self.assertEqual(self.suppression_list.get_reasons(["bounce@example.com"]), {})  # not yet
+        mock_time.return_value = 1060.0
+        self.assertEqual(self.suppression_list.get_reasons(["bounce@example.com"]),
+                         {"bounce@example.com": "bounced"})
+
+    def test_many_recipients(self):
+        emails = ["user%d@example.com" % n for n in range(1200)]
+        for email in emails:
+            self.suppression_list.add(email, "bounced")
+        self.assertEqual(len(self.suppression_list.get_reasons(emails)), 1200)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'anymail-test-suppression'}})
+class CacheSuppressionListTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_add_remove(self):
+        suppression_list = CacheSuppressionList()
+        suppression_list.cache.clear()
+        suppression_list.add("Bounce@Example.com", "bounced")
+        self.assertEqual(suppression_list.get_reasons(["bounce@example.com", "ok@example.com"]),
+                         {"bounce@example.com": "bounced"})
+        suppression_list.remove("bounce@example.com")
+        self.assertEqual(suppression_list.get_reasons(["bounce@example.com"]), {})
+
+
+class SuppressionSettingsMixin(object):
+
+    def setUp(self):
+        super(SuppressionSettingsMixin, self).setUp()
+        # Don't share suppression lists between tests:
+        patch_lists = patch.dict(suppression._suppression_lists.instances, clear=True)
+        patch_lists.start()
+        self.addCleanup(patch_lists.stop)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        settings_override = self.settings(ANYMAIL={
+            'WEBHOOK_AUTHORIZATION': 'username:password',
+            'POSTMARK_SERVER_TOKEN': 'test_server_token',
+            'SUPPRESSION_LIST': 'sqlite',
+            'SUPPRESSION_LIST_PATH': path.join(tempdir, 'suppressions.sqlite3'),
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class SuppressionWebhookTests(SuppressionSettingsMixin, WebhookTestCase):
+
+    def setUp(self):
+        super(SuppressionWebhookTests, self).setUp()
+        # (AnymailConfig.ready connects this when SUPPRESSION_LIST is set at startup)
+        tracking.connect(record_suppression_event, dispatch_uid="anymail.suppression")
+        self.addCleanup(tracking.disconnect, dispatch_uid="anymail.suppression")
+
+    def test_records_tracking_events(self):
+        webhook = reverse('sendgrid_tracking_webhook')
+        self.client.post(webhook, content_type='application/json', data=json.dumps([
+            {"email": "bounce@example.com", "event": "bounce", "timestamp": 1461095250},
+            {"email": "spam@example.com", "event": "spamreport", "timestamp": 1461095250},
+            {"email": "ok@example.com", "event": "delivered", "timestamp": 1461095250},
+        ]))
+        self.assertEqual(
+            get_suppression_list().get_reasons(["bounce@example.com", "spam@example.com", "ok@example.com"]),
+            {"bounce@example.com": "bounced", "spam@example.com": "complained"})
+
+
+@override_settings(EMAIL_BACKEND='anymail.backends.postmark.PostmarkBackend')
+class SuppressionBackendTests(SuppressionSettingsMixin, RequestsBackendMockAPITestCase):
+
+    def setUp(self):
+        super(SuppressionBackendTests, self).setUp()
+        get_suppression_list().add("bounce@example.com", "bounced")
+
+    def test_drops_suppressed_recipients(self):
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                    ['to@example.com', 'Bounce <BOUNCE@example.com>'], cc=['bounce@example.com'])
+        self.set_mock_response(
+            raw=b'{"To": "to@example.com", "MessageID": "abc123", "ErrorCode": 0, "Message": "OK"}')
+        message.send()
+        data = self.get_api_call_json()
+        self.assertEqual(data['To'], "to@example.com")
+        self.assertNotIn('Cc', data)
+        self.assertEqual(message.to, ['to@example.com', 'Bounce <BOUNCE@example.com>'])  # caller's message unchanged
+        self.assertEqual(message.anymail_status.recipients['BOUNCE@example.com'].status, 'rejected')
+        self.assertEqual(message.anymail_status.recipients['to@example.com'].status, 'sent')
+        self.assertEqual(message.anymail_status.status, {'sent', 'rejected'})
+
+    def test_all_recipients_suppressed(self):
+        message = mail.EmailMessage('Subject', 'Body', 'from@example.com', ['bounce@example.com'])
+        with self.assertRaises(AnymailRecipientsRefused):
+            message.send()
+        self.assert_esp_not_called()
+        self.assertEqual(message.anymail_status.status, {'rejected'})
+
+        sent = mail.get_connection(ignore_recipient_status=True).send_messages([message])
+        self.assertEqual(sent, 0)
+        self.assert_esp_not_called()
+
+    def test_batch_send(self):
+        """Postmark's batch_send path also drops suppressed recipients"""
+        messages = [mail.EmailMessage('Subject', 'Body', 'from@example.com', ['to@example.com', 'bounce@example.com']),
+                    mail.EmailMessage('Subject', 'Body', 'from@example.com', ['bounce@example.com']),
+                    mail.EmailMessage('Subject', 'Body', 'from@example.com', ['other@example.com'])]
+        self.set_mock_response(
+            raw=b'[{"To": "to@example.com", "MessageID": "abc123", "ErrorCode": 0, "Message": "OK"},'
+                b' {"To": "other@example.com", "MessageID": "def456", "ErrorCode": 0, "Message": "OK"}]')
+        sent = mail.get_connection(batch_send=True, fail_silently=True).send_messages(messages)
+        self.assertEqual(sent, 2)
+        self.assert_esp_called('/email/batch')
+        self.assertEqual([item['To'] for item in self.get_api_call_json()], ["to@example.com", "other@example.com"])
+        self.assertEqual(messages[0].anymail_status.recipients['bounce@example.com'].status, 'rejected')
+        self.assertEqual(messages[0].anymail_status.recipients['to@example.com'].status, 'sent')
+        self.assertEqual(messages[1].anymail_status.status, {'rejected'})
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from base64 import b64encode
+
+from django.core import mail
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from anymail.exceptions import AnymailConfigurationError
+from anymail.utils import Attachment, EncodedContentCache, InstanceRegistry, attachment_encoding_cache
+
+from .utils import AnymailTestMixin
+
+
+class EncodedContentCacheTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_cached(self):
+        cache = EncodedContentCache(max_size=100)
+        encoded = cache.b64encode(b"content")
+        self.assertEqual(encoded, b64encode(b"content").decode('ascii'))
+        self.assertIs(cache.b64encode(b"content"), encoded)
+        self.assertIs(cache.b64encode(bytes(bytearray(b"content"))), encoded)  # equal content, different object
+        self.assertEqual(cache.size, len(b"content") + len(encoded))
+
+    def test_found_by_identity(self):
+        """The same content object isn't rehashed"""
+        cache = EncodedContentCache(max_size=100)
+        content = b"content"
+        encoded = cache.b64encode(content)
+        with patch('hashlib.sha1') as mock_sha1:
+            self.assertIs(cache.b64encode(content), encoded)
+        mock_sha1.assert_not_called()
+
+    def test_lru_eviction(self):
+        cache = EncodedContentCache(max_size=42)  # room for 3 6-byte contents with 8-char encodings
+        first = cache.b64encode(b"111111")
+        second = cache.b64encode(b"222222")
+        cache.b64encode(b"333333")
+        self.assertIs(cache.b64encode(b"111111"), first)  # (now most recently used)
+        cache.b64encode(b"444444")  # evicts 222222
+        self.assertEqual(cache.size, 42)
+        self.assertIs(cache.b64encode(b"111111"), first)
+        self.assertEqual(len(cache._entries), 3)
+
+        cache.b64encode(b"content too big to cache")
+        self.assertEqual(len(cache._entries), 3)
+
+        self.assertIsNot(cache.b64encode(b"222222"), second)  # was evicted
+
+        cache.resize(14)
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(len(cache._keys_by_id), 1)
+        self.assertEqual(cache.size, 14)
+
+    def test_attachment_b64content(self):
+        cache = EncodedContentCache(max_size=100)
+        att1 = Attachment(("terms.pdf", b"%PDF-1.4 terms", "application/pdf"), 'utf-8', cache)
+        att2 = Attachment(("terms.pdf", b"%PDF-1.4 terms", "application/pdf"), 'utf-8', cache)
+        self.assertIs(att1.b64content, att2.b64content)
+
+    @override_settings(ANYMAIL={'POSTMARK_SERVER_TOKEN': 'test_server_token',
+                                'ATTACHMENT_ENCODING_CACHE_SIZE': 1000})
+    def test_backend_setting(self):
+        self.addCleanup(attachment_encoding_cache.clear)
+        connection = mail.get_connection('anymail.backends.postmark.PostmarkBackend')
+        self.assertIs(connection.attachment_encoding_cache, attachment_encoding_cache)
+        self.assertEqual(attachment_encoding_cache.max_size, 1000)
+        # the shared cache is sized only by the global setting (not per backend):
+        other_connection = mail.get_connection('anymail.backends.postmark.PostmarkBackend',
+                                               attachment_encoding_cache_size=10)
+        self.assertIs(other_connection.attachment_encoding_cache, attachment_encoding_cache)
+        self.assertEqual(attachment_encoding_cache.max_size, 1000)
+
+
+class InstanceRegistryTests(SimpleTestCase, AnymailTestMixin):
+
+    def test_shared_instances(self):
+        registry = InstanceRegistry({"list": list}, "Unknown SETTING %r")
+        self.assertIs(registry.get("list"), registry.get("list"))
+        self.assertIsInstance(registry.get("collections.OrderedDict"), dict)  # (import path)
+        with self.assertRaisesMessage(AnymailConfigurationError, "Unknown SETTING 'no.such.Class'"):
+            registry.get("no.such.Class")
+
+    def test_no_import_paths(self):
+        registry = InstanceRegistry({"list": list}, "Unknown SETTING %r", import_paths=False)
+        with self.assertRaisesMessage(AnymailConfigurationError, "Unknown SETTING 'collections.OrderedDict'"):
+            registry.get("collections.OrderedDict")
@@ -0,0 +1,120 @@
+import json
+
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from mock import patch
+
+from anymail import webhook_dedup
+from anymail.signals import AnymailTrackingEvent
+from anymail.webhook_dedup import LocalWebhookDedup, event_key, get_webhook_dedup
+
+from .webhook_cases import WebhookTestCase
+
+
+def sendgrid_event(event_id, event_type="delivered", **kwargs):
+    esp_event = {"email": "recipient@example.com", "timestamp": 1461095250, "event": event_type}
+    if event_id is not None:
+        esp_event["sg_event_id"] = event_id
+    esp_event.update(kwargs)
+    return esp_event
+
+
+class WebhookDedupTestCase(WebhookTestCase):
+
+    def setUp(self):
+        super(WebhookDedupTestCase, self).setUp()
+        # Don't share dedup stores (and what they've seen) between tests:
+        patch_dedups = patch.dict(webhook_dedup._dedups.instances, clear=True)
+        patch_dedups.start()
+        self.addCleanup(patch_dedups.stop)
+
+    def post_sendgrid(self, events):
+        webhook = reverse('sendgrid_tracking_webhook')
+        return self.client.post(webhook, content_type='application/json', data=json.dumps(events))
+
+    def handled_event_ids(self):
+        return [kwargs['event'].event_id for args, kwargs in self.tracking_handler.call_args_list]
+
+
+@override_settings(ANYMAIL={'WEBHOOK_AUTHORIZATION': 'username:password', 'WEBHOOK_DEDUP': 'local'})
+class LocalWebhookDedupTests(WebhookDedupTestCase):
+
+    def test_drops_redelivered_events(self):
+        self.post_sendgrid([sendgrid_event("id1"), sendgrid_event("id2")])
+        self.post_sendgrid([sendgrid_event("id1"), sendgrid_event("id2"), sendgrid_event("id3")])
+        self.assertEqual(self.handled_event_ids(), ["id1", "id2", "id3"])
+
+    def test_failed_events_are_redelivered(self):
+        """Events are only marked seen after their receivers succeed"""
+        self.tracking_handler.side_effect = [None, ValueError("receiver failed")]
+        with self.assertRaises(ValueError):
+            self.post_sendgrid([sendgrid_event("id1"), sendgrid_event("id2")])
+        self.tracking_handler.side_effect = None
+        self.post_sendgrid([sendgrid_event("id1"), sendgrid_event("id2")])  # ESP retries the batch
+        self.assertEqual(self.handled_event_ids(), ["id1", "id2", "id2"])
+
+    def test_events_without_id(self):
+        self.post_sendgrid([sendgrid_event(None, "open"), sendgrid_event(None, "click")])
+        self.post_sendgrid([sendgrid_event(None, "click"), sendgrid_event(None, "click", url="http://example.com")])
+        self.assertEqual([kwargs['event'].event_type for args, kwargs in self.tracking_handler.call_args_list],
+                         ["opened", "clicked", "clicked"])
+
+    def test_max_size(self):
+        dedup = LocalWebhookDedup(max_size=2)
+        for key in ["a", "b", "c"]:
+            dedup.add(key)
+        self.assertFalse(dedup.is_seen("a"))  # least recently seen was forgotten
+        self.assertTrue(dedup.is_seen("b"))
+        self.assertTrue(dedup.is_seen("c"))
+
+    @patch('time.time', return_value=1000.0)
+    def test_ttl(self, mock_time):
+        dedup = LocalWebhookDedup(ttl=60)
+        dedup.add("a")
+        mock_time.return_value = 1059.0
+        self.assertTrue(dedup.is_seen("a"))
+        mock_time.return_value = 1060.0
+        self.assertFalse(dedup.is_seen("a"))
+
+
+@override_settings(ANYMAIL={'WEBHOOK_AUTHORIZATION': 'username:password', 'WEBHOOK_DEDUP': 'cache'},
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'anymail-test-dedup'}})
+class CacheWebhookDedupTests(WebhookDedupTestCase):
+
+    def setUp(self):
+        super(CacheWebhookDedupTests, self).setUp()
+        get_webhook_dedup().cache.clear()
+
+    def test_drops_redelivered_events(self):
+        self.post_sendgrid([sendgrid_event("id1"), sendgrid_event("id2")])
+        self.post_sendgrid([sendgrid_event("id2"), sendgrid_event("id3")])
+        self.assertEqual(self.handled_event_ids(), ["id1", "id2", "id3"])
+
+    def test_unusual_event_ids(self):
+        """Event ids are hashed for cache keys"""
+        event_id = "id with spaces and a long tail " + "x" * 300
+        self.post_sendgrid([sendgrid_event(event_id)])
+        self.post_sendgrid([sendgrid_event(event_id)])
+        self.assertEqual(self.handled_event_ids(), [event_id])
+
+
+class WebhookDedupSettingsTests(WebhookDedupTestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(get_webhook_dedup())
+        self.post_sendgrid([sendgrid_event("id1")])
+        self.post_sendgrid([sendgrid_event("id1")])
+        self.assertEqual(self.handled_event_ids(), ["id1", "id1"])
+
+    def test_event_key(self):
+        event = AnymailTrackingEvent(event_type="delivered", event_id="abc123", esp_event={"id": "abc123"})
+        self.assertEqual(event_key("SendGrid", event), "SendGrid:abc123")
+        self.assertNotEqual(event_key("Mailgun", event), event_key("SendGrid", event))
+
+        # without an event_id, hash is stable (and independent of dict order):
+        event1 = AnymailTrackingEvent(event_type="opened", esp_event={"a": 1, "b": 2})
+        event2 = AnymailTrackingEvent(event_type="opened", esp_event={"b": 2, "a": 1})
+        self.assertEqual(event_key("SendGrid", event1), event_key("SendGrid", event2))
+        event3 = AnymailTrackingEvent(event_type="opened", esp_event={"a": 1, "b": 3})
+        self.assertNotEqual(event_key("SendGrid", event1), event_key("SendGrid", event3))
@@ -0,0 +1,194 @@
+import json
+import pickle
+import shutil
+import tempfile
+from os import path
+
+from django.core.management import call_command, CommandError
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+from mock import ANY, patch
+from six import StringIO
+
+from anymail import webhook_dispatch
+from anymail.webhook_dispatch import get_webhook_dispatcher
+from anymail.webhooks.mailgun import MailgunTrackingWebhookView
+from anymail.webhooks.sendgrid import SendGridTrackingWebhookView
+
+from .test_mailgun_webhooks import TEST_API_KEY, mailgun_sign
+from .webhook_cases import WebhookTestCase
+
+SENDGRID_EVENTS = [{
+    "email": "recipient@example.com",
+    "timestamp": 1461095250,
+    "smtp-id": "<wrfRRvF7Q0GgwUo2CvDmEA@example.com>",
+    "sg_event_id": "nOSv8m0eTQ-vxvwNwt3fZQ",
+    "event": "delivered",
+}]
+
+
+class WebhookDispatchTestCase(WebhookTestCase):
+
+    def setUp(self):
+        super(WebhookDispatchTestCase, self).setUp()
+        # Don't share dispatchers (and their settings) between tests:
+        patch_dispatchers = patch.dict(webhook_dispatch._dispatchers.instances, clear=True)
+        patch_dispatchers.start()
+        self.addCleanup(patch_dispatchers.stop)
+
+    def post_sendgrid(self, events=None):
+        webhook = reverse('sendgrid_tracking_webhook')
+        return self.client.post(webhook, content_type='application/json',
+                                data=json.dumps(events or SENDGRID_EVENTS))
+
+    def assert_sendgrid_event_dispatched(self):
+        kwargs = self.assert_handler_called_once_with(self.tracking_handler, sender=SendGridTrackingWebhookView,
+                                                      event=ANY, esp_name='SendGrid')
+        self.assertEqual(kwargs['event'].event_type, "delivered")
+        self.assertEqual(kwargs['event'].event_id, "nOSv8m0eTQ-vxvwNwt3fZQ")
+
+
+@override_settings(ANYMAIL={'WEBHOOK_AUTHORIZATION': 'username:password', 'WEBHOOK_DISPATCH': 'thread'})
+class ThreadWebhookDispatchTests(WebhookDispatchTestCase):
+
+    def test_dispatch(self):
+        response = self.post_sendgrid()
+        self.assertEqual(response.status_code, 200)
+        get_webhook_dispatcher().join()
+        self.assert_sendgrid_event_dispatched()
+
+    def test_validates_before_queuing(self):
+        self.set_basic_auth('baduser', 'wrongpassword')
+        response = self.post_sendgrid()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(get_webhook_dispatcher().queue.qsize(), 0)
+
+
+class SpoolWebhookDispatchTests(WebhookDispatchTestCase):
+
+    def setUp(self):
+        super(SpoolWebhookDispatchTests, self).setUp()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        settings_override = self.settings(
+            ANYMAIL={
+                'WEBHOOK_AUTHORIZATION': 'username:password',
+                'WEBHOOK_DISPATCH': 'spool',
+                'WEBHOOK_SPOOL_PATH': path.join(tempdir, 'webhooks.sqlite3'),
+                'WEBHOOK_QUEUE_SIZE': 2,
+                'WEBHOOK_MAX_ATTEMPTS': 2,
+            },
+            ANYMAIL_MAILGUN_API_KEY=TEST_API_KEY)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_dispatch(self):
+        response = self.post_sendgrid()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.tracking_handler.call_count, 0)  # not yet
+        self.assertEqual(get_webhook_dispatcher().process_pending(),
+                         {'dispatched': 1, 'retrying': 0, 'failed': 0})
+        self.assert_sendgrid_event_dispatched()
+
+    def test_form_data(self):
+        """Form posts (which are parsed during validation) are reconstructed for parse_events"""
+        webhook = reverse('mailgun_tracking_webhook')
+        response = self.client.post(webhook, data=mailgun_sign({  # (multipart/form-data)
+            'event': 'delivered', 'recipient': 'recipient@example.com',
+            'Message-Id': '<20160929203413.66193.86012.0D1D8E8A@example.com>',
+            'message-headers': '[]',
+        }))
+        self.assertEqual(response.status_code, 200)
+        call_command('anymail_process_webhooks', once=True, stdout=StringIO())
+        kwargs = self.assert_handler_called_once_with(self.tracking_handler, sender=MailgunTrackingWebhookView,
+                                                      event=ANY, esp_name='Mailgun')
+        self.assertEqual(kwargs['event'].event_type, "delivered")
+        self.assertEqual(kwargs['event'].recipient, "recipient@example.com")
+
+    def test_snapshot_omits_authorization(self):
+        self.post_sendgrid()
+        item = get_webhook_dispatcher().spool.claim()[0]
+        snapshot = pickle.loads(item.data)
+        self.assertEqual(snapshot['view'], 'anymail.webhooks.sendgrid.SendGridTrackingWebhookView')
+        self.assertNotIn('HTTP_AUTHORIZATION', snapshot['meta'])
+        self.assertEqual(json.loads(snapshot['body'].decode('utf-8')), SENDGRID_EVENTS)
+
+    def test_queue_full(self):
+        self.assertEqual(self.post_sendgrid().status_code, 200)
+        self.assertEqual(self.post_sendgrid().status_code, 200)
+        self.assertEqual(self.post_sendgrid().status_code, 503)  # WEBHOOK_QUEUE_SIZE
+        get_webhook_dispatcher().process_pending()
+        self.assertEqual(self.post_sendgrid().status_code, 200)
+
+    @patch('anymail.webhook_dispatch.logger')  # (quiet expected errors)
+    @patch('time.time', return_value=1000.0)
+    def test_retries(self, mock_time, mock_logger):
+        self.tracking_handler.side_effect = ValueError("receiver failed")
+        self.post_sendgrid()
+        dispatcher = get_webhook_dispatcher()
+        self.assertEqual(dispatcher.process_pending(), {'dispatched': 0, 'retrying': 1, 'failed': 0})
+        self.assertEqual(dispatcher.process_pending(), {'dispatched': 0, 'retrying': 0, 'failed': 0})  # not yet
+
+        mock_time.return_value = 1031.0
+        self.assertEqual(dispatcher.process_pending(), {'dispatched': 0, 'retrying': 0, 'failed': 1})
+        self.assertEqual(dispatcher.spool.counts(), {'failed': 1})
+
+
+@override_settings(ANYMAIL={'WEBHOOK_AUTHORIZATION': 'username:password',
+                            'WEBHOOK_DISPATCH': 'cache', 'WEBHOOK_QUEUE_SIZE': 2},
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                       'LOCATION': 'anymail-test-webhooks'}})
+class CacheWebhookDispatchTests(WebhookDispatchTestCase):
+
+    def setUp(self):
+        super(CacheWebhookDispatchTests, self).setUp()
+        get_webhook_dispatcher().cache.clear()
+
+    def test_dispatch(self):
+        self.assertEqual(self.post_sendgrid().status_code, 200)
+        self.assertEqual(self.post_sendgrid().status_code, 200)
+        self.assertEqual(self.post_sendgrid().status_code, 503)  # WEBHOOK_QUEUE_SIZE
+        self.assertEqual(self.tracking_handler.call_count, 0)  # not yet
+
+        stdout = StringIO()
+        call_command('anymail_process_webhooks', once=True, stdout=stdout)
+        self.assertEqual(self.tracking_handler.call_count, 2)
+        self.assertIn("Dispatched 2, retrying 0, failed 0", stdout.getvalue())
+        self.assertEqual(get_webhook_dispatcher().process_pending(),
+                         {'dispatched': 0, 'retrying': 0, 'failed': 0})
+
+    @patch('anymail.webhook_dispatch.logger')  # (quiet expected errors)
+    def test_retries(self, mock_logger):
+        self.tracking_handler.side_effect = [ValueError("receiver failed"), None]
+        self.post_sendgrid()
+        dispatcher = get_webhook_dispatcher()
+        self.assertEqual(dispatcher.process_pending(limit=1), {'dispatched': 0, 'retrying': 1, 'failed': 0})
+        self.assertEqual(dispatcher.process_pending(), {'dispatched': 1, 'retrying': 0, 'failed': 0})
+
+    def test_claimed_indexes(self):
+        # Each index is claimed by one worker, even when it's claimed before its event is stored
+        dispatcher = get_webhook_dispatcher()
+        dispatcher.enqueue({'n': 1})
+        self.assertEqual(dispatcher._pop(), {'n': 1})
+        # an enqueue has reserved index 2 (but not yet stored its event), and a worker
+        # with a stale view of the list claims indexes 2 and 3:
+        dispatcher.cache.incr(dispatcher.tail_key)
+        with patch.object(dispatcher, '_get_head_and_tail', return_value=(0, 2)):
+            self.assertIsNone(dispatcher._pop())
+        dispatcher.enqueue({'n': 2})  # (skips the claimed index 3)
+        dispatcher.enqueue({'n': 3})
+        self.assertEqual(dispatcher._pop(), {'n': 2})
+        self.assertEqual(dispatcher._pop(), {'n': 3})
+        self.assertIsNone(dispatcher._pop())
+
+
+class SyncWebhookDispatchTests(WebhookDispatchTestCase):
+
+    def test_sync_is_default(self):
+        self.assertIsNone(get_webhook_dispatcher())
+        self.post_sendgrid()
+        self.assert_sendgrid_event_dispatched()
+
+    def test_command_requires_queue(self):
+        with self.assertRaisesMessage(CommandError, "WEBHOOK_DISPATCH"):
+            call_command('anymail_process_webhooks', once=True)